@@ -0,0 +1,72 @@
+"""
+SQL statements per signed in request, with and without the role permission cache.
+
+    python benchmarks/auth_queries.py [--requests 200]
+
+Runs against a throwaway in-memory database, nothing else needs to be set up.
+"""
+import argparse
+import os
+import sys
+import time
+
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flaskblog import create_app, db, bcrypt  # noqa: E402
+from flaskblog.config import TestingConfig  # noqa: E402
+
+PAGES = ['/', '/about', '/user-profile/moderator', '/moderate']
+
+
+def build_app(role_cache_ttl):
+    class BenchConfig(TestingConfig):
+        ROLE_CACHE_TTL = role_cache_ttl
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        from flaskblog.models import Role, User
+        db.create_all()
+        Role.insert_roles()
+        user = User(username = 'moderator', email = 'moderator@example.com', country = 'Kenya', confirmed = True,
+                    password = bcrypt.generate_password_hash('pw').decode('utf-8'),
+                    role = Role.query.filter_by(name = 'Moderator').one())
+        db.session.add(user)
+        db.session.commit()
+    client = app.test_client()
+    client.post('/login', data = dict(email = 'moderator@example.com', password = 'pw'))
+    return app, client
+
+
+def measure(role_cache_ttl, requests):
+    app, client = build_app(role_cache_ttl)
+    statements = []
+    event.listen(db.get_engine(app), 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    results = {}
+    for page in PAGES:
+        client.get(page)  # warm up
+        del statements[:]
+        start = time.perf_counter()
+        for _ in range(requests):
+            assert client.get(page).status_code == 200, page
+        elapsed = time.perf_counter() - start
+        results[page] = (len(statements) / requests, requests / elapsed)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type = int, default = 200)
+    args = parser.parse_args()
+    before = measure(0, args.requests)
+    after = measure(300, args.requests)
+    print('{:<26}{:>16}{:>16}{:>14}{:>14}'.format('page', 'queries (role)', 'queries (cache)', 'req/s (role)',
+                                                  'req/s (cache)'))
+    for page in PAGES:
+        print('{:<26}{:>16.1f}{:>16.1f}{:>14.0f}{:>14.0f}'.format(page, before[page][0], after[page][0],
+                                                                  before[page][1], after[page][1]))
+
+
+if __name__ == '__main__':
+    main()
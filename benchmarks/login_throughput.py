@@ -0,0 +1,103 @@
+"""
+Sign in throughput and page latency while many clients sign in at once.
+
+    python benchmarks/login_throughput.py [--clients 16] [--seconds 5] [--rounds 12] [--workers 2]
+
+Every client thread signs in with its own account and address in a loop while one more thread keeps
+fetching /about. This runs once with the hashes computed on the request threads and once with the
+PASSWORD_HASH_WORKERS process pool, against a throwaway SQLite file.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flaskblog import create_app, db  # noqa: E402
+from flaskblog.config import TestingConfig  # noqa: E402
+from flaskblog.passwords import passwords, hash_password  # noqa: E402
+
+
+def build_app(database, rounds, workers, clients):
+    class BenchConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + database
+        BCRYPT_LOG_ROUNDS = rounds
+        PASSWORD_HASH_WORKERS = workers
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        from flaskblog.models import Role, User
+        db.drop_all()
+        db.create_all()
+        Role.insert_roles()
+        pw_hash = hash_password('pw', rounds)
+        db.session.add_all(User(username = 'user%d' % n, email = 'user%d@example.com' % n, country = 'Kenya',
+                                confirmed = True, password = pw_hash) for n in range(clients))
+        db.session.commit()
+    return app
+
+
+def sign_in_loop(app, n, deadline, results):
+    client = app.test_client()
+    environ = {'REMOTE_ADDR': '10.0.0.%d' % (n + 1)}
+    data = dict(email = 'user%d@example.com' % n, password = 'pw')
+    while time.perf_counter() < deadline:
+        status = client.post('/login', data = data, environ_base = environ).status_code
+        results.append(status)
+        if status == 302:
+            client.get('/logout', environ_base = environ)
+
+
+def page_loop(app, deadline, latencies):
+    client = app.test_client()
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        assert client.get('/about').status_code == 200
+        latencies.append(time.perf_counter() - start)
+
+
+def measure(database, args, workers):
+    app = build_app(database, args.rounds, workers, args.clients)
+    if workers:
+        with app.app_context():  # start the worker processes before the clock runs
+            passwords.hash('warm up')
+    results, latencies = [], []
+    deadline = time.perf_counter() + args.seconds
+    threads = [threading.Thread(target = sign_in_loop, args = (app, n, deadline, results))
+               for n in range(args.clients)]
+    threads.append(threading.Thread(target = page_loop, args = (app, deadline, latencies)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with app.app_context():
+        passwords.pool.shutdown()
+    latencies.sort()
+    return dict(logins = results.count(302) / args.seconds, rejected = results.count(429),
+                p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0,
+                p95 = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type = int, default = 16)
+    parser.add_argument('--seconds', type = float, default = 5)
+    parser.add_argument('--rounds', type = int, default = 12)
+    parser.add_argument('--workers', type = int, default = 2)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'bench.db')
+        rows = [('request threads', measure(database, args, 0)),
+                ('{} worker process(es)'.format(args.workers), measure(database, args, args.workers))]
+    print('{:<24}{:>12}{:>12}{:>16}{:>16}'.format('hashing on', 'logins/s', 'rejected', '/about p50 ms',
+                                                  '/about p95 ms'))
+    for name, row in rows:
+        print('{:<24}{:>12.1f}{:>12}{:>16.1f}{:>16.1f}'.format(name, row['logins'], row['rejected'], row['p50'],
+                                                               row['p95']))
+
+
+if __name__ == '__main__':
+    main()
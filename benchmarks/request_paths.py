@@ -0,0 +1,356 @@
+"""
+Latency, SQL statements and allocations of the main pages against a seeded database.
+
+    python benchmarks/request_paths.py [--scale 10k|100k|1m] [--requests 200] [--output benchmark.json]
+                                       [--baseline old.json [--max-regression 0.2]]
+
+Builds the app with the testing config on a SQLite file, fills it with synthetic users, posts, tags
+and comments (``--scale``, or ``--posts``), then requests every page below through the test client.
+Each page reports latency percentiles, SQL statements per request and the peak memory a request
+allocates (measured in a separate tracemalloc pass, which is too slow to time). Seeding 1M posts takes
+a few minutes, ``--database PATH`` keeps the seeded file and reuses it on the next run.
+
+The results are written to ``--output``. With ``--baseline`` they are compared to an earlier results
+file: more SQL statements per request, or a p95 latency or peak allocation more than
+``--max-regression`` above the baseline, is reported and the script exits with status 1, so it can
+gate a deploy.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flaskblog import create_app, db  # noqa: E402
+from flaskblog.config import TestingConfig  # noqa: E402
+from flaskblog.passwords import hash_password  # noqa: E402
+from flaskblog.rendering import render_post, render_comment, plain_text  # noqa: E402
+
+SCALES = {'10k': 10000, '100k': 100000, '1m': 1000000}
+POSTS_PER_USER = 10
+TAG_COUNT = 50
+TAGS_PER_POST = 2
+PASSWORD = 'benchmark'
+MODERATOR = 'moderator'
+INSERT_CHUNK = 5000
+WORDS = ('python', 'flask', 'django', 'africa', 'nairobi', 'lagos', 'kigali', 'startup', 'database', 'sqlite',
+         'postgres', 'cache', 'deploy', 'docker', 'testing', 'mobile', 'payments', 'design', 'career', 'remote')
+SCENARIOS = ('home', 'post', 'user_profile', 'search_results', 'login', 'moderate')
+STARTED = datetime(2020, 1, 1)
+
+
+def build_app(database, cache, rounds):
+    class BenchConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + database
+        RESPONSE_CACHE_BACKEND = cache
+        BCRYPT_LOG_ROUNDS = rounds
+
+    return create_app(BenchConfig)
+
+
+# Seeding goes through Core executemany with the rendered columns filled in up front, the ORM and its
+# flush events would take hours at 1M posts. The counters and tag scores are then computed the usual way.
+
+def _templates(count):
+    """Post and comment bodies, rendered once and reused."""
+    rng = random.Random(0)
+    posts, comments = [], []
+    for n in range(count):
+        words = [rng.choice(WORDS) for _ in range(120)]
+        content = '<p>{}</p><p>{} <a href="https://example.com/{}">link</a></p>'.format(
+            ' '.join(words[:60]), ' '.join(words[60:]), n)
+        post = SimpleNamespace()
+        render_post(post, content)
+        posts.append(dict(content = content, content_html = post.content_html, excerpt = post.excerpt,
+                          render_version = post.render_version, text = plain_text(content)))
+        body = 'I like the part about **{}** and {}.'.format(rng.choice(WORDS), rng.choice(WORDS))
+        comment = SimpleNamespace()
+        render_comment(comment, body)
+        comments.append(dict(body = body, body_html = comment.body_html, render_version = comment.render_version))
+    return posts, comments
+
+
+def _insert(table, rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == INSERT_CHUNK:
+            db.session.execute(table.insert(), chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+
+
+def seed(posts, comments_per_post, rounds):
+    from flaskblog.counters import reconcile
+    from flaskblog.models import Comment, Post, Role, Tag, User, post_tag
+    from flaskblog.search import get_backend, init_index
+    from flaskblog.tags import rescore
+
+    db.create_all()
+    Role.insert_roles()
+    init_index()  # the deploy step, while there is nothing to index yet
+    backend = get_backend()
+    users = max(1, posts // POSTS_PER_USER)
+    pw_hash = hash_password(PASSWORD, rounds)
+    roles = {role.name: role.id for role in Role.query}
+    _insert(User.__table__, (dict(id = n + 1, username = 'user%d' % n, email = 'user%d@example.com' % n,
+                                  country = 'Kenya', password = pw_hash, confirmed = True, image_file = 'default.jpg',
+                                  member_since = STARTED, role_id = roles['User']) for n in range(users)))
+    db.session.execute(User.__table__.insert(), dict(id = users + 1, username = MODERATOR, country = 'Kenya',
+                                                     email = MODERATOR + '@example.com', password = pw_hash,
+                                                     confirmed = True, image_file = 'default.jpg',
+                                                     member_since = STARTED, role_id = roles['Moderator']))
+    tag_names = ['{}-{}'.format(WORDS[n % len(WORDS)], n) for n in range(TAG_COUNT)]
+    db.session.add_all(Tag(name = name) for name in tag_names)
+    db.session.flush()
+    tag_ids = [tag.id for tag in Tag.query.order_by(Tag.id)]
+
+    post_templates, comment_templates = _templates(50)
+    minutes = max(1, 3 * 365 * 24 * 60 // posts)  # spread over three years
+
+    def post_rows():
+        for n in range(posts):
+            template = post_templates[n % len(post_templates)]
+            yield dict(id = n + 1, title = 'Post {} about {} and {}'.format(n, WORDS[n % len(WORDS)],
+                                                                          WORDS[n * 7 % len(WORDS)]),
+                       date_posted = STARTED + timedelta(minutes = n * minutes), user_id = n % users + 1,
+                       comment_count = comments_per_post, content = template['content'],
+                       content_html = template['content_html'], excerpt = template['excerpt'],
+                       render_version = template['render_version'])
+
+    def comment_rows():
+        for n in range(posts):
+            for c in range(comments_per_post):
+                template = comment_templates[(n + c) % len(comment_templates)]
+                yield dict(post_id = n + 1, author_id = (n + c + 1) % users + 1,
+                           timestamp = STARTED + timedelta(minutes = n * minutes + c + 1),
+                           disabled = None if c % 3 else False, **template)
+
+    _insert(Post.__table__, post_rows())
+    _insert(post_tag, (dict(post_id = n + 1, tag_id = tag_ids[(n * 3 + k) % len(tag_ids)])
+                       for n in range(posts) for k in range(TAGS_PER_POST)))
+    _insert(Comment.__table__, comment_rows())
+
+    def documents():
+        for row in post_rows():
+            n = row['id'] - 1
+            tags = ' '.join(tag_names[(n * 3 + k) % len(tag_names)] for k in range(TAGS_PER_POST))
+            yield n + 1, dict(title = row['title'], tags = tags,
+                              content = post_templates[n % len(post_templates)]['text'])
+
+    if backend.name == 'sqlite':
+        _insert(db.table('post_search', *(db.column(name) for name in ('rowid', 'title', 'tags', 'content'))),
+                (dict(rowid = post_id, **document) for post_id, document in documents()))
+    else:
+        connection = db.session.connection()
+        for post_id, document in documents():
+            backend.index(connection, post_id, document)
+    db.session.commit()
+    reconcile()
+    rescore()
+    return users
+
+
+def _client(app, address):
+    client = app.test_client()
+    client.environ_base['REMOTE_ADDR'] = address
+    return client
+
+
+def _sign_in(client, username):
+    response = client.post('/login', data = dict(email = username + '@example.com', password = PASSWORD))
+    assert response.status_code == 302, 'could not sign in as ' + username
+
+
+def scenarios(app, posts, users, rng):
+    """``{name: (client, make_request)}``, make_request sends one request and returns its status."""
+    anonymous = _client(app, '10.0.0.1')
+    moderator = _client(app, '10.0.0.2')
+    _sign_in(moderator, MODERATOR)
+    signing_in = _client(app, '10.0.0.3')
+    pages = max(1, min(5, posts // app.config['FLASKY_POSTS_PER_PAGE']))
+
+    def home():
+        return anonymous.get('/?page=%d' % rng.randint(1, pages)).status_code
+
+    def post():
+        return anonymous.get('/post/%d' % rng.randint(1, posts)).status_code
+
+    def user_profile():
+        return anonymous.get('/user-profile/user%d' % rng.randrange(users)).status_code
+
+    def search_results():
+        return anonymous.get('/search_results/{} {}'.format(rng.choice(WORDS), rng.choice(WORDS))).status_code
+
+    def login():
+        username = 'user%d' % rng.randrange(users)
+        status = signing_in.post('/login', data = dict(email = username + '@example.com',
+                                                       password = PASSWORD)).status_code
+        signing_in.cookie_jar.clear()  # signed out without paying for a /logout request
+        return status
+
+    def moderate():
+        return moderator.get('/moderate?page=%d' % rng.randint(1, 3)).status_code
+
+    return dict(home = (home, 200), post = (post, 200), user_profile = (user_profile, 200),
+                search_results = (search_results, 200), login = (login, 302), moderate = (moderate, 200))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def measure(app, request, expected_status, requests, allocation_requests, warmup = 5):
+    statements = []
+    engine = db.get_engine(app)
+
+    def count(*args):
+        statements.append(1)
+
+    for _ in range(warmup):
+        request()
+    latencies = []
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        for _ in range(requests):
+            start = time.perf_counter()
+            status = request()
+            latencies.append(time.perf_counter() - start)
+            assert status == expected_status, 'got {}, expected {}'.format(status, expected_status)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(allocation_requests):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            request()
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+
+    return dict(requests = requests, mean_ms = sum(latencies) / len(latencies) * 1000,
+                p50_ms = percentile(latencies, 0.5) * 1000, p90_ms = percentile(latencies, 0.9) * 1000,
+                p95_ms = percentile(latencies, 0.95) * 1000, p99_ms = percentile(latencies, 0.99) * 1000,
+                queries = len(statements) / requests, alloc_peak_kb = percentile(peaks, 0.5) / 1024)
+
+
+def run(database, posts, comments_per_post = 2, requests = 200, allocation_requests = 20, cache = 'null',
+        rounds = TestingConfig.BCRYPT_LOG_ROUNDS, only = SCENARIOS):
+    """Seeds ``database`` unless it is already seeded and returns the results of every scenario."""
+    app = build_app(database, cache, rounds)
+    with app.app_context():
+        from flaskblog.counters import POSTS, USERS, get_counts
+        if db.engine.has_table('post'):
+            counts = get_counts(USERS, POSTS)
+            users, posts = counts[USERS] - 1, counts[POSTS]  # minus the moderator
+        else:
+            users = seed(posts, comments_per_post, rounds)
+    rng = random.Random(1)
+    results = {}
+    for name, (request, expected_status) in scenarios(app, posts, users, rng).items():
+        if name in only:
+            results[name] = measure(app, request, expected_status, requests, allocation_requests)
+    return dict(meta = environment(posts, users, comments_per_post, cache, rounds), results = results)
+
+
+def environment(posts, users, comments_per_post, cache, rounds):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True,
+                                cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return dict(date = datetime.utcnow().isoformat(timespec = 'seconds'), commit = commit, posts = posts,
+                users = users, comments_per_post = comments_per_post, cache = cache, bcrypt_rounds = rounds,
+                python = platform.python_version(), sqlite = sqlite3.sqlite_version)
+
+
+def compare(results, baseline, max_regression):
+    """Returns one message per regression of ``results`` against ``baseline``."""
+    regressions = []
+    for name, row in results['results'].items():
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        if row['queries'] > old['queries']:
+            regressions.append('{}: {:.1f} SQL statements per request, was {:.1f}'.format(
+                name, row['queries'], old['queries']))
+        for key, unit in (('p95_ms', 'ms p95'), ('alloc_peak_kb', 'KB allocated')):
+            if old[key] and row[key] > old[key] * (1 + max_regression):
+                regressions.append('{}: {:.1f} {}, was {:.1f} (+{:.0%})'.format(
+                    name, row[key], unit, old[key], row[key] / old[key] - 1))
+    return regressions
+
+
+def print_table(results, baseline = None):
+    print('{:<16}{:>10}{:>10}{:>10}{:>10}{:>10}{:>12}'.format('page', 'p50 ms', 'p95 ms', 'p99 ms', 'queries',
+                                                             'alloc KB', 'p95 change'))
+    for name, row in results['results'].items():
+        old = (baseline or {}).get('results', {}).get(name)
+        change = '{:+.0%}'.format(row['p95_ms'] / old['p95_ms'] - 1) if old and old['p95_ms'] else ''
+        print('{:<16}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.0f}{:>12}'.format(
+            name, row['p50_ms'], row['p95_ms'], row['p99_ms'], row['queries'], row['alloc_peak_kb'], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', choices = sorted(SCALES), default = '10k', help = 'number of posts')
+    parser.add_argument('--posts', type = int, help = 'number of posts, overrides --scale')
+    parser.add_argument('--comments', type = int, default = 2, help = 'comments per post')
+    parser.add_argument('--requests', type = int, default = 200, help = 'timed requests per page')
+    parser.add_argument('--allocation-requests', type = int, default = 20)
+    parser.add_argument('--only', nargs = '+', choices = SCENARIOS, default = SCENARIOS)
+    parser.add_argument('--cache', default = 'null', help = 'RESPONSE_CACHE_BACKEND, null measures every view')
+    parser.add_argument('--rounds', type = int, default = TestingConfig.BCRYPT_LOG_ROUNDS, help = 'bcrypt cost')
+    parser.add_argument('--database', help = 'SQLite file to seed and keep, reused when it exists')
+    parser.add_argument('--output', default = 'benchmark.json')
+    parser.add_argument('--baseline', help = 'results file to compare with')
+    parser.add_argument('--max-regression', type = float, default = 0.2,
+                        help = 'allowed p95 and allocation growth over the baseline, 0.2 = 20%%')
+    args = parser.parse_args()
+    posts = args.posts or SCALES[args.scale]
+
+    options = dict(comments_per_post = args.comments, requests = args.requests, cache = args.cache,
+                   allocation_requests = args.allocation_requests, rounds = args.rounds, only = args.only)
+    if args.database:
+        results = run(os.path.abspath(args.database), posts, **options)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            results = run(os.path.join(directory, 'bench.db'), posts, **options)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent = 1, sort_keys = True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_table(results, baseline)
+    print('Results written to {}'.format(args.output))
+    if baseline:
+        if baseline['meta'].get('posts') != results['meta']['posts']:
+            print('Warning: the baseline was measured with {} posts'.format(baseline['meta'].get('posts')))
+        regressions = compare(results, baseline, args.max_regression)
+        for message in regressions:
+            print('REGRESSION ' + message)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Cold start cost: importing flaskblog and creating the app in a fresh interpreter.
+
+    python benchmarks/startup_time.py [--runs 5] [--budget-ms 600] [--top 15] [--output startup.json]
+
+Every run starts ``python -X importtime`` and times ``create_app('testing')``. The median wall time is
+reported with the import time of each top level package (its modules' own time, summed). The script
+exits with status 1 when the median is over ``--budget-ms`` or when a module that should only load on
+demand (``--forbid``: Flask-Admin, Alembic, Flask-Migrate and Flask-Moment by default) was imported at
+start up, so it can gate a deploy.
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FORBIDDEN = ('flask_admin', 'alembic', 'flask_migrate', 'flask_moment')
+IMPORT_LINE_RE = re.compile(r'^import time:\s+(\d+) \|\s+\d+ \| *(\S+)$')
+PROGRAM = '''
+import json, sys, time
+start = time.perf_counter()
+from flaskblog import create_app
+create_app('testing')
+print(json.dumps([(time.perf_counter() - start) * 1000, sorted(sys.modules)]))
+'''
+
+
+def measure_once():
+    environment = dict(os.environ, FLASKBLOG_CONFIG_FILE = os.devnull)
+    environment.pop('FLASK_RUN_FROM_CLI', None)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROGRAM], cwd = ROOT,
+                            env = environment, capture_output = True, text = True, check = True)
+    elapsed, modules = json.loads(result.stdout.strip().splitlines()[-1])
+    imports = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE_RE.match(line)
+        if match:
+            package = match.group(2).split('.')[0]
+            imports[package] = imports.get(package, 0.0) + int(match.group(1)) / 1000.0  # self time, in ms
+    return elapsed, imports, modules
+
+
+def measure(runs):
+    times, imports, modules = [], {}, set()
+    for _ in range(runs):
+        elapsed, run_imports, run_modules = measure_once()
+        times.append(elapsed)
+        for name, ms in run_imports.items():
+            imports.setdefault(name, []).append(ms)
+        modules.update(run_modules)
+    return dict(median_ms = statistics.median(times), min_ms = min(times), max_ms = max(times),
+                imports = {name: statistics.median(values) for name, values in imports.items()},
+                modules = sorted(modules))
+
+
+def forbidden_imports(modules, forbidden):
+    return sorted(name for name in modules if name.split('.')[0] in forbidden)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type = int, default = 5)
+    parser.add_argument('--budget-ms', type = float, default = 600)
+    parser.add_argument('--top', type = int, default = 15, help = 'slowest packages to list')
+    parser.add_argument('--forbid', nargs = '*', default = FORBIDDEN, help = 'packages not to import at start up')
+    parser.add_argument('--output', help = 'write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = measure(args.runs)
+    print('create_app cold start: median {:.0f} ms (min {:.0f}, max {:.0f}), budget {:.0f} ms'.format(
+        results['median_ms'], results['min_ms'], results['max_ms'], args.budget_ms))
+    print('\nImport time by package (ms):')
+    for name, ms in sorted(results['imports'].items(), key = lambda item: -item[1])[:args.top]:
+        print('{:>9.1f}  {}'.format(ms, name))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(results, budget_ms = args.budget_ms), f, indent = 1, sort_keys = True)
+
+    failures = []
+    if results['median_ms'] > args.budget_ms:
+        failures.append('median start up {:.0f} ms is over the {:.0f} ms budget'.format(results['median_ms'],
+                                                                                     args.budget_ms))
+    loaded = forbidden_imports(results['modules'], args.forbid)
+    if loaded:
+        failures.append('imported at start up: ' + ', '.join(loaded))
+    for failure in failures:
+        print('FAIL ' + failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,57 +1,107 @@
-from flask import Flask
+import os
+
+from flask import Flask, current_app
 from flask_bcrypt import Bcrypt
 from flask_bootstrap import Bootstrap
 from flask_ckeditor import CKEditor
 from flask_login import LoginManager
 from flask_mail import Mail
-from flask_migrate import Migrate
-from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from flaskblog.config import config
+from flaskblog.database import SQLAlchemy
+from flaskblog.geolocation import GeoLocator
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    # the full text search tables are created by `flask search init` (flaskblog/search.py), keep autogenerate off them
+    return not (type_ == 'table' and reflected and compare_to is None and name.startswith('post_search'))
+
+
+class Moment(object):
+    """Flask-Moment's ``moment`` template global, imported on the first render (its distutils import is slow)."""
+
+    def init_app(self, app):
+        app.context_processor(self.context_processor)
 
-from flaskblog.config import ProductionConfig
+    @staticmethod
+    def context_processor():
+        if 'moment' not in current_app.extensions:
+            from flask_moment import _moment
+            current_app.extensions['moment'] = _moment
+        return {'moment': current_app.extensions['moment']}
 
-db = SQLAlchemy()  # new instance of a database
-migrate = Migrate()  # migrate tracks db changes just like git
+
+db = SQLAlchemy()  # new instance of a database, with read replica routing (flaskblog/database.py)
 bcrypt = Bcrypt()  # new instance of bcrypt encryption for password on register
 login_manager = LoginManager()  # new instance of LoginManager lib for handling user login sessions
-login_manager.session_protection = 'strong'
+login_manager.session_protection = None  # 'strong' protection is done by flaskblog.auth.SessionGuard
 login_manager.login_view = 'users.login'  # telling the extension where the login view is
 login_manager.login_message_category = 'info'
 mail = Mail()
 ckeditor = CKEditor()
 bootstrap = Bootstrap()
 moment = Moment()  # for formatting dates
+geolocator = GeoLocator()  # cached, non-blocking IP geolocation
 
 
-# admin = Admin(name = 'Afri Devs Forum', template_mode = 'bootstrap3')
-
-
-def create_app():
+def create_app(config_name = None):
+    """
+    ``config_name`` is a key of ``flaskblog.config.config`` or a config class, by default the
+    FLASK_CONFIG environment variable or 'default' (production).
+    """
+    config_class = config_name or os.environ.get('FLASK_CONFIG', 'default')
+    if isinstance(config_class, str):
+        config_class = config[config_class]
     app = Flask(__name__)
     with app.app_context():
-        # TODO : Change config class to Production for deployment
-        app.config.from_object(ProductionConfig)
+        app.config.from_object(config_class)
+        config_class.init_app(app)
+        if app.config.get('TRUSTED_PROXIES'):
+            # X-Forwarded-For/-Proto are only believed as far as the proxies we run, the rest comes from clients
+            hops = app.config['TRUSTED_PROXIES']
+            app.wsgi_app = ProxyFix(app.wsgi_app, x_for = hops, x_proto = hops)
         initialize_extensions(app)
         register_blueprints(app)
+        register_commands(app)
     return app
 
 
 def initialize_extensions(app):
-    # admin.init_app(app)
     db.init_app(app)
-    migrate.init_app(app, db)
+    if os.environ.get('FLASK_RUN_FROM_CLI'):  # only `flask db ...` needs alembic, it is slow to import
+        from flask_migrate import Migrate
+        Migrate(app, db, include_object = include_object)  # migrate tracks db changes just like git
     bcrypt.init_app(app)
     login_manager.init_app(app)
     mail.init_app(app)
     ckeditor.init_app(app)
     bootstrap.init_app(app)
     moment.init_app(app)
+    geolocator.init_app(app)
+    from flaskblog.auth import session_guard
+    session_guard.init_app(app, login_manager)
 
-    from flaskblog.models import User
-
-    @login_manager.user_loader
-    def load_user(user_id):
-        return User.query.filter(User.id == int(user_id)).first()
+    import flaskblog.models  # registers the user loader
+    import flaskblog.counters  # registers the counter maintenance events
+    import flaskblog.search  # registers the search index sync events
+    import flaskblog.tags  # registers the tag popularity events
+    from flaskblog.caching import response_cache
+    response_cache.init_app(app)
+    from flaskblog.outbox import outbox
+    outbox.init_app(app)
+    from flaskblog.subscriptions import subscriptions
+    subscriptions.init_app(app)
+    from flaskblog.passwords import passwords
+    passwords.init_app(app)
+    from flaskblog.avatars import avatars
+    avatars.init_app(app)
+    from flaskblog.assets import assets
+    assets.init_app(app)
+    from flaskblog.metrics import metrics
+    metrics.init_app(app)
+    from flaskblog.perf import slow_queries
+    slow_queries.init_app(app)
 
 
 def register_blueprints(app):
@@ -59,8 +109,34 @@ def register_blueprints(app):
     from flaskblog.posts.routes import posts
     from flaskblog.main.routes import main
     from flaskblog.error_handler.handlers import errors
+    from flaskblog.admin import admin_loader
 
     app.register_blueprint(users)  # users is the Blueprint variable
     app.register_blueprint(posts)  # posts is the Blueprint variable
     app.register_blueprint(main)  # main is the Blueprint variable
     app.register_blueprint(errors)
+    app.register_blueprint(admin_loader)  # Flask-Admin is set up on the first visit to /admin/
+
+
+def register_commands(app):
+    from flaskblog.assets import assets_cli
+    from flaskblog.avatars import avatars_cli
+    from flaskblog.counters import counters_cli
+    from flaskblog.countries import countries_cli
+    from flaskblog.outbox import outbox_cli
+    from flaskblog.perf import perf_cli
+    from flaskblog.rendering import content_cli
+    from flaskblog.search import search_cli
+    from flaskblog.subscriptions import subscriptions_cli
+    from flaskblog.tags import tags_cli
+
+    app.cli.add_command(counters_cli)  # flask counters reconcile
+    app.cli.add_command(countries_cli)  # flask countries refresh
+    app.cli.add_command(search_cli)  # flask search init, flask search reindex
+    app.cli.add_command(outbox_cli)  # flask outbox worker
+    app.cli.add_command(subscriptions_cli)  # flask subscriptions worker
+    app.cli.add_command(content_cli)  # flask content rerender
+    app.cli.add_command(tags_cli)  # flask tags rescore
+    app.cli.add_command(avatars_cli)  # flask avatars worker / gc
+    app.cli.add_command(assets_cli)  # flask assets build
+    app.cli.add_command(perf_cli)  # flask perf advise
@@ -0,0 +1,111 @@
+"""
+The Flask-Admin site at /admin/, set up on first use.
+
+Importing Flask-Admin and building its model views is a noticeable part of a worker's start up, and
+most workers never serve /admin/. At start up only the ``admin_loader`` blueprint is registered, its
+catch-all /admin/ routes are limited to administrators. The first time one of them is hit the real
+views are built, their routes are staged on a scratch app and merged into a copy of the URL map that
+then replaces the app's map in one assignment, so requests running at the same time never see a half
+updated map. The request is then redirected to the same URL, which the admin views now answer.
+
+This writes to Flask's private state (``_blueprint_order``, ``blueprints``, ``view_functions``) and rebuilds
+the map with Werkzeug 1.0's ``Map`` arguments, so it is pinned to the versions in ``MERGE_TESTED_WITH``:
+with any other Flask or Werkzeug the install raises instead of leaving the app half set up, and the
+tests fail until the merge has been checked again. One lock serializes installs, so two requests can
+never interleave them.
+"""
+import threading
+
+import flask
+import werkzeug
+from flask import Blueprint, Flask, abort, current_app, redirect, request
+from flask_login import current_user
+
+from flaskblog import db
+from flaskblog.decorators import admin_required
+from flaskblog.models import Comment, Permission, Post, Role, Tag, User
+
+admin_loader = Blueprint('admin_loader', __name__, url_prefix = '/admin')
+
+_lock = threading.Lock()
+
+# versions the merge in install_admin has been checked against, as (module, version prefix)
+MERGE_TESTED_WITH = ((flask, '1.1.'), (werkzeug, '1.0.'))
+
+
+def check_versions():
+    for module, prefix in MERGE_TESTED_WITH:
+        if not module.__version__.startswith(prefix):
+            raise RuntimeError('flaskblog.admin merges its routes into the app by hand and has only been checked '
+                               'with {} {}x, not {}'.format(module.__name__, prefix, module.__version__))
+
+
+def build_admin():
+    from flask_admin import Admin, AdminIndexView, expose
+    from flask_admin.contrib.sqla import ModelView
+
+    def is_administrator():
+        return current_user.is_authenticated and current_user.can(Permission.ADMINISTRATOR)
+
+    class AdminHome(AdminIndexView):
+        @expose('/')
+        def index(self):
+            if is_administrator():
+                return self.render('admin/index.html')
+            else:
+                return self.render('errors/403.html')
+
+    class AdminModelView(ModelView):
+        def is_accessible(self):
+            return is_administrator()
+
+        def inaccessible_callback(self, name, **kwargs):
+            abort(403)
+
+    admin = Admin(name = 'Afri Devs Forum', template_mode = 'bootstrap3', index_view = AdminHome())
+    for model in (User, Post, Tag, Comment, Role):
+        admin.add_view(AdminModelView(model, db.session))
+    return admin
+
+
+def _copy_map(url_map, rules):
+    new_map = url_map.__class__(
+        [rule.empty() for rule in rules], default_subdomain = url_map.default_subdomain, charset = url_map.charset,
+        strict_slashes = url_map.strict_slashes, merge_slashes = url_map.merge_slashes,
+        redirect_defaults = url_map.redirect_defaults, converters = url_map.converters,
+        sort_parameters = url_map.sort_parameters, sort_key = url_map.sort_key,
+        encoding_errors = url_map.encoding_errors, host_matching = url_map.host_matching)
+    new_map.update()  # sorted now rather than by the first request to bind it
+    return new_map
+
+
+def install_admin(app):
+    """Adds the admin views to ``app`` unless they are there already, returns the Admin."""
+    with _lock:
+        if app.extensions.get('admin'):
+            return app.extensions['admin'][0]
+        check_versions()
+        admin = build_admin()
+        staging = Flask(app.import_name)
+        admin.init_app(staging)
+        staged = {name: blueprint for name, blueprint in staging.blueprints.items()}
+        rules = [rule for rule in app.url_map.iter_rules() if not rule.endpoint.startswith('admin_loader.')]
+        rules += [rule for rule in staging.url_map.iter_rules() if rule.endpoint != 'static']
+        new_map = _copy_map(app.url_map, rules)
+
+        app.view_functions.update((endpoint, view) for endpoint, view in staging.view_functions.items()
+                                  if endpoint != 'static')
+        app.blueprints.update(staged)
+        app._blueprint_order.extend(staged.values())
+        admin.app = app
+        app.extensions['admin'] = [admin]
+        app.url_map = new_map
+        return admin
+
+
+@admin_loader.route('/', defaults = {'path': ''}, methods = ['GET', 'POST'])
+@admin_loader.route('/<path:path>', methods = ['GET', 'POST'])
+@admin_required
+def load(path):
+    install_admin(current_app._get_current_object())
+    return redirect(request.full_path if request.query_string else request.path, 307)
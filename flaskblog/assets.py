@@ -0,0 +1,230 @@
+"""
+Fingerprinted static files.
+
+``flask assets build`` copies the stylesheets, scripts and site pictures from ``static/`` into
+``static/dist/``. Along the way it compiles the SCSS sources (needs libsass), minifies CSS (and JS when
+rjsmin is installed), drops the unminified twins of ``.min`` files, and recompresses PNGs without loss.
+Every output is named after its content (``css/main.3f2a91c07d.css``) and gets ``.gz`` and, when the
+brotli module is installed, ``.br`` siblings. ``static/dist/manifest.json`` maps the source names to
+the built ones.
+
+When the manifest exists, ``url_for('static', filename = 'css/main.css')`` links the built file. It is
+served precompressed when the browser accepts it, with ``Cache-Control: immutable`` and a year of
+max-age, so repeat visits download nothing. Without a build the static files are served as before.
+"""
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import re
+import tempfile
+
+import click
+from PIL import Image
+from flask import current_app, request, send_from_directory
+from flask.cli import AppGroup
+
+assets_cli = AppGroup('assets', help = 'Build the fingerprinted static files.')
+
+ASSET_DIRS = ('css', 'js', 'site_pics', 'scss')
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt')
+IMMUTABLE = 'public, max-age={}, immutable'
+
+CSS_MINIFY_RE = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|/\*(?!!)[\s\S]*?\*/|\s*([{};,>])\s*|(\s+)''')
+
+
+def minify_css(css):
+    """Drops comments (except /*! ... */) and the whitespace around punctuation, strings are kept as is."""
+
+    def replace(match):
+        if match.group(1):
+            return match.group(1)
+        if match.group(2):
+            return match.group(2)
+        return ' ' if match.group(3) else ''
+
+    return CSS_MINIFY_RE.sub(replace, css).strip()
+
+
+def minify_js(js):
+    try:
+        import rjsmin
+    except ImportError:  # optional, gzip and brotli do most of the work anyway
+        return js
+    return rjsmin.jsmin(js)
+
+
+def compile_scss(path):
+    """The compressed CSS of an SCSS file, None when libsass is not installed."""
+    try:
+        import sass
+    except ImportError:
+        return None
+    return sass.compile(filename = path, output_style = 'compressed')
+
+
+def optimize_png(data):
+    output = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as image:
+        image.save(output, 'PNG', optimize = True)
+    return min(data, output.getvalue(), key = len)
+
+
+def _sources(static_folder):
+    """Yields ``(source name, path)`` of every file to build."""
+    for directory in ASSET_DIRS:
+        for root, dirs, files in os.walk(os.path.join(static_folder, directory)):
+            for filename in sorted(files):
+                stem, ext = os.path.splitext(filename)
+                if filename.startswith(('.', '_')) or os.path.exists(os.path.join(root, stem + '.min' + ext)):
+                    continue  # hidden files, SCSS partials and the sources of .min files
+                path = os.path.join(root, filename)
+                yield os.path.relpath(path, static_folder).replace(os.sep, '/'), path
+
+
+def _process(name, path):
+    """Returns ``(built name, content)`` for one source file, content is None when it cannot be built here."""
+    stem, ext = os.path.splitext(name)
+    if ext == '.scss':
+        css = compile_scss(path)
+        return 'css/{}.css'.format(os.path.basename(stem)), css.encode('utf-8') if css is not None else None
+    with open(path, 'rb') as f:
+        data = f.read()
+    minified = stem.endswith('.min')
+    if ext == '.css' and not minified:
+        data = minify_css(data.decode('utf-8')).encode('utf-8')
+    elif ext == '.js' and not minified:
+        data = minify_js(data.decode('utf-8')).encode('utf-8')
+    elif ext == '.png':
+        data = optimize_png(data)
+    return name, data
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path), suffix = '.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _compressed_variants(data):
+    yield '.gz', gzip.compress(data, 9, mtime = 0)
+    try:
+        import brotli
+    except ImportError:
+        return
+    yield '.br', brotli.compress(data)
+
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def build_assets(static_folder):
+    """
+    Builds ``static/dist`` and its manifest, returns the manifest. Files of the previous build are kept
+    so pages rendered before a deploy still load, older ones are deleted.
+    """
+    dist = os.path.join(static_folder, DIST_DIR)
+    previous = load_manifest(static_folder)
+    manifest = {}
+    for name, path in _sources(static_folder):
+        built_name, data = _process(name, path)
+        if data is None:
+            click.echo('Skipping {}, compiling SCSS needs libsass (pip install libsass)'.format(name), err = True)
+            continue
+        stem, ext = os.path.splitext(built_name)
+        fingerprinted = '{}/{}.{}{}'.format(DIST_DIR, stem, hashlib.sha256(data).hexdigest()[:10], ext)
+        manifest[built_name] = fingerprinted
+        target = os.path.join(static_folder, fingerprinted)
+        if os.path.exists(target):
+            continue
+        _write_atomic(target, data)
+        if ext in COMPRESSIBLE:
+            for suffix, compressed in _compressed_variants(data):
+                if len(compressed) < len(data):
+                    _write_atomic(target + suffix, compressed)
+    _write_atomic(os.path.join(dist, MANIFEST), json.dumps(manifest, indent = 1, sort_keys = True).encode('utf-8'))
+
+    keep = {os.path.join(dist, MANIFEST)}
+    for path in list(manifest.values()) + list(previous.values()):
+        keep.update(os.path.join(static_folder, path) + suffix for suffix in ('', '.gz', '.br'))
+    for root, dirs, files in os.walk(dist):
+        for filename in files:
+            if os.path.join(root, filename) not in keep:
+                os.unlink(os.path.join(root, filename))
+    return manifest
+
+
+class StaticAssets(object):
+    """Links and serves the built files, see the module docstring."""
+
+    def __init__(self, app = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ASSETS_MAX_AGE', 365 * 24 * 60 * 60)
+        self.load(app)
+        app.url_defaults(self.link_built_file)
+        app.view_functions['static'] = self.send_static_file
+
+    @staticmethod
+    def load(app):
+        manifest = load_manifest(app.static_folder)
+        app.extensions['assets'] = dict(manifest = manifest, built = frozenset(manifest.values()))
+        return app.extensions['assets']
+
+    @staticmethod
+    def link_built_file(endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            manifest = current_app.extensions['assets']['manifest']
+            values['filename'] = manifest.get(values['filename'], values['filename'])
+
+    @staticmethod
+    def send_static_file(filename):
+        app = current_app._get_current_object()
+        if filename not in app.extensions['assets']['built']:
+            return app.send_static_file(filename)
+        mimetype = mimetypes.guess_type(filename)[0]
+        encoding = None
+        compressible = filename.endswith(COMPRESSIBLE)
+        if compressible:
+            for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+                path = os.path.join(app.static_folder, filename + suffix)
+                if request.accept_encodings[candidate] and os.path.isfile(path):
+                    encoding, filename = candidate, filename + suffix
+                    break
+        response = send_from_directory(app.static_folder, filename, mimetype = mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if compressible:
+            response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = IMMUTABLE.format(app.config['ASSETS_MAX_AGE'])
+        return response
+
+
+assets = StaticAssets()
+
+
+@assets_cli.command('build')
+def build_command():
+    """Compile, minify, fingerprint and precompress the static files into static/dist."""
+    app = current_app._get_current_object()
+    manifest = build_assets(app.static_folder)
+    assets.load(app)
+    size = sum(os.path.getsize(os.path.join(app.static_folder, path)) for path in manifest.values())
+    click.echo('Built {} file(s), {:.0f} KB.'.format(len(manifest), size / 1024.0))
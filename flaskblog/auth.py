@@ -0,0 +1,107 @@
+import time
+from functools import lru_cache
+from hashlib import sha512
+
+from flask import request, session, redirect, url_for, current_app
+from flask_login import current_user, session_protected, user_logged_in, user_loaded_from_cookie
+from flask_login.config import SESSION_KEYS
+
+AUTH_STAMP_KEY = '_auth'  # [confirmed, checked at] of the signed in user
+
+
+@lru_cache(maxsize = 4096)
+def _identifier(remote_addr, user_agent):
+    # same value as flask_login.utils._create_identifier, so sessions survive the switch: flask-login 0.5
+    # formats both as bytes, the hash is taken over "b'1.2.3.4'|b'agent'"
+    if remote_addr is not None:
+        remote_addr = remote_addr.encode('utf-8')
+    if user_agent is not None:
+        user_agent = user_agent.encode('utf-8')
+    return sha512('{0}|{1}'.format(remote_addr, user_agent).encode('utf8')).hexdigest()
+
+
+def client_address():
+    """
+    The address the request came from. Behind ``TRUSTED_PROXIES`` reverse proxies it is the one the
+    outermost of them saw, X-Forwarded-For entries added by the client itself are never used.
+    """
+    return request.remote_addr
+
+
+def session_identifier():
+    """
+    Hash of the client address and user agent, computed once per distinct client. The address is the
+    one flask-login 0.5 used, the first X-Forwarded-For entry, so sessions it made stay valid. It only
+    ties a session to its client, limits use ``client_address()``.
+    """
+    forwarded = request.headers.get('X-Forwarded-For', request.remote_addr)
+    address = forwarded.split(',')[0].strip() if forwarded is not None else None
+    return _identifier(address, request.headers.get('User-Agent'))
+
+
+class SessionGuard(object):
+    """
+    Stands in for flask-login's 'strong' session protection and the "confirmed accounts only" check.
+
+    Both used to run on every request and the second needed the user row. Here the session identifier
+    is only compared when the session holds a signed in user, static files are skipped entirely, and
+    the user's ``confirmed`` flag rides along in the signed session cookie. The database is only asked
+    again once that stamp is older than ``AUTH_STAMP_MAX_AGE`` seconds.
+    """
+    public_endpoints = {'static'}
+
+    def __init__(self, app = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, login_manager = None):
+        app.config.setdefault('AUTH_STAMP_MAX_AGE', 300)
+        if login_manager is not None:
+            login_manager._session_identifier_generator = session_identifier
+        app.before_request(self.check_request)
+        user_logged_in.connect_via(app)(self._logged_in)
+        user_loaded_from_cookie.connect_via(app)(self._loaded_from_cookie)
+        app.extensions['session_guard'] = self
+
+    @staticmethod
+    def stamp(user):
+        """Records ``user``'s current state in the session, call after changing ``confirmed``."""
+        value = [bool(user.confirmed), int(time.time())]
+        session[AUTH_STAMP_KEY] = value
+        return value
+
+    def _logged_in(self, app, user):
+        self.stamp(user)
+
+    def _loaded_from_cookie(self, app, user):
+        session['_id'] = session_identifier()
+        self.stamp(user)
+
+    def check_request(self):
+        if request.endpoint is None or request.endpoint in self.public_endpoints or '_user_id' not in session:
+            return
+        if session.get('_id') != session_identifier():
+            # another client presenting this cookie, handled the way flask-login's 'strong' mode does:
+            # a permanent session is only marked as not fresh, any other is signed out
+            session_protected.send(current_app._get_current_object())
+            if session.permanent:
+                session['_fresh'] = False
+                return self.check_confirmed()
+            for key in SESSION_KEYS:
+                session.pop(key, None)
+            session.pop(AUTH_STAMP_KEY, None)
+            session['_remember'] = 'clear'
+            return
+        return self.check_confirmed()
+
+    def check_confirmed(self):
+        stamp = session.get(AUTH_STAMP_KEY)
+        if not stamp or time.time() - stamp[1] > current_app.config['AUTH_STAMP_MAX_AGE']:
+            if not current_user.is_authenticated:
+                return
+            stamp = self.stamp(current_user)
+        if not stamp[0] and request.blueprint != 'users':
+            return redirect(url_for('users.unconfirmed'))
+
+
+session_guard = SessionGuard()
@@ -0,0 +1,336 @@
+"""
+Profile picture processing.
+
+The upload request only checks the file: its size in bytes, and its format and pixel count from the
+image header, before anything is decoded. The bytes are then stored under their SHA-256 in
+``AVATAR_UPLOAD_DIR`` and an ``avatar_job`` row is queued. Worker threads (``AVATAR_WORKERS``, started
+on the first upload) decode the picture, reduced by the JPEG decoder itself where possible, and write a
+square JPEG or PNG plus a WebP copy of it at every size in ``AVATAR_SIZES``. The files are named after
+the upload's digest, so a URL always points at the same bytes and can be cached forever. A job whose
+worker died is picked up again once its ``AVATAR_LEASE`` runs out. The files written so far are reused.
+
+``flask avatars gc`` deletes the pictures and uploads nobody refers to any more.
+"""
+import hashlib
+import io
+import logging
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+from PIL import Image, ImageOps, UnidentifiedImageError
+from flask import current_app, url_for
+from flask.cli import AppGroup
+
+from flaskblog import db
+from flaskblog.models import AvatarJob, User
+
+logger = logging.getLogger(__name__)
+
+avatars_cli = AppGroup('avatars', help = 'Process uploaded profile pictures and clean up old ones.')
+
+AVATAR_SIZES = (32, 64, 125, 256)
+DEFAULT_AVATAR = 'default.jpg'
+PIPELINE_VERSION = '1'  # part of the file names, bump it when the output changes
+UPLOAD_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+AVATAR_RE = re.compile(r'^([0-9a-f]{16})-(\d+)\.(jpg|png|webp)$')
+UPLOAD_RE = re.compile(r'^[0-9a-f]{64}\.\w+$')
+
+
+class InvalidAvatar(ValueError):
+    """The upload is not a picture we accept, the message is shown to the user."""
+
+
+def inspect_upload(stream, max_bytes, max_pixels):
+    """Returns ``(data, extension)`` of an acceptable upload, only the image header is parsed."""
+    data = stream.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        raise InvalidAvatar('Pictures can be at most {} MB.'.format(max_bytes // (1024 * 1024)))
+    too_big = InvalidAvatar('That picture is too big, please upload one under {} megapixels.'
+                            .format(max_pixels // 1000000))
+    try:
+        image = Image.open(io.BytesIO(data))  # lazy, reads the size and format only
+    except (Image.DecompressionBombError, Image.DecompressionBombWarning):
+        raise too_big  # a small file claiming a huge canvas, the warning when it is made an error
+    except (UnidentifiedImageError, OSError):
+        raise InvalidAvatar('That file is not a picture we can read.')
+    if image.format not in UPLOAD_FORMATS:
+        raise InvalidAvatar('Please upload a JPEG, PNG, GIF or WebP picture.')
+    width, height = image.size
+    if width * height > max_pixels:
+        raise too_big
+    return data, UPLOAD_FORMATS[image.format]
+
+
+def avatar_name(upload):
+    """The content address of the pictures made from ``upload``."""
+    digest = upload.split('.')[0]
+    return hashlib.sha256((digest + PIPELINE_VERSION).encode('ascii')).hexdigest()[:16]
+
+
+def avatar_url(image_file, size = 125, format = None):
+    """
+    URL of the smallest stored variant of ``image_file`` at least ``size`` pixels wide. ``format = 'webp'``
+    returns None for pictures uploaded before the pipeline, which only exist in one size.
+    """
+    match = AVATAR_RE.match(image_file or '')
+    if match is None:
+        if format == 'webp':
+            return None
+        filename = image_file or DEFAULT_AVATAR
+    else:
+        size = next((s for s in AVATAR_SIZES if s >= size), AVATAR_SIZES[-1])
+        filename = '{}-{}.{}'.format(match.group(1), size, format or match.group(3))
+    return url_for('static', filename = 'profile_pics/' + filename)
+
+
+def _write_atomic(directory, filename, write):
+    fd, tmp = tempfile.mkstemp(dir = directory, suffix = '.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp, os.path.join(directory, filename))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def render_avatars(source, directory, name):
+    """Writes every size of ``source`` in its own format and WebP, returns the default image file name."""
+    image = Image.open(source)
+    if image.format == 'JPEG':
+        # let the decoder scale down by up to 8x while keeping at least the largest size
+        image.draft('RGB', (AVATAR_SIZES[-1], AVATAR_SIZES[-1]))
+    image = ImageOps.exif_transpose(image)
+    alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    image = image.convert('RGBA' if alpha else 'RGB')
+    extension = 'png' if alpha else 'jpg'
+    for size in AVATAR_SIZES:
+        thumbnail = None
+        for filename, options in (('{}-{}.{}'.format(name, size, extension),
+                                   dict(format = 'PNG', optimize = True) if alpha else
+                                   dict(format = 'JPEG', quality = 85, optimize = True, progressive = True)),
+                                  ('{}-{}.webp'.format(name, size), dict(format = 'WEBP', quality = 80))):
+            if os.path.exists(os.path.join(directory, filename)):  # done by an earlier attempt
+                continue
+            if thumbnail is None:
+                thumbnail = ImageOps.fit(image, (size, size), Image.LANCZOS)
+            _write_atomic(directory, filename, lambda f: thumbnail.save(f, **options))
+    return '{}-{}.{}'.format(name, 125, extension)
+
+
+class AvatarProcessor(object):
+    """Queue and workers of the avatar pipeline, see the module docstring."""
+
+    def __init__(self, app = None):
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('AVATAR_WORKERS', 1)
+        app.config.setdefault('AVATAR_MAX_BYTES', 5 * 1024 * 1024)
+        app.config.setdefault('AVATAR_MAX_PIXELS', 40000000)
+        app.config.setdefault('AVATAR_DIR', None)  # defaults to static/profile_pics
+        app.config.setdefault('AVATAR_UPLOAD_DIR', None)  # defaults to <instance>/avatar_uploads
+        app.config.setdefault('AVATAR_BATCH_SIZE', 4)
+        app.config.setdefault('AVATAR_MAX_ATTEMPTS', 3)
+        app.config.setdefault('AVATAR_RETRY_DELAY', 30)  # seconds, doubled after every failure
+        app.config.setdefault('AVATAR_POLL_INTERVAL', 30)
+        app.config.setdefault('AVATAR_LEASE', 120)  # a claimed job is retried if not done by then
+        app.config.setdefault('AVATAR_GC_GRACE', 24 * 60 * 60)  # seconds an unused file is kept
+        app.add_template_global(avatar_url)
+        app.extensions['avatars'] = self
+
+    @property
+    def directory(self):
+        return current_app.config['AVATAR_DIR'] or os.path.join(current_app.root_path, 'static', 'profile_pics')
+
+    @property
+    def upload_directory(self):
+        directory = current_app.config['AVATAR_UPLOAD_DIR'] or os.path.join(current_app.instance_path,
+                                                                            'avatar_uploads')
+        os.makedirs(directory, exist_ok = True)
+        return directory
+
+    def check(self, stream):
+        """Raises InvalidAvatar for an unacceptable upload, leaves ``stream`` at its start."""
+        config = current_app.config
+        try:
+            return inspect_upload(stream, config['AVATAR_MAX_BYTES'], config['AVATAR_MAX_PIXELS'])
+        finally:
+            stream.seek(0)
+
+    def submit(self, user, file_storage):
+        """Stores the upload and queues it for ``user``, commits the current session."""
+        data, extension = self.check(file_storage.stream)
+        upload = '{}.{}'.format(hashlib.sha256(data).hexdigest(), extension)
+        if not os.path.exists(os.path.join(self.upload_directory, upload)):
+            _write_atomic(self.upload_directory, upload, lambda f: f.write(data))
+        job = AvatarJob(user = user, upload = upload)
+        db.session.add(job)
+        db.session.commit()
+        if current_app.config['AVATAR_WORKERS']:
+            self.start_workers(current_app._get_current_object(), current_app.config['AVATAR_WORKERS'])
+            self._wakeup.set()
+        return job
+
+    def start_workers(self, app, count):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            for i in range(len(self._threads), count):
+                thread = threading.Thread(target = self.run_worker, args = [app],
+                                          name = 'avatars-{}'.format(i), daemon = True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def run_worker(self, app):
+        while not self._stop.is_set():
+            try:
+                with app.app_context():
+                    processed = self.process_batch()
+            except Exception:
+                logger.exception('Avatar worker failed')
+                processed = 0
+            if not processed:
+                self._wakeup.wait(app.config['AVATAR_POLL_INTERVAL'])
+                self._wakeup.clear()
+
+    def claim_batch(self):
+        """Marks up to AVATAR_BATCH_SIZE due jobs as ours and returns them."""
+        config = current_app.config
+        now = datetime.utcnow()
+        token = secrets.token_hex(16)
+        due = db.and_(AvatarJob.status.in_(['pending', 'working']), AvatarJob.next_attempt_at <= now)
+        ids = db.session.query(AvatarJob.id).filter(due) \
+            .order_by(AvatarJob.next_attempt_at, AvatarJob.id) \
+            .limit(config['AVATAR_BATCH_SIZE']) \
+            .subquery()
+        # ``due`` is repeated so a job claimed by another worker in the meantime is skipped
+        AvatarJob.query.filter(AvatarJob.id.in_(db.session.query(ids.c.id)), due) \
+            .update({'status': 'working', 'claim': token,
+                     'next_attempt_at': now + timedelta(seconds = config['AVATAR_LEASE'])},
+                    synchronize_session = False)
+        db.session.commit()
+        return AvatarJob.query.filter_by(claim = token).order_by(AvatarJob.id).all()
+
+    def process_batch(self):
+        """Renders one batch of uploads, returns the number of jobs handled."""
+        batch = self.claim_batch()
+        for job in batch:
+            try:
+                image_file = render_avatars(os.path.join(self.upload_directory, job.upload), self.directory,
+                                            avatar_name(job.upload))
+            except (UnidentifiedImageError, Image.DecompressionBombError, FileNotFoundError) as e:
+                self._failed(job, e, final = True)
+            except Exception as e:
+                logger.warning('Rendering %r failed, retrying later: %s', job, e)
+                self._failed(job, e)
+            else:
+                newer = db.session.query(AvatarJob.id).filter(AvatarJob.user_id == job.user_id,
+                                                              AvatarJob.id > job.id,
+                                                              AvatarJob.status != 'failed').first()
+                if newer is None:  # a later upload by the same user wins, whichever finishes first
+                    job.user.image_file = image_file
+                job.status = 'done'
+                job.claim = None
+            db.session.commit()
+        return len(batch)
+
+    def _failed(self, job, error, final = False):
+        config = current_app.config
+        job.attempts += 1
+        job.last_error = repr(error)[:1000]
+        job.claim = None
+        if final or job.attempts >= config['AVATAR_MAX_ATTEMPTS']:
+            job.status = 'failed'
+            logger.error('Giving up on %r: %s', job, job.last_error)
+        else:
+            job.status = 'pending'
+            delay = config['AVATAR_RETRY_DELAY'] * 2 ** (job.attempts - 1)
+            job.next_attempt_at = datetime.utcnow() + timedelta(seconds = delay)
+
+    def collect_garbage(self, grace = None):
+        """
+        Deletes pictures no user refers to and uploads no job is waiting for, once they are older than
+        ``grace`` seconds. Returns the number of files removed.
+        """
+        grace = current_app.config['AVATAR_GC_GRACE'] if grace is None else grace
+        cutoff = time.time() - grace
+        in_use = set()
+        for image_file, in db.session.query(User.image_file).distinct():
+            match = AVATAR_RE.match(image_file or '')
+            in_use.add(match.group(1) if match else image_file)
+        waiting = {upload for upload, in db.session.query(AvatarJob.upload)
+                   .filter(AvatarJob.status.in_(['pending', 'working']))}
+
+        def picture_in_use(name):
+            match = AVATAR_RE.match(name)
+            return name == DEFAULT_AVATAR or (match.group(1) if match else name) in in_use
+
+        def upload_in_use(name):
+            return not UPLOAD_RE.match(name) or name in waiting
+
+        removed = 0
+        for directory, keep in ((self.directory, picture_in_use), (self.upload_directory, upload_in_use)):
+            for entry in os.scandir(directory):
+                if not entry.is_file() or keep(entry.name):
+                    continue
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        AvatarJob.query.filter(AvatarJob.status == 'done',
+                               AvatarJob.created_at < datetime.utcnow() - timedelta(seconds = grace)) \
+            .delete(synchronize_session = False)
+        db.session.commit()
+        return removed
+
+
+avatars = AvatarProcessor()
+
+
+@avatars_cli.command('worker')
+@click.option('--workers', default = None, type = int, help = 'Number of worker threads.')
+@click.option('--once', is_flag = True, help = 'Process what is due and exit.')
+def worker_command(workers, once):
+    """Process uploaded profile pictures until interrupted."""
+    if once:
+        total = 0
+        while True:
+            processed = avatars.process_batch()
+            if not processed:
+                break
+            total += processed
+        click.echo('Processed {} picture(s).'.format(total))
+        return
+    app = current_app._get_current_object()
+    workers = workers or app.config['AVATAR_WORKERS'] or 1
+    click.echo('Processing pictures with {} worker(s), press CTRL+C to quit.'.format(workers))
+    avatars.start_workers(app, workers)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        avatars.stop()
+
+
+@avatars_cli.command('gc')
+@click.option('--grace', default = None, type = int, help = 'Keep unused files younger than this many seconds.')
+def gc_command(grace):
+    """Delete profile pictures and uploads that are no longer used."""
+    click.echo('Removed {} file(s).'.format(avatars.collect_garbage(grace)))
@@ -0,0 +1,365 @@
+"""
+Response cache for anonymous traffic.
+
+Views decorated with ``response_cache.cached(...)`` are stored whole, keyed on path, query string and
+auth state, and served with an ETag so repeat visitors get a 304. Only anonymous GET/HEAD requests that
+leave the session untouched are cached. Each entry records the generation of the dependency tags it was
+rendered with (``posts``, ``post:<id>``, ``users``, ``tags``). Committing a change to a Post, Comment,
+Tag or User gives the affected tags a new generation, which turns every entry built on them into a miss.
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request, session, make_response
+from flask_login import current_user
+
+from flaskblog import db
+from flaskblog.database import primary_reads
+
+GENERATION_PREFIX = 'gen:'
+UNCACHED_HEADERS = ('Set-Cookie', 'Date', 'ETag', 'X-Cache')
+
+
+class NullCacheBackend(object):
+    """Caches nothing, for development and most tests."""
+    name = 'null'
+
+    def get_many(self, keys):
+        return [None] * len(keys)
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout = None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class MemoryCacheBackend(object):
+    """Per process LRU of at most ``max_entries`` values."""
+    name = 'memory'
+
+    def __init__(self, max_entries = 1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires, value)
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        now = time.time()
+        values = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None or (entry[0] and entry[0] < now):
+                    values.append(None)
+                else:
+                    self._entries.move_to_end(key)
+                    values.append(entry[1])
+        return values
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def set(self, key, value, timeout = None):
+        with self._lock:
+            self._entries[key] = (time.time() + timeout if timeout else 0, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FileSystemCacheBackend(object):
+    """One pickle file per key, shared by every process on the host."""
+    name = 'filesystem'
+    PRUNE_EVERY = 100  # sets between checks of the directory size
+
+    def __init__(self, directory, max_entries = 1000):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._sets = 0
+        os.makedirs(directory, exist_ok = True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.cache')
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires and expires < time.time():
+            return None
+        return value
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, timeout = None):
+        fd, tmp = tempfile.mkstemp(dir = self.directory, suffix = '.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((time.time() + timeout if timeout else 0, value), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._sets += 1
+        if self._sets % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def prune(self):
+        """Drops the least recently written files once there are more than ``max_entries``."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.cache'):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        for mtime, path in entries[:len(entries) - self.max_entries]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.cache'):
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+class RedisCacheBackend(object):
+    """
+    Any client with the redis-py ``get``, ``mget``, ``set(..., ex = )``, ``delete`` and ``scan_iter``
+    methods, values are pickled under ``prefix``.
+    """
+    name = 'redis'
+
+    def __init__(self, client, prefix = 'flaskblog:cache:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get_many(self, keys):
+        return [None if value is None else pickle.loads(value)
+                for value in self.client.mget([self.prefix + key for key in keys])]
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def set(self, key, value, timeout = None):
+        self.client.set(self.prefix + key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ex = timeout or None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(match = self.prefix + '*'):
+            self.client.delete(key)
+
+
+def create_backend(app):
+    """Picks the backend named by ``RESPONSE_CACHE_BACKEND``."""
+    config = app.config
+    choice = config['RESPONSE_CACHE_BACKEND']
+    if choice == 'null':
+        return NullCacheBackend()
+    elif choice == 'memory':
+        return MemoryCacheBackend(config['RESPONSE_CACHE_MAX_ENTRIES'])
+    elif choice == 'filesystem':
+        directory = config['RESPONSE_CACHE_DIR'] or os.path.join(tempfile.gettempdir(), 'flaskblog-cache')
+        return FileSystemCacheBackend(directory, config['RESPONSE_CACHE_MAX_ENTRIES'])
+    elif choice == 'redis':
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('RESPONSE_CACHE_BACKEND = "redis" needs the redis package installed')
+        return RedisCacheBackend(redis.Redis.from_url(config['RESPONSE_CACHE_REDIS_URL']))
+    raise ValueError('Unknown RESPONSE_CACHE_BACKEND {!r}'.format(choice))
+
+
+class ResponseCache(object):
+    """Flask extension holding the configured backend in ``app.extensions['response_cache']``."""
+
+    def __init__(self, app = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RESPONSE_CACHE_BACKEND', 'memory')
+        app.config.setdefault('RESPONSE_CACHE_TIMEOUT', 300)
+        app.config.setdefault('RESPONSE_CACHE_MAX_ENTRIES', 1000)
+        app.config.setdefault('RESPONSE_CACHE_DIR', None)
+        app.config.setdefault('RESPONSE_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+        app.extensions['response_cache'] = create_backend(app)
+
+    @property
+    def backend(self):
+        return current_app.extensions['response_cache']
+
+    def generations(self, tags):
+        """Current generation of every tag, tags never seen before get one now."""
+        keys = [GENERATION_PREFIX + tag for tag in tags]
+        values = self.backend.get_many(keys) if keys else []
+        generations = {}
+        for tag, key, value in zip(tags, keys, values):
+            if value is None:
+                # a fresh token rather than a default, so entries made before an eviction stay invalid
+                value = uuid.uuid4().hex
+                self.backend.set(key, value)
+            generations[tag] = value
+        return generations
+
+    def invalidate(self, tags):
+        for tag in tags:
+            self.backend.set(GENERATION_PREFIX + tag, uuid.uuid4().hex)
+
+    def _lookup(self, key, tags):
+        """Returns ``(entry or None, generations to store a new entry with)`` in one read when possible."""
+        keys = [key] + [GENERATION_PREFIX + tag for tag in tags]
+        values = self.backend.get_many(keys)
+        entry, stored = values[0], values[1:]
+        if any(value is None for value in stored):
+            return None, self.generations(tags)
+        generations = dict(zip(tags, stored))
+        if entry is not None and entry['generations'] != generations:
+            entry = None
+        return entry, generations
+
+    def fragment(self, key, tags, render, timeout = None):
+        """Cached result of ``render()``, for pieces of pages that are also shown to signed in users."""
+        if current_app.config['RESPONSE_CACHE_BACKEND'] == 'null':
+            return render()
+        key = 'fragment:' + key
+        entry, generations = self._lookup(key, list(tags))
+        if entry is not None:
+            return entry['value']
+        with primary_reads():  # a lagging replica's data would be kept until the entry expires
+            value = render()
+        self.backend.set(key, dict(value = value, generations = generations),
+                         timeout or current_app.config['RESPONSE_CACHE_TIMEOUT'])
+        return value
+
+    @staticmethod
+    def cacheable_request():
+        return request.method in ('GET', 'HEAD') and not current_user.is_authenticated \
+            and '_flashes' not in session
+
+    @staticmethod
+    def request_key():
+        # one entry per path and query string per auth state, only anonymous pages are stored for now
+        query = '&'.join(sorted(request.query_string.decode('utf-8', 'replace').split('&')))
+        return 'page:anonymous:{}?{}'.format(request.path, query)
+
+    def cached(self, tags = lambda **view_args: (), timeout = None):
+        """
+        Caches the view for anonymous visitors. ``tags`` is called with the view arguments and returns
+        the dependency tags of the page.
+        """
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if current_app.config['RESPONSE_CACHE_BACKEND'] == 'null' or not self.cacheable_request():
+                    return view(*args, **kwargs)
+                key = self.request_key()
+                entry, generations = self._lookup(key, list(tags(**kwargs)))
+                if entry is not None:
+                    response = current_app.response_class(entry['body'], status = entry['status'],
+                                                          headers = entry['headers'])
+                    response.headers['X-Cache'] = 'HIT'
+                else:
+                    with primary_reads():  # the page is kept, so it must not come from a lagging replica
+                        response = make_response(view(*args, **kwargs))
+                    response.headers['X-Cache'] = 'MISS'
+                    if response.status_code == 200 and not response.direct_passthrough \
+                            and 'Set-Cookie' not in response.headers and not session.modified:
+                        headers = [(name, value) for name, value in response.headers
+                                   if name not in UNCACHED_HEADERS]
+                        self.backend.set(key, dict(status = response.status_code, headers = headers,
+                                                   body = response.get_data(), generations = generations),
+                                         timeout or current_app.config['RESPONSE_CACHE_TIMEOUT'])
+                response.add_etag()
+                response.vary.add('Cookie')
+                return response.make_conditional(request)
+
+            return wrapper
+
+        return decorator
+
+
+response_cache = ResponseCache()
+
+
+# Invalidation: the tags touched by a flush are collected and only applied once the transaction
+# commits, so a rolled back change never evicts anything and a commit always does.
+
+def _changed_tags(obj):
+    from flaskblog.models import Post, Comment, Tag, User
+    if isinstance(obj, Post):
+        return {'posts', 'post:{}'.format(obj.id)}
+    elif isinstance(obj, Comment):
+        return {'post:{}'.format(obj.post_id)} if obj.post_id is not None else {'posts'}
+    elif isinstance(obj, Tag):
+        return {'tags', 'posts'}
+    elif isinstance(obj, User):
+        return {'users'}
+    return set()
+
+
+def invalidate_on_commit(session, tags):
+    """Queues ``tags`` for the next commit, for changes the flush cannot see such as bulk UPDATEs."""
+    if tags:
+        session.info.setdefault('cache_tags', set()).update(tags)
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def collect_cache_tags(session, flush_context):
+    tags = set()
+    for obj in session.new.union(session.dirty).union(session.deleted):
+        tags.update(_changed_tags(obj))
+    invalidate_on_commit(session, tags)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def invalidate_cache_tags(session):
+    tags = session.info.pop('cache_tags', None)
+    if tags and 'response_cache' in current_app.extensions:
+        response_cache.invalidate(sorted(tags))
+
+
+@db.event.listens_for(db.session, 'after_soft_rollback')
+def discard_cache_tags(session, previous_transaction):
+    session.info.pop('cache_tags', None)
@@ -10,27 +10,91 @@ class Config(object):
     MAIL_SERVER = 'smtp.gmail.com'
     MAIL_USE_TLS = True
     MAIL_PORT = 587
+    MAIL_OUTBOX_WORKERS = 2  # set to 0 when mail is delivered by a separate `flask outbox worker` process
+    MAILGUN_API_URL = 'https://api.eu.mailgun.net/v3'
+    SUBSCRIPTION_WORKERS = 1  # mailing list signups, see flaskblog/subscriptions.py
+    AVATAR_WORKERS = 1  # profile picture resizing, see flaskblog/avatars.py
+
+    # Requests and reverse proxies
+    # Number of reverse proxies in front of the app, 0 ignores X-Forwarded-For. It is used by
+    #  - the ProxyFix create_app wraps the app in, which sets request.remote_addr from the proxies' headers
+    #  - client_address() in flaskblog/auth.py, the address the password hashing limiter counts per client
+    #  - the session identifier the SessionGuard checks, which hashes the first X-Forwarded-For entry as
+    #    flask-login did and only falls back to the ProxyFix address when the header is missing
+    TRUSTED_PROXIES = int(environ.get('TRUSTED_PROXIES', 0))
+
+    # Password hashing, see flaskblog/passwords.py
+    BCRYPT_LOG_ROUNDS = 12  # existing hashes are upgraded when their owner next signs in
+    PASSWORD_HASH_WORKERS = 2  # processes, 0 hashes on the request thread
+    PASSWORD_HASH_PER_CLIENT = 2  # hashes in flight per client address
+    PASSWORD_HASH_PER_ACCOUNT = 1
 
     # Blog parameters
     FLASKY_COMMENTS_PER_PAGE = 4
+    FLASKY_MODERATION_BATCH = 1000  # comments per bulk moderation request
     FLASKY_POSTS_PER_PAGE = 7
+    FLASKY_MAX_OFFSET_PAGES = 5  # deeper pages are reached with keyset cursors instead of OFFSET
     FLASKY_ADMIN = environ.get('FLASKY_ADMIN')
+    ROLE_CACHE_TTL = 300  # seconds other processes may act on a stale role, 0 reads the role on every request
+    FLASKY_POPULAR_TAGS = 6
+    TAG_POPULARITY_HALF_LIFE = 30  # days
     MAX_SEARCH_RESULTS = 50
+    SEARCH_BACKEND = environ.get('SEARCH_BACKEND', 'auto')  # auto, sqlite (FTS5), postgres (tsvector) or python
+
+    # Geolocation - lookups never block a request, see flaskblog/geolocation.py
+    GEOIP_TIMEOUT = 1.5  # seconds
+    GEOIP_CACHE_SIZE = 10000
+    GEOIP_CACHE_TTL = 24 * 60 * 60
+    GEOIP_FAILURE_TTL = 60  # seconds a timed out or failed lookup is remembered
+    GEOIP_DATABASE = environ.get('GEOIP_DATABASE')  # optional offline IP range CSV file
+
+    # Anonymous page cache, see flaskblog/caching.py
+    RESPONSE_CACHE_BACKEND = environ.get('RESPONSE_CACHE_BACKEND', 'memory')  # memory, filesystem, redis or null
+    RESPONSE_CACHE_TIMEOUT = 300
+    RESPONSE_CACHE_DIR = environ.get('RESPONSE_CACHE_DIR')
+    RESPONSE_CACHE_REDIS_URL = environ.get('RESPONSE_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+
+    # Database connections, see flaskblog/database.py, SQLite ignores the pool settings
+    DATABASE_POOL_SIZE = int(environ.get('DATABASE_POOL_SIZE', 5))  # per process and database, >= serve --threads
+    DATABASE_MAX_OVERFLOW = int(environ.get('DATABASE_MAX_OVERFLOW', 10))  # extra connections under load
+    DATABASE_POOL_TIMEOUT = 10  # seconds a request waits for a free connection
+    DATABASE_POOL_RECYCLE = 1800  # seconds, shorter than the server's idle timeout
+    DATABASE_POOL_PRE_PING = True  # checks connections before use, survives database restarts
+    DATABASE_REPLICA_URIS = environ.get('DATABASE_REPLICA_URIS', '').split()  # read-only copies of the primary
+    DATABASE_REPLICA_ENDPOINTS = ('main.home', 'posts.post', 'users.user_profile', 'main.search_results')
+    DATABASE_REPLICA_STICKINESS = 10  # seconds a client reads from the primary after it wrote
+
+    # Instrumentation, see flaskblog/metrics.py
+    METRICS_TOKEN = environ.get('METRICS_TOKEN')  # bearer token the Prometheus scraper sends to /metrics
+    METRICS_DIR = environ.get('METRICS_DIR')  # shared by the server's workers, flaskblog.serve picks one if unset
+    METRICS_SLOW_REQUEST = 1.0  # seconds, slower requests are logged with their slowest SQL statements
+    SLOW_QUERY_THRESHOLD = 0.1  # seconds, slower statements go to the log `flask perf advise` reads
+    SLOW_QUERY_LOG = environ.get('SLOW_QUERY_LOG')  # defaults to <instance>/slow_queries.jsonl
+
+    @staticmethod
+    def init_app(app):
+        pass
 
 
 class ProductionConfig(Config):
     DEBUG = False
     TESTING = False
     FLASK_ENV = 'production'
+    CONFIG_FILE = environ.get('FLASKBLOG_CONFIG_FILE', '/etc/config.json')
+    # shared by the worker processes of a host, so a commit invalidates pages in all of them
+    RESPONSE_CACHE_BACKEND = environ.get('RESPONSE_CACHE_BACKEND', 'filesystem')
+    # app.config key: key in CONFIG_FILE
+    CONFIG_FILE_KEYS = dict(SECRET_KEY = 'SECRET_KEY', SQLALCHEMY_DATABASE_URI = 'SQLALCHEMY_DATABASE_URI',
+                            MAIL_API_KEY = 'MAIL_API_KEY', MAIL_USERNAME = 'MAIL_USER', MAIL_PASSWORD = 'MAIL_PASS',
+                            FLASKY_ADMIN = 'FLASKY_ADMIN')
 
-    with open('/etc/config.json') as config_file:
-        config = json.load(config_file)
-        SECRET_KEY = config.get('SECRET_KEY')
-        SQLALCHEMY_DATABASE_URI = config.get('SQLALCHEMY_DATABASE_URI')
-        MAIL_API_KEY = config.get('MAIL_API_KEY')
-        MAIL_USERNAME = config.get('MAIL_USER')
-        MAIL_PASSWORD = config.get('MAIL_PASS')
-        FLASKY_ADMIN = config.get('FLASKY_ADMIN')
+    @classmethod
+    def init_app(cls, app):
+        # read when an app is created, importing the package has no need for the file
+        with open(cls.CONFIG_FILE) as config_file:
+            config = json.load(config_file)
+        for name, key in cls.CONFIG_FILE_KEYS.items():
+            app.config[name] = config.get(key)
 
 
 class DevelopmentConfig(Config):
@@ -42,3 +106,30 @@ class DevelopmentConfig(Config):
     # MAIL_USERNAME = environ.get('MAIL_USER')
     # MAIL_PASSWORD = environ.get('MAIL_PASS')
     # MAIL_API_KEY = environ.get('MAIL_API_KEY')
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SECRET_KEY = 'testing'
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    WTF_CSRF_ENABLED = False
+    MAIL_SUPPRESS_SEND = True
+    MAIL_OUTBOX_WORKERS = 0
+    SUBSCRIPTION_WORKERS = 0
+    AVATAR_WORKERS = 0
+    RESPONSE_CACHE_BACKEND = 'null'
+    BCRYPT_LOG_ROUNDS = 4
+    PASSWORD_HASH_WORKERS = 0
+    SLOW_QUERY_THRESHOLD = None
+    MAIL_API_KEY = None
+    MAIL_USERNAME = 'testing@afridevsforum.com'
+    FLASKY_ADMIN = 'admin@afridevsforum.com'
+
+
+config = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+    'default': ProductionConfig,
+}
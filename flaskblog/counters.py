@@ -0,0 +1,156 @@
+import click
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import func, select
+from sqlalchemy.orm import attributes
+
+from flaskblog import db
+from flaskblog.models import Counter, User, Post, Tag, Comment, post_tag
+
+USERS = 'users'
+POSTS = 'posts'
+
+counters_cli = AppGroup('counters', help = 'Maintain the denormalized site counters.')
+
+
+def tag_counter(slug):
+    return 'tag_posts:' + slug
+
+
+def get_counts(*names):
+    """Returns ``{name: value}`` for the requested counters in one query, missing counters read as 0."""
+    rows = db.session.query(Counter.name, Counter.value).filter(Counter.name.in_(names)).all()
+    counts = dict.fromkeys(names, 0)
+    counts.update(rows)
+    return counts
+
+
+def get_count(name):
+    return get_counts(name)[name]
+
+
+def _bump(connection, name, delta):
+    table = Counter.__table__
+    result = connection.execute(table.update()
+                                .where(table.c.name == name)
+                                .values(value = table.c.value + delta))
+    if result.rowcount == 0:
+        connection.execute(table.insert().values(name = name, value = max(delta, 0)))
+
+
+def _bump_comment_count(connection, post_id, delta):
+    if post_id is None:
+        return
+    table = Post.__table__
+    connection.execute(table.update()
+                       .where(table.c.id == post_id)
+                       .values(comment_count = table.c.comment_count + delta))
+
+
+# Mapper events run inside the flush, on the same connection and transaction as the row they count.
+
+@db.event.listens_for(User, 'after_insert')
+def user_inserted(mapper, connection, target):
+    _bump(connection, USERS, 1)
+
+
+@db.event.listens_for(User, 'after_delete')
+def user_deleted(mapper, connection, target):
+    _bump(connection, USERS, -1)
+
+
+@db.event.listens_for(Post, 'after_insert')
+def post_inserted(mapper, connection, target):
+    _bump(connection, POSTS, 1)
+
+
+@db.event.listens_for(Post, 'after_delete')
+def post_deleted(mapper, connection, target):
+    _bump(connection, POSTS, -1)
+
+
+@db.event.listens_for(Comment, 'after_insert')
+def comment_inserted(mapper, connection, target):
+    _bump_comment_count(connection, target.post_id, 1)
+
+
+@db.event.listens_for(Comment, 'after_delete')
+def comment_deleted(mapper, connection, target):
+    _bump_comment_count(connection, target.post_id, -1)
+
+
+# post_tag rows have no mapper of their own, so the tag counters are worked out from the pending
+# changes to Post.tag before the flush writes them.
+@db.event.listens_for(db.session, 'before_flush')
+def count_tag_changes(session, flush_context, instances):
+    deltas = {}
+    for obj in session.new.union(session.dirty):
+        if isinstance(obj, Post):
+            history = attributes.get_history(obj, 'tag')
+            for tag in history.added:
+                deltas[tag.slug] = deltas.get(tag.slug, 0) + 1
+            for tag in history.deleted:
+                deltas[tag.slug] = deltas.get(tag.slug, 0) - 1
+    with session.no_autoflush:
+        for obj in session.deleted:
+            if isinstance(obj, Post):
+                for tag in obj.tag:
+                    deltas[tag.slug] = deltas.get(tag.slug, 0) - 1
+    if deltas:
+        session.info.setdefault('tag_count_deltas', []).append(deltas)
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def apply_tag_changes(session, flush_context):
+    pending = session.info.pop('tag_count_deltas', None)
+    if not pending:
+        return
+    connection = session.connection()
+    for deltas in pending:
+        for slug, delta in deltas.items():
+            if delta and slug:
+                _bump(connection, tag_counter(slug), delta)
+
+
+def reconcile():
+    """Recomputes every counter from the source tables and returns the number of values that were off."""
+    expected = {
+        USERS: db.session.query(func.count(User.id)).scalar(),
+        POSTS: db.session.query(func.count(Post.id)).scalar(),
+    }
+    tag_counts = db.session.query(Tag.slug, func.count(post_tag.c.post_id)) \
+        .join(post_tag, post_tag.c.tag_id == Tag.id) \
+        .group_by(Tag.slug)
+    for slug, count in tag_counts:
+        if slug:
+            expected[tag_counter(slug)] = count
+
+    fixed = 0
+    current = {c.name: c for c in Counter.query.all()}
+    for name, value in expected.items():
+        counter = current.pop(name, None)
+        if counter is None:
+            db.session.add(Counter(name = name, value = value))
+            fixed += 1
+        elif counter.value != value:
+            counter.value = value
+            fixed += 1
+    for counter in current.values():  # tags that no longer have posts
+        if counter.value != 0:
+            counter.value = 0
+            fixed += 1
+
+    comment_counts = select([func.count(Comment.id)]).where(Comment.post_id == Post.id).as_scalar()
+    result = db.session.execute(Post.__table__.update()
+                                .where(Post.comment_count != comment_counts)
+                                .values(comment_count = comment_counts))
+    fixed += result.rowcount
+    db.session.commit()
+    return fixed
+
+
+@counters_cli.command('reconcile')
+@with_appcontext
+def reconcile_command():
+    """Recount users, posts, comments per post and posts per tag."""
+    fixed = reconcile()
+    click.echo('Reconciled counters, {} value(s) corrected.'.format(fixed))
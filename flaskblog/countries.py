@@ -0,0 +1,79 @@
+import json
+import os
+import tempfile
+import threading
+
+import click
+import requests
+from flask.cli import AppGroup
+
+from flaskblog.metrics import metrics
+
+countries_cli = AppGroup('countries', help = 'Manage the bundled list of countries.')
+
+COUNTRIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'json', 'countries.json')
+REFRESH_URL = 'https://restcountries.com/v2/region/africa'
+
+_lock = threading.Lock()
+_countries = None
+_choices = None
+
+
+def get_countries():
+    """The bundled country records, read from disk once per process."""
+    global _countries, _choices
+    if _countries is None:
+        with _lock:
+            if _countries is None:
+                with open(COUNTRIES_FILE, encoding = 'utf-8') as json_file:
+                    countries = tuple(json.load(json_file))
+                _choices = tuple((c['name'], c['name']) for c in countries)
+                _countries = countries
+    return _countries
+
+
+def country_choices():
+    """``(name, name)`` pairs for the country select fields, shared by every form."""
+    get_countries()
+    return _choices
+
+
+def reset():
+    global _countries, _choices
+    with _lock:
+        _countries = _choices = None
+
+
+def refresh(source = REFRESH_URL, timeout = 10):
+    """
+    Replaces the bundled file with the records from ``source``, a restcountries v2 style URL or a local
+    JSON file, and returns how many were written. Never runs on its own, the app only reads the file.
+    """
+    if source.startswith(('http://', 'https://')):
+        response = requests.get(source, timeout = timeout, hooks = dict(response = metrics.record_http))
+        response.raise_for_status()
+        countries = response.json()
+    else:
+        with open(source, encoding = 'utf-8') as json_file:
+            countries = json.load(json_file)
+    if not isinstance(countries, list) or not all(isinstance(c, dict) and c.get('name') for c in countries):
+        raise ValueError('Expected a list of country records with a name')
+    countries.sort(key = lambda c: c['name'])
+    # written next to the old file and moved over it, readers never see half a file
+    fd, path = tempfile.mkstemp(dir = os.path.dirname(COUNTRIES_FILE), suffix = '.json')
+    try:
+        with os.fdopen(fd, 'w', encoding = 'utf-8') as json_file:
+            json.dump(countries, json_file, indent = 2)
+        os.replace(path, COUNTRIES_FILE)
+    except BaseException:
+        os.unlink(path)
+        raise
+    reset()
+    return len(countries)
+
+
+@countries_cli.command('refresh')
+@click.option('--source', default = REFRESH_URL, show_default = True, help = 'URL or JSON file to read from.')
+def refresh_command(source):
+    """Update static/json/countries.json, commit the result to ship it."""
+    click.echo('Wrote {} countries to {}.'.format(refresh(source), COUNTRIES_FILE))
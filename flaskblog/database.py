@@ -0,0 +1,139 @@
+"""
+Database connection pools and read replicas.
+
+Engines other than SQLite's take their pool settings from the config. Each process keeps
+``DATABASE_POOL_SIZE`` connections per database, opens up to ``DATABASE_MAX_OVERFLOW`` more under
+load, then waits up to ``DATABASE_POOL_TIMEOUT`` seconds for a free one. ``DATABASE_POOL_PRE_PING``
+tests a connection before handing it out, so a restarted or failed over server costs a reconnect
+instead of an error. Connections are replaced after ``DATABASE_POOL_RECYCLE`` seconds, before an idle
+timeout on the server or a firewall drops them. SQLite keeps Flask-SQLAlchemy's pooling.
+
+``DATABASE_REPLICA_URIS`` lists read-only copies of the primary. GET and HEAD requests to one of the
+``DATABASE_REPLICA_ENDPOINTS`` read from a replica, picked at random per request. Writes go to the
+primary, and so does every read after a write in the same request. Reads whose result outlives the
+request also use the primary (``primary_reads()``, used by the response cache), because a page cached
+from a lagging replica would stay stale until it expires. After a client's request commits a write,
+that client reads from the primary for ``DATABASE_REPLICA_STICKINESS`` seconds so it sees its own
+changes.
+
+To try it locally, use a copy of a SQLite database as the replica::
+
+    cp flaskblog/site.db /tmp/replica.db
+    DATABASE_REPLICA_URIS=sqlite:////tmp/replica.db python run.py
+"""
+import random
+import time
+from contextlib import contextmanager
+
+import flask_sqlalchemy
+from flask import current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import orm
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.sql.selectable import SelectBase
+
+STICKY_COOKIE = 'read_primary_until'
+POOL_OPTIONS = dict(pool_size = 'DATABASE_POOL_SIZE', max_overflow = 'DATABASE_MAX_OVERFLOW',
+                    pool_timeout = 'DATABASE_POOL_TIMEOUT', pool_recycle = 'DATABASE_POOL_RECYCLE',
+                    pool_pre_ping = 'DATABASE_POOL_PRE_PING')
+
+
+def is_read(clause):
+    if isinstance(clause, SelectBase):
+        return getattr(clause, '_for_update_arg', None) is None  # a replica cannot lock rows
+    return isinstance(clause, TextClause) and clause.text.lstrip().upper().startswith(('SELECT', 'WITH'))
+
+
+@contextmanager
+def primary_reads():
+    """Reads in the block use the primary, for results that are kept after the request."""
+    previous = g.get('read_primary', False)
+    g.read_primary = True
+    try:
+        yield
+    finally:
+        g.read_primary = previous
+
+
+class RoutingSession(flask_sqlalchemy.SignallingSession):
+    """Sends the reads of replica routed requests to a replica, see the module docstring."""
+
+    def __init__(self, db, **options):
+        super(RoutingSession, self).__init__(db, **options)
+        self._db = db
+        self._replica = None
+        self._wrote = False
+
+    def get_bind(self, mapper = None, clause = None):
+        if self._flushing or (clause is not None and not is_read(clause)):
+            self._wrote = True
+        elif self._reads_from_replica(mapper):
+            if self._replica is None:
+                self._replica = random.choice(self.app.extensions['read_replicas'])
+            return self._db.get_engine(self.app, self._replica)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def _reads_from_replica(self, mapper):
+        if self._wrote or not has_app_context() or not g.get('read_replica') or g.get('read_primary'):
+            return False
+        return mapper is None or mapper.persist_selectable.info.get('bind_key') is None
+
+    def commit(self):
+        super(RoutingSession, self).commit()
+        if self._wrote and has_request_context():
+            g.database_wrote = True
+
+
+class SQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    """Flask-SQLAlchemy with configured connection pools and read replica routing."""
+
+    def init_app(self, app):
+        app.config.setdefault('DATABASE_POOL_SIZE', None)  # None leaves SQLAlchemy's default
+        app.config.setdefault('DATABASE_MAX_OVERFLOW', None)
+        app.config.setdefault('DATABASE_POOL_TIMEOUT', None)
+        app.config.setdefault('DATABASE_POOL_RECYCLE', None)
+        app.config.setdefault('DATABASE_POOL_PRE_PING', None)
+        app.config.setdefault('DATABASE_REPLICA_URIS', ())
+        app.config.setdefault('DATABASE_REPLICA_ENDPOINTS', ())
+        app.config.setdefault('DATABASE_REPLICA_STICKINESS', 10)  # seconds
+        super(SQLAlchemy, self).init_app(app)
+        # the replicas are Flask-SQLAlchemy binds that no model uses, create_all() leaves them alone
+        binds = dict(app.config['SQLALCHEMY_BINDS'] or {})
+        replicas = []
+        for number, uri in enumerate(app.config['DATABASE_REPLICA_URIS']):
+            replicas.append('replica{}'.format(number))
+            binds[replicas[-1]] = uri
+        app.config['SQLALCHEMY_BINDS'] = binds or None
+        app.extensions['read_replicas'] = tuple(replicas)
+        if replicas:
+            app.before_request(self._route_request)
+            app.after_request(self._stick_to_primary)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_ = RoutingSession, db = self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super(SQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername.startswith('sqlite'):
+            return  # no server connections to keep, Flask-SQLAlchemy picks the right pool
+        options.update((option, app.config[key]) for option, key in POOL_OPTIONS.items()
+                       if app.config[key] is not None)
+
+    def dispose_all(self, app):
+        """Closes the pooled connections of every engine of ``app``, e.g. before forking."""
+        for bind in [None] + list(app.config['SQLALCHEMY_BINDS'] or ()):
+            self.get_engine(app, bind).dispose()
+
+    @staticmethod
+    def _route_request():
+        sticky = request.cookies.get(STICKY_COOKIE, '')
+        g.read_replica = request.method in ('GET', 'HEAD') and \
+            request.endpoint in current_app.config['DATABASE_REPLICA_ENDPOINTS'] and \
+            not (sticky.isdigit() and int(sticky) > time.time())
+
+    @staticmethod
+    def _stick_to_primary(response):
+        if g.get('database_wrote'):
+            stickiness = current_app.config['DATABASE_REPLICA_STICKINESS']
+            response.set_cookie(STICKY_COOKIE, str(int(time.time() + stickiness) + 1), max_age = stickiness,
+                                httponly = True, samesite = 'Lax')
+        return response
@@ -1,5 +1,7 @@
 from flask import Blueprint, render_template
 
+from flaskblog.passwords import PasswordHashingBusy
+
 errors = Blueprint('errors', __name__)
 
 
@@ -16,3 +18,8 @@ def error_403(error):
 @errors.app_errorhandler(500)  # decorator used to handle error 500
 def error_500(error):
     return render_template('errors/500.html'), 500  # also return  the error code here
+
+
+@errors.app_errorhandler(PasswordHashingBusy)  # too many sign in attempts at once, see flaskblog/passwords.py
+def error_429(error):
+    return render_template('errors/429.html'), 429, {'Retry-After': '5'}
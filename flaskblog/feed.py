@@ -0,0 +1,28 @@
+from sqlalchemy.orm import defer, joinedload, selectinload
+
+from flaskblog.models import Post, post_tag
+from flaskblog.pagination import paginate_keyset
+
+
+# Every listing page renders the author (avatar + username) and may render the tags of each post.
+# Loading them here keeps a page at a fixed number of queries no matter how many posts it shows:
+# authors come in with a JOIN and all the tags of the page with one extra SELECT ... IN.
+# Listings show the stored excerpt, so the full bodies are left in the database.
+def feed_query():
+    return Post.query.options(joinedload(Post.author), selectinload(Post.tags),
+                              defer(Post.content), defer(Post.content_html))
+
+
+def recent_posts(page, per_page, after = None, before = None):
+    return paginate_keyset(feed_query(), (Post.date_posted, Post.id), page, per_page, after = after, before = before)
+
+
+def posts_by_author(user, page, per_page, after = None, before = None):
+    return paginate_keyset(feed_query().filter(Post.user_id == user.id), (Post.date_posted, Post.id),
+                           page, per_page, after = after, before = before)
+
+
+def posts_by_tag(tag, page, per_page, after = None, before = None):
+    # post_tag is reached through its (tag_id, post_id) index
+    query = feed_query().join(post_tag, post_tag.c.post_id == Post.id).filter(post_tag.c.tag_id == tag.id)
+    return paginate_keyset(query, (Post.date_posted, Post.id), page, per_page, after = after, before = before)
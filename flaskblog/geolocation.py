@@ -0,0 +1,227 @@
+import bisect
+import csv
+import ipaddress
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from flaskblog.metrics import metrics
+
+GEOIP_FIELDS = 'status,message,continent,continentCode,country,countryCode,region,regionName,city,zip,lat,lon,' \
+               'timezone,isp,org,as,mobile,proxy,query'
+
+
+class LocationCache(object):
+    """Thread safe LRU cache whose entries expire after ``ttl`` seconds, or their own ttl."""
+
+    def __init__(self, maxsize = 10000, ttl = 86400):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns ``(value, fresh)`` or ``(None, False)`` if the key was never stored."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None, False
+            self._data.move_to_end(key)
+            value, expires_at = entry
+            return value, time.monotonic() < expires_at
+
+    def set(self, key, value, ttl = None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last = False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class IPRangeDatabase(object):
+    """Offline lookups from a CSV file of ``start_ip,end_ip,country_code,country,continent_code,continent`` rows."""
+
+    def __init__(self, path):
+        self._starts = []
+        self._rows = []
+        with open(path, newline = '') as csv_file:
+            rows = []
+            for row in csv.reader(csv_file):
+                if not row or row[0].startswith('#'):
+                    continue
+                try:
+                    start = int(ipaddress.ip_address(row[0].strip()))
+                    end = int(ipaddress.ip_address(row[1].strip()))
+                except ValueError:
+                    continue  # header line or malformed address
+                rows.append((start, end, [x.strip() for x in row[2:6]]))
+        rows.sort(key = lambda r: r[0])
+        for start, end, info in rows:
+            self._starts.append(start)
+            self._rows.append((end, info))
+
+    def lookup(self, ip_address):
+        try:
+            ip = int(ipaddress.ip_address(ip_address))
+        except ValueError:
+            return None
+        i = bisect.bisect_right(self._starts, ip) - 1
+        if i < 0:
+            return None
+        end, info = self._rows[i]
+        if ip > end:
+            return None
+        info = info + [''] * (4 - len(info))
+        return {'status': 'success', 'countryCode': info[0], 'country': info[1],
+                'continentCode': info[2], 'continent': info[3], 'query': ip_address}
+
+
+class GeoLocator(object):
+    """
+    Looks up the location of a client IP address without ever blocking a request.
+
+    Results come from the local IP range database when ``GEOIP_DATABASE`` is set, otherwise from the
+    ip-api.com service. Remote lookups run on a small background pool with a hard timeout; a request that
+    misses the cache gets ``None`` and the answer is ready for the next page view. Stale entries are served
+    while they are refreshed in the background. A lookup that times out or gets an HTTP error is only
+    remembered for ``GEOIP_FAILURE_TTL`` seconds, with the previous answer if there was one.
+    """
+
+    def __init__(self, app = None):
+        self.cache = LocationCache()
+        self.database = None
+        self.api_url = 'http://ip-api.com/json/{}'
+        self.timeout = 1.5
+        self.failure_ttl = 60
+        self.by_prefix = True
+        self._executor = None
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._session = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('GEOIP_API_URL', self.api_url)
+        app.config.setdefault('GEOIP_TIMEOUT', self.timeout)
+        app.config.setdefault('GEOIP_CACHE_SIZE', 10000)
+        app.config.setdefault('GEOIP_CACHE_TTL', 86400)
+        app.config.setdefault('GEOIP_FAILURE_TTL', self.failure_ttl)
+        app.config.setdefault('GEOIP_CACHE_BY_PREFIX', True)
+        app.config.setdefault('GEOIP_DATABASE', None)
+        app.config.setdefault('GEOIP_WORKERS', 2)
+
+        self.api_url = app.config['GEOIP_API_URL']
+        self.timeout = app.config['GEOIP_TIMEOUT']
+        self.failure_ttl = app.config['GEOIP_FAILURE_TTL']
+        self.by_prefix = app.config['GEOIP_CACHE_BY_PREFIX']
+        self.cache = LocationCache(app.config['GEOIP_CACHE_SIZE'], app.config['GEOIP_CACHE_TTL'])
+        if app.config['GEOIP_DATABASE']:
+            self.database = IPRangeDatabase(app.config['GEOIP_DATABASE'])
+        self._workers = app.config['GEOIP_WORKERS']
+
+        app.extensions['geolocator'] = self
+
+        @app.context_processor
+        def inject_user_location():
+            from flask import request
+            return dict(user_location = LazyLocation(self, request.remote_addr))
+
+    def cache_key(self, ip_address):
+        """Clients in the same /24 (IPv4) or /48 (IPv6) network share a cache entry."""
+        if not self.by_prefix:
+            return ip_address
+        try:
+            ip = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return ip_address
+        prefix = 24 if ip.version == 4 else 48
+        return str(ipaddress.ip_network('{}/{}'.format(ip, prefix), strict = False))
+
+    def lookup(self, ip_address, wait = False):
+        """
+        Returns the location dict for ``ip_address`` or ``None`` if it isn't known yet.
+        :param wait: block (up to the configured timeout) for a remote lookup instead of scheduling it.
+        """
+        if not ip_address:
+            return None
+        if self.database is not None:
+            return self.database.lookup(ip_address)
+
+        key = self.cache_key(ip_address)
+        value, fresh = self.cache.get(key)
+        if fresh:
+            return value
+        if wait:
+            return self._fetch(key, ip_address)
+        self._schedule(key, ip_address)
+        return value  # stale value (or None) while the refresh runs
+
+    def _schedule(self, key, ip_address):
+        with self._pending_lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers = self._workers,
+                                                    thread_name_prefix = 'geolocation')
+        self._executor.submit(self._fetch, key, ip_address)
+
+    def _fetch(self, key, ip_address):
+        try:
+            if self._session is None:
+                self._session = requests.Session()
+                self._session.hooks['response'].append(metrics.record_http)
+            response = self._session.get(self.api_url.format(ip_address), params = {'fields': GEOIP_FIELDS},
+                                         timeout = self.timeout)
+            response.raise_for_status()
+            data = response.json()
+        except (requests.RequestException, ValueError):
+            # remembered briefly so an unreachable service isn't hammered, a blip must not blank it for a day
+            data, _ = self.cache.get(key)
+            self.cache.set(key, data, self.failure_ttl)
+            return data
+        finally:
+            with self._pending_lock:
+                self._pending.discard(key)
+        if not isinstance(data, dict) or data.get('status') != 'success':
+            data = None  # a private or reserved address, the answer will not change
+        self.cache.set(key, data)
+        return data
+
+
+class LazyLocation(object):
+    """Template proxy that only looks the location up when an attribute is read."""
+
+    def __init__(self, locator, ip_address):
+        self._locator = locator
+        self._ip_address = ip_address
+        self._resolved = False
+        self._data = None
+
+    def _get(self):
+        if not self._resolved:
+            self._data = self._locator.lookup(self._ip_address)
+            self._resolved = True
+        return self._data
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        data = self._get()
+        if data is None:
+            return None
+        return data.get(name)
+
+    def __bool__(self):
+        return self._get() is not None
@@ -1,17 +1,18 @@
-import requests
+from email_validator import validate_email, EmailNotValidError
 from flask import Blueprint, redirect, flash
 from flask import render_template, request, current_app, g, url_for
 from flask_login import current_user
 from flask_mail import Message
-from flaskblog import mail
-from sqlalchemy import or_
 
-from flaskblog import db
+from flaskblog.caching import response_cache
+from flaskblog.counters import get_counts, USERS, POSTS
 from flaskblog.decorators import admin_required
-from flaskblog.models import Post, Tag, User
+from flaskblog.feed import recent_posts
+from flaskblog.outbox import outbox
 from flaskblog.posts.forms import SearchForm
-
-app = current_app._get_current_object()
+from flaskblog.search import search_posts
+from flaskblog.subscriptions import subscriptions, NEWSLETTER_LIST
+from flaskblog.tags import popular_tags
 
 main = Blueprint('main', __name__)
 
@@ -23,69 +24,52 @@ def before_request():
         g.search_form = SearchForm()
 
 
-# CHECK USER LOCATION - IP ADDRESS.
-def get_user_ip(ip_address):
-    try:
-        response = requests.get(
-            "http://ip-api.com/json/{}?fields=status,message,continent,continentCode,country,countryCode,region,regionName,city,zip,lat,lon,timezone,isp,org,as,mobile,proxy,query".format(
-                ip_address))
-        data = response.json()
-        return data
-    except Exception as e:
-        return "Unknown"
-
-
-def subscribe_user(email, user_group, api_key):
-    resp = requests.post(f"https://api.eu.mailgun.net/v3/lists/{user_group}/members",
-                         auth = ("api", api_key),
-                         data = {"subscribed": True, "address": email})
-
-    print(resp.status_code)
-
-
 @main.route("/")
 @main.route("/home")
+@response_cache.cached(tags = lambda: ('posts', 'users', 'tags'))
 def home():
-    # TODO: use HTTP_X_FORWARDED_FOR to get ip address on nginx (Production)
-    ip_address = request.remote_addr
-    user_data = get_user_ip(ip_address)
-
-    user_count = db.session.query(User).count()
-    post_count = db.session.query(Post).count()
+    counts = get_counts(USERS, POSTS)
     # we will use the paginate function to limit the number of posts appearing in the home page - ...
     page = request.args.get('page', 1, type = int)
-    posts = Post.query.order_by(Post.date_posted.desc()).paginate(page = page,
-                                                                  per_page = current_app.config[
-                                                                      'FLASKY_POSTS_PER_PAGE'])
+    posts = recent_posts(page, current_app.config['FLASKY_POSTS_PER_PAGE'],
+                         after = request.args.get('after'), before = request.args.get('before'))
 
-    # tags = Tag.query.distinct(Tag.name).limit(8)
-    tags = db.session.query(Tag.name).distinct().limit(6)
-    return render_template('home.html', posts = posts, tags = tags, user_count = user_count, post_count = post_count)
+    tags = popular_tags()
+    return render_template('home.html', posts = posts, tags = tags, user_count = counts[USERS],
+                           post_count = counts[POSTS])
 
 
 # TODO -> You have successfully subscribed message
 @main.route("/subscribe", methods = ["GET", "POST"])
 def subscribe():
     if request.method == "POST":
-        email = request.form.get('submail')
-        subscribe_user(email,
-                       "newsletter@app.afridevsforum.com",
-                       app.config['MAIL_API_KEY'])
-        flash('You have successfully subscribed!', 'success')
+        email = request.form.get('submail', '').strip()
+        if email:
+            try:
+                # a malformed address would make Mailgun reject the whole batch it is pushed with
+                email = validate_email(email, check_deliverability = False).email
+            except EmailNotValidError:
+                flash('Please enter a valid email address to subscribe.', 'danger')
+            else:
+                subscriptions.subscribe(email, NEWSLETTER_LIST)
+                flash('You have successfully subscribed!', 'success')
         return redirect(url_for('main.home'))
 
 
 @main.route("/about")
+@response_cache.cached()
 def about():
     return render_template('about.html', title = 'About')
 
 
 @main.route("/advertising")
+@response_cache.cached()
 def advertising():
     return render_template('advertising.html', title = 'Advertising')
 
 
 @main.route("/contact")
+@response_cache.cached()
 def contact():
     return render_template('contactus.html', title = 'Contact Us')
 
@@ -93,18 +77,17 @@ def contact():
 @main.route("/admin")
 @admin_required
 def admin():
-    pass
+    return redirect(request.path + '/')  # the admin site, see flaskblog/admin.py
 
 
 @main.route('/search_results/<query>')
 # @login_required
 def search_results(query):
-    print(query)
     page = request.args.get('page', 1, type = int)
-    query_formatted = "%{}%".format(query)
-    query_test = Post.query.filter(or_(Post.title.like(query_formatted), Post.content.like(query_formatted)))
+    posts = search_posts(query, page, current_app.config['FLASKY_POSTS_PER_PAGE'],
+                         current_app.config['MAX_SEARCH_RESULTS'])
 
-    return render_template('search_results.html', posts = query_test, query = query)
+    return render_template('search_results.html', posts = posts, query = query)
 
 
 @main.route('/search', methods = ['POST'])
@@ -124,13 +107,13 @@ def adscontact():
         message = request.form['message']
         subject = 'Ads Enquiry - ' + name
         msg = Message(subject = subject,
-                      sender = (name, app.config['MAIL_USERNAME']),
+                      sender = (name, current_app.config['MAIL_USERNAME']),
                       recipients = ['ads@afridevsforum.com'])
         message_body = message + '\n\nContact: ' + ad_email
         msg.body = message_body
-        mail.send(msg)
+        outbox.enqueue(msg)
         flash('Thank you for showing interest in advertising, our team will contact you!', 'success')
-        return redirect(url_for('home.advertising'))
+        return redirect(url_for('main.advertising'))
 
 
 @main.route("/contactnow", methods = ["GET", "POST"])
@@ -141,11 +124,11 @@ def contactnow():
         message = request.form['message']
         subject = request.form['subject']
         msg = Message(subject = subject,
-                      sender = (name, app.config['MAIL_USERNAME']),
+                      sender = (name, current_app.config['MAIL_USERNAME']),
                       recipients = ['info@afridevsforum.com'])
         message_body = message + '\n\nContact: ' + c_email
         msg.body = message_body
-        mail.send(msg)
+        outbox.enqueue(msg)
         flash('Your message has been sent, our team will contact you!', 'success')
         return redirect(url_for('main.contact'))
 
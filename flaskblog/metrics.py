@@ -0,0 +1,405 @@
+"""
+Request instrumentation.
+
+Every request records its latency, the number and total time of its SQL statements, the time spent
+rendering templates and in outbound HTTP calls, labelled by endpoint. The numbers are kept in memory
+and served in the Prometheus text format at ``/metrics`` to requests carrying
+``Authorization: Bearer <METRICS_TOKEN>`` or signed in administrators.
+
+With ``METRICS_DIR`` set (``flaskblog.serve`` sets it when it runs several workers) every process also
+writes its numbers to that directory, at most ``METRICS_DUMP_INTERVAL`` seconds apart and when it
+exits. A scrape adds up all of them, so the totals do not depend on which worker answers it. The
+numbers of workers that exited are folded into one file by the master, so counters never go back.
+
+Requests slower than ``METRICS_SLOW_REQUEST`` seconds are logged to the ``flaskblog.metrics`` logger
+with their slowest SQL statements.
+
+Outbound HTTP is timed by adding ``metrics.record_http`` to the response hooks of a requests session.
+"""
+import bisect
+import hmac
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+from flask import Response, abort, current_app, g, has_request_context, request
+from flask import before_render_template, request_finished, request_started, template_rendered
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+STATEMENTS_KEPT = 200  # per request, for the slow request log
+STATEMENT_LOG_LENGTH = 1000  # characters
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(names, values, extra = ()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join('{}="{}"'.format(name, value) for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help, labels = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def combine(total, values):
+        """Adds the ``values`` of a snapshot to ``total``."""
+        for label_values, value in values.items():
+            total[label_values] = total.get(label_values, 0) + value
+
+    def samples(self, values = None):
+        values = sorted((self.snapshot() if values is None else values).items())
+        for label_values, value in values:
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Histogram(Counter):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1  # le is inclusive
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *label_values):
+        series = self._values.get(label_values)
+        return series[2] if series else 0
+
+    def sum(self, *label_values):
+        series = self._values.get(label_values)
+        return series[1] if series else 0.0
+
+    def snapshot(self):
+        with self._lock:
+            return {key: [list(series[0])] + series[1:] for key, series in self._values.items()}
+
+    @staticmethod
+    def combine(total, values):
+        for label_values, (counts, value_sum, count) in values.items():
+            series = total.get(label_values)
+            if series is None:
+                total[label_values] = [list(counts), value_sum, count]
+            else:
+                series[0] = [a + b for a, b in zip(series[0], counts)]
+                series[1] += value_sum
+                series[2] += count
+
+    def samples(self, values = None):
+        values = sorted((self.snapshot() if values is None else values).items())
+        for label_values, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else _format_value(float(bound))
+                yield self.name + '_bucket', _format_labels(self.labels, label_values, [('le', le)]), cumulative
+            yield self.name + '_sum', _format_labels(self.labels, label_values), total
+            yield self.name + '_count', _format_labels(self.labels, label_values), count
+
+
+class MetricsRegistry(object):
+    """The metrics of this process."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def clear(self):
+        for metric in self._metrics:
+            metric.clear()
+
+    def snapshot(self):
+        """Plain, picklable copy of every value: ``{metric name: {label values: value}}``."""
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+    def combine(self, total, snapshot):
+        """Adds ``snapshot`` to the snapshot ``total``, returns ``total``."""
+        for metric in self._metrics:
+            if metric.name in snapshot:
+                metric.combine(total.setdefault(metric.name, {}), snapshot[metric.name])
+        return total
+
+    def render(self, others = ()):
+        """The text exposition of this process's values plus the snapshots in ``others``."""
+        total = self.snapshot()
+        for snapshot in others:
+            self.combine(total, snapshot)
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            lines.extend('{}{} {}'.format(name, labels, _format_value(value))
+                         for name, labels, value in metric.samples(total.get(metric.name, {})))
+        return '\n'.join(lines) + '\n'
+
+
+class SharedMetrics(object):
+    """
+    The snapshots of the processes serving one app, one ``<pid>.pickle`` per live process plus
+    ``retired.pickle`` holding the sum of those that exited and the pids already added to it.
+    """
+    RETIRED = 'retired.pickle'
+    RETIRED_PIDS_KEPT = 1000
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, pid):
+        return os.path.join(self.directory, '{}.pickle'.format(pid))
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _write(self, path, value):
+        fd, tmp = tempfile.mkstemp(dir = self.directory, suffix = '.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def dump(self, registry):
+        self._write(self._path(os.getpid()), registry.snapshot())
+
+    def load(self, exclude_pid = None):
+        """The snapshots of every other process, live or exited."""
+        live = {}
+        for entry in os.scandir(self.directory):
+            name, _, extension = entry.name.partition('.')
+            if extension == 'pickle' and name.isdigit() and int(name) != exclude_pid:
+                live[int(name)] = self._read(entry.path)
+        # read after the live files: a pid retired in between is then in here and skipped below
+        retired = self._read(os.path.join(self.directory, self.RETIRED)) or dict(snapshot = {}, pids = [])
+        return [snapshot for pid, snapshot in live.items() if snapshot and pid not in retired['pids']] \
+            + [retired['snapshot']]
+
+    def retire(self, registry, pid):
+        """Folds the snapshot of the exited process ``pid`` into the retired totals, called by the master."""
+        snapshot = self._read(self._path(pid))
+        if snapshot is None:
+            return
+        path = os.path.join(self.directory, self.RETIRED)
+        retired = self._read(path) or dict(snapshot = {}, pids = [])
+        registry.combine(retired['snapshot'], snapshot)
+        retired['pids'] = (retired['pids'] + [pid])[-self.RETIRED_PIDS_KEPT:]
+        self._write(path, retired)  # before the unlink, so a scrape never misses it
+        os.unlink(self._path(pid))
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(('.pickle', '.tmp')):
+                os.unlink(entry.path)
+
+
+class RequestStats(object):
+    """What one request spent its time on, kept in ``g.request_stats``."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statement_count = 0
+        self.sql_time = 0.0
+        self.statements = []  # (seconds, statement), the first STATEMENTS_KEPT
+        self.template_time = 0.0
+        self.template_starts = []
+        self.http_time = 0.0
+
+
+class Metrics(object):
+    """Flask extension, collects into the process wide ``registry``."""
+
+    def __init__(self, app = None):
+        self.registry = MetricsRegistry()
+        self.requests = self.registry.register(Counter(
+            'flaskblog_requests_total', 'Requests handled.', ('endpoint', 'method', 'status')))
+        self.request_seconds = self.registry.register(Histogram(
+            'flaskblog_request_duration_seconds', 'Time from dispatch to response.', ('endpoint', 'method')))
+        self.sql_statements = self.registry.register(Histogram(
+            'flaskblog_request_sql_statements', 'SQL statements per request.', ('endpoint',), COUNT_BUCKETS))
+        self.sql_seconds = self.registry.register(Histogram(
+            'flaskblog_request_sql_seconds', 'Time per request spent in SQL statements.', ('endpoint',)))
+        self.template_seconds = self.registry.register(Histogram(
+            'flaskblog_template_render_seconds', 'Time spent rendering each template.', ('template',)))
+        self.http_seconds = self.registry.register(Histogram(
+            'flaskblog_http_client_seconds', 'Outbound HTTP calls, until the response headers arrived.',
+            ('host', 'status')))
+        self.slow_requests = self.registry.register(Counter(
+            'flaskblog_slow_requests_total', 'Requests slower than METRICS_SLOW_REQUEST.', ('endpoint',)))
+        self._next_dump = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_TOKEN', None)  # bearer token for the scraper, administrators need none
+        app.config.setdefault('METRICS_SLOW_REQUEST', 1.0)  # seconds, 0 logs nothing
+        app.config.setdefault('METRICS_SLOW_REQUEST_STATEMENTS', 5)  # slowest statements shown in the log
+        app.config.setdefault('METRICS_DIR', None)  # shared by the processes serving the app, see above
+        app.config.setdefault('METRICS_DUMP_INTERVAL', 5)  # seconds
+        app.extensions['metrics'] = self
+        app.add_url_rule('/metrics', 'metrics', self.view)
+        if not app.config['METRICS_ENABLED']:
+            return
+        request_started.connect(self.request_started, app)
+        request_finished.connect(self.request_finished, app)
+        before_render_template.connect(self.before_render_template, app)
+        template_rendered.connect(self.template_rendered, app)
+
+    @staticmethod
+    def _stats():
+        return g.get('request_stats') if has_request_context() else None
+
+    def request_started(self, app, **extra):
+        g.request_stats = RequestStats()
+
+    def request_finished(self, app, response, **extra):
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return
+        elapsed = time.perf_counter() - stats.start
+        endpoint = request.endpoint or 'none'
+        self.requests.inc(endpoint, request.method, response.status_code)
+        self.request_seconds.observe(elapsed, endpoint, request.method)
+        self.sql_statements.observe(stats.statement_count, endpoint)
+        self.sql_seconds.observe(stats.sql_time, endpoint)
+        threshold = app.config['METRICS_SLOW_REQUEST']
+        if threshold and elapsed >= threshold:
+            self.slow_requests.inc(endpoint)
+            self.log_slow_request(app, endpoint, elapsed, stats)
+        if app.config['METRICS_DIR'] and time.monotonic() >= self._next_dump:
+            self._next_dump = time.monotonic() + app.config['METRICS_DUMP_INTERVAL']
+            self.dump(app)
+
+    def dump(self, app):
+        """Writes this process's numbers to ``METRICS_DIR`` for the other processes' scrapes."""
+        if app.config['METRICS_DIR']:
+            SharedMetrics(app.config['METRICS_DIR']).dump(self.registry)
+
+    @staticmethod
+    def log_slow_request(app, endpoint, elapsed, stats):
+        lines = ['Slow request: {} {} ({}) {:.0f} ms, {} SQL statement(s) in {:.0f} ms, templates {:.0f} ms, '
+                 'outbound HTTP {:.0f} ms'.format(request.method, request.full_path.rstrip('?'), endpoint,
+                                                  elapsed * 1000, stats.statement_count, stats.sql_time * 1000,
+                                                  stats.template_time * 1000, stats.http_time * 1000)]
+        slowest = sorted(stats.statements, key = lambda item: -item[0])
+        for seconds, statement in slowest[:app.config['METRICS_SLOW_REQUEST_STATEMENTS']]:
+            statement = ' '.join(statement.split())[:STATEMENT_LOG_LENGTH]
+            lines.append('  {:8.1f} ms  {}'.format(seconds * 1000, statement))
+        logger.warning('\n'.join(lines))
+
+    def before_render_template(self, app, template, context, **extra):
+        stats = self._stats()
+        if stats is not None:
+            stats.template_starts.append(time.perf_counter())
+
+    def template_rendered(self, app, template, context, **extra):
+        stats = self._stats()
+        if stats is None or not stats.template_starts:
+            return
+        elapsed = time.perf_counter() - stats.template_starts.pop()
+        self.template_seconds.observe(elapsed, template.name or 'string')
+        if not stats.template_starts:  # included templates are part of their parent's time
+            stats.template_time += elapsed
+
+    def record_sql(self, statement, seconds):
+        stats = self._stats()
+        if stats is None:
+            return
+        stats.statement_count += 1
+        stats.sql_time += seconds
+        if len(stats.statements) < STATEMENTS_KEPT:
+            stats.statements.append((seconds, statement))
+
+    def record_http(self, response, *args, **kwargs):
+        """A requests response hook: ``session.hooks['response'].append(metrics.record_http)``."""
+        seconds = response.elapsed.total_seconds()
+        self.http_seconds.observe(seconds, urlsplit(response.url).hostname or 'unknown', response.status_code)
+        stats = self._stats()
+        if stats is not None:
+            stats.http_time += seconds
+
+    def view(self):
+        token = current_app.config['METRICS_TOKEN']
+        authorization = request.headers.get('Authorization', '').encode('utf-8')
+        scraper = token and hmac.compare_digest(authorization, 'Bearer {}'.format(token).encode('utf-8'))
+        if not (scraper or current_user.is_authenticated and current_user.is_administrator()):
+            abort(403)
+        directory = current_app.config['METRICS_DIR']
+        others = SharedMetrics(directory).load(exclude_pid = os.getpid()) if directory else ()
+        return Response(self.registry.render(others), content_type = CONTENT_TYPE)
+
+
+metrics = Metrics()
+
+
+# Statement timing for every engine, statements outside a request are not counted.
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('metrics_query_start')
+    if starts:
+        metrics.record_sql(statement, time.perf_counter() - starts.pop())
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(exception_context):
+    starts = exception_context.connection.info.get('metrics_query_start') if exception_context.connection else None
+    if starts:
+        starts.pop()
@@ -1,18 +1,15 @@
 import re
+import time
 from datetime import datetime
 
-import bleach
 from flask import current_app
-from flask_admin import expose, AdminIndexView, Admin
-from flask_admin.contrib.sqla import ModelView
 # UserMixin is a class that we inherit from the required methods & attributes used in managing login sessions
 from flask_login import UserMixin, AnonymousUserMixin
-from flask_login import current_user
 # Serializer will be used for generating tokens for 'Forgot Password'
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-from markdown import markdown
 
 from flaskblog import db, login_manager
+from flaskblog.rendering import render_post, render_comment
 
 
 class Permission:
@@ -52,6 +49,53 @@ class Role(db.Model):
         db.session.commit()
 
 
+class RolePermissions(object):
+    """
+    Per app, process wide ``{role_id: permissions}`` map, so permission checks never query the role table.
+
+    Loaded with one query on first use and dropped when a Role change is committed in this process.
+    Other processes pick up role edits after ``ROLE_CACHE_TTL`` seconds, 0 disables the cache.
+    """
+
+    def __init__(self):
+        self._permissions = None
+        self._loaded_at = 0
+
+    def get(self, role_id):
+        permissions = self._permissions
+        if permissions is None or time.monotonic() - self._loaded_at > current_app.config['ROLE_CACHE_TTL']:
+            permissions = dict(db.session.query(Role.id, Role.permissions))
+            self._permissions, self._loaded_at = permissions, time.monotonic()
+        return permissions.get(role_id)
+
+    def clear(self):
+        self._permissions = None
+
+
+def role_permissions():
+    permissions = current_app.extensions.get('role_permissions')
+    if permissions is None:
+        permissions = current_app.extensions.setdefault('role_permissions', RolePermissions())
+    return permissions
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def collect_role_changes(session, flush_context):
+    if any(isinstance(obj, Role) for obj in session.new.union(session.dirty).union(session.deleted)):
+        session.info['roles_changed'] = True
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def clear_role_permissions(session):
+    if session.info.pop('roles_changed', False):
+        role_permissions().clear()
+
+
+@db.event.listens_for(db.session, 'after_soft_rollback')
+def discard_role_changes(session, previous_transaction):
+    session.info.pop('roles_changed', None)
+
+
 class User(db.Model, UserMixin):  # this class is used for creating the database table User
     id = db.Column(db.Integer, primary_key = True)  # id attribute/column that is an integer and primary key
     name = db.Column(db.String(64))
@@ -60,7 +104,7 @@ class User(db.Model, UserMixin):  # this class is used for creating the database
     country = db.Column(db.String(20), nullable = False)
     about_me = db.Column(db.Text())
     member_since = db.Column(db.DateTime, default = datetime.utcnow)
-    image_file = db.Column(db.String(20), nullable = False, default = 'default.jpg')
+    image_file = db.Column(db.String(64), nullable = False, default = 'default.jpg')  # see flaskblog/avatars.py
     password = db.Column(db.String(60), nullable = True)
     confirmed = db.Column(db.Boolean, default = False)
     role_id = db.Column(db.Integer, db.ForeignKey('role.id'))
@@ -77,8 +121,11 @@ class User(db.Model, UserMixin):  # this class is used for creating the database
                 self.role = Role.query.filter_by(default = True).first()
 
     def can(self, permissions):
-        return self.role is not None and \
-               (self.role.permissions & permissions) == permissions
+        if self.role_id is None or not current_app.config['ROLE_CACHE_TTL']:
+            return self.role is not None and \
+                   (self.role.permissions & permissions) == permissions
+        granted = role_permissions().get(self.role_id)  # a bit test against the cached role table
+        return granted is not None and (granted & permissions) == permissions
 
     def is_administrator(self):
         return self.can(Permission.ADMINISTRATOR)
@@ -136,33 +183,55 @@ def load_user(user_id):  # this function gets the user id
 
 
 post_tag = db.Table('post_tag',
-                    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id')),
-                    db.Column('post_id', db.Integer, db.ForeignKey('post.id'))
+                    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key = True),
+                    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key = True),
+                    # the primary key covers "tags of a post", this one "posts with a tag"
+                    db.Index('ix_post_tag_tag_id_post_id', 'tag_id', 'post_id')
                     )
 
 
 class Post(db.Model):
     __searchable__ = ['title', 'content']
+    __table_args__ = (
+        # keyset pagination seeks on (date_posted, id), see flaskblog/pagination.py
+        db.Index('ix_post_date_posted_id', 'date_posted', 'id'),
+        db.Index('ix_post_user_id_date_posted_id', 'user_id', 'date_posted', 'id'),
+    )
     id = db.Column(db.Integer, primary_key = True)
     title = db.Column(db.String(100), nullable = False)
     date_posted = db.Column(db.DateTime, nullable = False, default = datetime.utcnow)
     content = db.Column(db.Text, nullable = False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable = False)  # a foreign key
     tag = db.relationship('Tag', secondary = post_tag, backref = 'post', lazy = 'dynamic')
+    tags = db.relationship('Tag', secondary = post_tag, viewonly = True)  # plain list, can be eager loaded
     comments = db.relationship('Comment', backref = 'post', lazy = 'dynamic')
+    comment_count = db.Column(db.Integer, nullable = False, default = 0, server_default = '0')  # see counters.py
+    # rendered from content when it is set, see flaskblog/rendering.py
+    content_html = db.Column(db.Text)
+    excerpt = db.Column(db.Text)
+    render_version = db.Column(db.String(12))
+
+    @staticmethod
+    def on_changed_content(target, value, oldvalue, initiator):
+        render_post(target, value)
 
     def __repr__(self):
         return f"Post('{self.title}', '{self.date_posted}')"
 
 
+db.event.listen(Post.content, 'set', Post.on_changed_content)
+
+
 def slugify_tag(s):
-    return re.sub('[^\w]+', '-', s).lower()
+    return re.sub(r'[^\w]+', '-', s).strip('-').lower()
 
 
 class Tag(db.Model):
     id = db.Column(db.Integer, primary_key = True)
     name = db.Column(db.String(64))
-    slug = db.Column(db.String(64), unique = False)
+    slug = db.Column(db.String(64), unique = True, nullable = False)  # see flaskblog/tags.py
+    # time decayed post count, kept current by flaskblog/tags.py
+    popularity = db.Column(db.Float, nullable = False, default = 0.0, server_default = '0', index = True)
 
     def __init__(self, *args, **kwargs):
         super(Tag, self).__init__(*args, **kwargs)
@@ -173,9 +242,16 @@ class Tag(db.Model):
 
 
 class Comment(db.Model):
+    __table_args__ = (
+        db.Index('ix_comment_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_comment_post_id_timestamp_id', 'post_id', 'timestamp', 'id'),
+        db.Index('ix_comment_disabled_timestamp_id', 'disabled', 'timestamp', 'id'),  # moderation queue filters
+        db.Index('ix_comment_author_id_timestamp_id', 'author_id', 'timestamp', 'id'),
+    )
     id = db.Column(db.Integer, primary_key = True)
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)
+    render_version = db.Column(db.String(12))
     timestamp = db.Column(db.DateTime, index = True, default = datetime.utcnow)
     disabled = db.Column(db.Boolean)
     author_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -183,10 +259,7 @@ class Comment(db.Model):
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code', 'em', 'i', 'li', 'ol', 'strong', 'ul', 's',
-                        'pre', 'p']
-        target.body_html = bleach.linkify(bleach.clean(markdown(value, output_format = 'html'),
-                                                       tags = allowed_tags, strip = True))
+        render_comment(target, value)
 
     def __repr__(self):
         return f"Comment('{self.body}', '{self.timestamp}')"
@@ -195,20 +268,75 @@ class Comment(db.Model):
 db.event.listen(Comment.body, 'set', Comment.on_changed_body)
 
 
-# Admin site setup
-class MyAdminHome(AdminIndexView):
-    @expose('/')
-    def index(self):
-        if current_user.is_authenticated and current_user.can(Permission.ADMINISTRATOR):
-            return self.render('admin/index.html')
-        else:
-            return self.render('errors/403.html')
+class Counter(db.Model):
+    """Denormalized aggregate counts, kept current by the model events in flaskblog/counters.py"""
+    name = db.Column(db.String(80), primary_key = True)
+    value = db.Column(db.Integer, nullable = False, default = 0)
+
+    def __repr__(self):
+        return f"Counter('{self.name}', {self.value})"
 
 
-admin = Admin(app = current_app, name = 'Afri Devs Forum', template_mode = 'bootstrap3', index_view = MyAdminHome())
+class OutboxMessage(db.Model):
+    """An email waiting to be delivered by the outbox workers, see flaskblog/outbox.py"""
+    __table_args__ = (
+        db.Index('ix_outbox_message_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+    id = db.Column(db.Integer, primary_key = True)
+    subject = db.Column(db.String(255), nullable = False)
+    sender = db.Column(db.String(255))
+    recipients = db.Column(db.Text, nullable = False)  # JSON list
+    reply_to = db.Column(db.String(255))
+    body = db.Column(db.Text)
+    html = db.Column(db.Text)
+    status = db.Column(db.String(10), nullable = False, default = 'pending')  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable = False, default = 0)
+    last_error = db.Column(db.Text)
+    claim = db.Column(db.String(32), index = True)  # workers fetch their claimed batch by it
+    created_at = db.Column(db.DateTime, nullable = False, default = datetime.utcnow)
+    next_attempt_at = db.Column(db.DateTime, nullable = False, default = datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
 
-admin.add_view(ModelView(User, db.session))
-admin.add_view(ModelView(Post, db.session))
-admin.add_view(ModelView(Tag, db.session))
-admin.add_view(ModelView(Comment, db.session))
-admin.add_view(ModelView(Role, db.session))
+    def __repr__(self):
+        return f"OutboxMessage('{self.subject}', '{self.status}', {self.attempts})"
+
+
+class ListSubscription(db.Model):
+    """A pending Mailgun mailing list signup, see flaskblog/subscriptions.py"""
+    __table_args__ = (
+        db.Index('ix_list_subscription_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+    id = db.Column(db.Integer, primary_key = True)
+    list_address = db.Column(db.String(120), nullable = False)
+    email = db.Column(db.String(120), nullable = False)
+    status = db.Column(db.String(10), nullable = False, default = 'pending')  # pending, sending, done, failed
+    attempts = db.Column(db.Integer, nullable = False, default = 0)
+    last_error = db.Column(db.Text)
+    claim = db.Column(db.String(32), index = True)  # workers fetch their claimed batch by it
+    created_at = db.Column(db.DateTime, nullable = False, default = datetime.utcnow)
+    next_attempt_at = db.Column(db.DateTime, nullable = False, default = datetime.utcnow)
+
+    def __repr__(self):
+        return f"ListSubscription('{self.email}', '{self.list_address}', '{self.status}')"
+
+
+class AvatarJob(db.Model):
+    """An uploaded profile picture waiting to be resized by the avatar workers, see flaskblog/avatars.py"""
+    __table_args__ = (
+        db.Index('ix_avatar_job_status_next_attempt_at', 'status', 'next_attempt_at'),
+        db.Index('ix_avatar_job_user_id_id', 'user_id', 'id'),  # newer uploads of the same user
+    )
+    id = db.Column(db.Integer, primary_key = True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable = False)
+    upload = db.Column(db.String(80), nullable = False)  # file name in AVATAR_UPLOAD_DIR
+    status = db.Column(db.String(10), nullable = False, default = 'pending')  # pending, working, done, failed
+    attempts = db.Column(db.Integer, nullable = False, default = 0)
+    last_error = db.Column(db.Text)
+    claim = db.Column(db.String(32), index = True)  # workers fetch their claimed batch by it
+    created_at = db.Column(db.DateTime, nullable = False, default = datetime.utcnow)
+    next_attempt_at = db.Column(db.DateTime, nullable = False, default = datetime.utcnow)
+
+    user = db.relationship('User')
+
+    def __repr__(self):
+        return f"AvatarJob('{self.user_id}', '{self.upload}', '{self.status}')"
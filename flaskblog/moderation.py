@@ -0,0 +1,46 @@
+from sqlalchemy.orm import joinedload
+
+from flaskblog import db
+from flaskblog.caching import invalidate_on_commit
+from flaskblog.models import Comment, User
+from flaskblog.pagination import paginate_keyset
+
+MODERATION_STATUSES = ('all', 'new', 'approved', 'disabled')  # new: not looked at by a moderator yet
+UPDATE_CHUNK = 500  # ids per UPDATE, below SQLite's limit on bound parameters
+
+
+def moderation_queue(page, per_page, status = 'all', author = None, post_id = None, after = None, before = None):
+    """Comments newest first, each filter is served by one of the (..., timestamp, id) indexes on comment."""
+    query = Comment.query.options(joinedload(Comment.author))
+    if status == 'new':
+        query = query.filter(Comment.disabled.is_(None))
+    elif status == 'approved':
+        query = query.filter(Comment.disabled == db.false())
+    elif status == 'disabled':
+        query = query.filter(Comment.disabled == db.true())
+    if author:
+        query = query.filter(Comment.author_id == db.session.query(User.id).filter_by(username = author).as_scalar())
+    if post_id:
+        query = query.filter(Comment.post_id == post_id)
+    return paginate_keyset(query, (Comment.timestamp, Comment.id), page, per_page, after = after, before = before,
+                           error_out = False)
+
+
+def set_comments_disabled(ids, disabled):
+    """
+    Enables or disables the comments with ``ids`` using UPDATE ... WHERE id IN (...) and commits, returns
+    how many comments changed. The pages of the posts they belong to are invalidated by the commit.
+    """
+    ids = sorted(set(ids))
+    changed = 0
+    post_ids = set()
+    for start in range(0, len(ids), UPDATE_CHUNK):
+        # rows already in the wanted state are left alone, so they do not evict anything either
+        rows = Comment.query.filter(Comment.id.in_(ids[start:start + UPDATE_CHUNK]),
+                                    db.or_(Comment.disabled.is_(None), Comment.disabled != disabled))
+        post_ids.update(post_id for post_id, in rows.with_entities(Comment.post_id).distinct())
+        changed += rows.update({'disabled': disabled}, synchronize_session = False)
+    # bulk updates skip the flush events the response cache listens to
+    invalidate_on_commit(db.session, ['post:{}'.format(post_id) for post_id in post_ids if post_id is not None])
+    db.session.commit()
+    return changed
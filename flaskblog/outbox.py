@@ -0,0 +1,202 @@
+import json
+import logging
+import secrets
+import smtplib
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from email.utils import formataddr
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from flask_mail import Message
+
+from flaskblog import db, mail
+from flaskblog.models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+outbox_cli = AppGroup('outbox', help = 'Deliver the queued outgoing email.')
+
+# errors that mean the SMTP connection itself is gone, the rest of the batch is retried later
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, smtplib.SMTPAuthenticationError,
+                     ConnectionError, TimeoutError, socket.gaierror)
+
+
+def _address(value):
+    if isinstance(value, (tuple, list)):
+        return formataddr(tuple(value))
+    return value
+
+
+class MailOutbox(object):
+    """
+    Durable outgoing mail queue.
+
+    ``enqueue`` stores the message in the ``outbox_message`` table and returns straight away. A fixed
+    number of worker threads (``MAIL_OUTBOX_WORKERS``, started on the first enqueue) drain the table in
+    batches, sending each batch over a single SMTP connection. Failed messages are retried with
+    exponential backoff until ``MAIL_OUTBOX_MAX_ATTEMPTS``. Set ``MAIL_OUTBOX_WORKERS`` to 0 and run
+    ``flask outbox worker`` to deliver from a separate process instead.
+    """
+
+    def __init__(self, app = None):
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MAIL_OUTBOX_WORKERS', 2)
+        app.config.setdefault('MAIL_OUTBOX_BATCH_SIZE', 20)
+        app.config.setdefault('MAIL_OUTBOX_MAX_ATTEMPTS', 5)
+        app.config.setdefault('MAIL_OUTBOX_RETRY_DELAY', 30)  # seconds, doubled after every failure
+        app.config.setdefault('MAIL_OUTBOX_POLL_INTERVAL', 15)
+        app.config.setdefault('MAIL_OUTBOX_LEASE', 300)  # a claimed batch is retried if not done by then
+        app.extensions['outbox'] = self
+
+    def enqueue(self, msg):
+        """Persists a flask_mail Message for delivery, commits the current session."""
+        row = OutboxMessage(subject = msg.subject,
+                            sender = _address(msg.sender or current_app.config.get('MAIL_DEFAULT_SENDER')),
+                            recipients = json.dumps([_address(r) for r in msg.recipients]),
+                            reply_to = _address(msg.reply_to),
+                            body = msg.body,
+                            html = msg.html)
+        db.session.add(row)
+        db.session.commit()
+        if current_app.config['MAIL_OUTBOX_WORKERS']:
+            self.start_workers(current_app._get_current_object(), current_app.config['MAIL_OUTBOX_WORKERS'])
+            self._wakeup.set()
+        return row
+
+    def start_workers(self, app, count):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            for i in range(len(self._threads), count):
+                thread = threading.Thread(target = self.run_worker, args = [app],
+                                          name = 'mail-outbox-{}'.format(i), daemon = True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def run_worker(self, app):
+        while not self._stop.is_set():
+            try:
+                with app.app_context():
+                    processed = self.process_batch()
+            except Exception:
+                logger.exception('Mail outbox worker failed')
+                processed = 0
+            if not processed:
+                self._wakeup.wait(app.config['MAIL_OUTBOX_POLL_INTERVAL'])
+                self._wakeup.clear()
+
+    def claim_batch(self):
+        """Marks up to MAIL_OUTBOX_BATCH_SIZE due messages as ours and returns them."""
+        config = current_app.config
+        now = datetime.utcnow()
+        token = secrets.token_hex(16)
+        due = db.and_(OutboxMessage.status.in_(['pending', 'sending']), OutboxMessage.next_attempt_at <= now)
+        ids = db.session.query(OutboxMessage.id).filter(due) \
+            .order_by(OutboxMessage.next_attempt_at, OutboxMessage.id) \
+            .limit(config['MAIL_OUTBOX_BATCH_SIZE']) \
+            .subquery()
+        # ``due`` is repeated so a row claimed by another worker in the meantime is skipped
+        OutboxMessage.query.filter(OutboxMessage.id.in_(db.session.query(ids.c.id)), due) \
+            .update({'status': 'sending', 'claim': token,
+                     'next_attempt_at': now + timedelta(seconds = config['MAIL_OUTBOX_LEASE'])},
+                    synchronize_session = False)
+        db.session.commit()
+        return OutboxMessage.query.filter_by(claim = token).order_by(OutboxMessage.id).all()
+
+    def process_batch(self):
+        """Sends one batch over a single SMTP connection, returns the number of messages handled."""
+        batch = self.claim_batch()
+        if not batch:
+            return 0
+        try:
+            with mail.connect() as connection:
+                for row in batch:
+                    try:
+                        connection.send(self.build_message(row))
+                    except CONNECTION_ERRORS:
+                        raise
+                    except Exception as e:  # this message only, e.g. a refused recipient or a bad header
+                        logger.warning('Could not send %r: %r', row, e)
+                        self._failed(row, e)
+                    else:
+                        row.status = 'sent'
+                        row.sent_at = datetime.utcnow()
+                        row.claim = None
+        except CONNECTION_ERRORS as e:
+            logger.warning('SMTP connection failed, retrying the rest of the batch later: %s', e)
+            for row in batch:
+                if row.status == 'sending':
+                    self._failed(row, e)
+        except Exception as e:
+            # anything else (an SMTP error while signing in, ...) must still count as an attempt, or the
+            # rows would be claimed again after every lease without ever giving up
+            logger.exception('Sending the batch failed, retrying the rest of it later')
+            for row in batch:
+                if row.status == 'sending':
+                    self._failed(row, e)
+        db.session.commit()
+        return len(batch)
+
+    def _failed(self, row, error):
+        config = current_app.config
+        row.attempts += 1
+        row.last_error = repr(error)[:1000]
+        row.claim = None
+        if row.attempts >= config['MAIL_OUTBOX_MAX_ATTEMPTS']:
+            row.status = 'failed'
+            logger.error('Giving up on %r: %s', row, row.last_error)
+        else:
+            row.status = 'pending'
+            delay = config['MAIL_OUTBOX_RETRY_DELAY'] * 2 ** (row.attempts - 1)
+            row.next_attempt_at = datetime.utcnow() + timedelta(seconds = delay)
+
+    @staticmethod
+    def build_message(row):
+        return Message(subject = row.subject,
+                       sender = row.sender,
+                       recipients = json.loads(row.recipients),
+                       reply_to = row.reply_to,
+                       body = row.body,
+                       html = row.html)
+
+
+outbox = MailOutbox()
+
+
+@outbox_cli.command('worker')
+@click.option('--workers', default = None, type = int, help = 'Number of worker threads.')
+@click.option('--once', is_flag = True, help = 'Drain what is due and exit.')
+def worker_command(workers, once):
+    """Deliver queued email until interrupted."""
+    if once:
+        total = 0
+        while True:
+            processed = outbox.process_batch()
+            if not processed:
+                break
+            total += processed
+        click.echo('Processed {} message(s).'.format(total))
+        return
+    app = current_app._get_current_object()
+    workers = workers or app.config['MAIL_OUTBOX_WORKERS'] or 1
+    click.echo('Delivering mail with {} worker(s), press CTRL+C to quit.'.format(workers))
+    outbox.start_workers(app, workers)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        outbox.stop()
@@ -0,0 +1,142 @@
+import base64
+from datetime import datetime
+
+from flask import abort, current_app
+from sqlalchemy import tuple_
+
+
+def encode_cursor(values):
+    """Turns the sort key of a row, e.g. ``(date_posted, id)``, into an opaque url safe string."""
+    parts = [v.isoformat() if isinstance(v, datetime) else str(v) for v in values]
+    return base64.urlsafe_b64encode('~'.join(parts).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Reverses encode_cursor for a ``(datetime, int)`` sort key, aborts with a 404 on garbage."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        moment, row_id = base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8').split('~')
+        return datetime.fromisoformat(moment), int(row_id)
+    except (ValueError, TypeError, UnicodeError):
+        abort(404)
+
+
+class KeysetPagination(object):
+    """
+    Seek ("keyset") pagination over a ``(timestamp, id)`` sort key.
+
+    The first ``max_offset_pages`` pages are still addressed by page number (a short OFFSET is cheap),
+    anything deeper is reached through the ``after`` / ``before`` cursors, which turn into a
+    ``WHERE (timestamp, id) < (:t, :id)`` seek on the composite index. A deeper page number without a
+    cursor is a 404 (page 1 with ``error_out = False``), so no request can ask for a long OFFSET scan.
+    No COUNT query is issued, one extra row is fetched instead to find out whether there is a next page.
+
+    The attributes mirror Flask-SQLAlchemy's Pagination so templates only need small changes,
+    except that ``total`` and ``pages`` are unknown (None).
+    """
+
+    def __init__(self, query, columns, page = 1, per_page = 20, after = None, before = None, last = False,
+                 descending = True, max_offset_pages = 5, error_out = True):
+        self.columns = columns
+        self.per_page = per_page
+        self.max_offset_pages = max_offset_pages
+        self.descending = descending
+        self.total = None
+        self.pages = None
+        self.page = page if page and page > 0 else None
+
+        key = tuple_(*columns)
+        forward = [c.desc() if descending else c.asc() for c in columns]
+        backward = [c.asc() if descending else c.desc() for c in columns]
+
+        if after:
+            bound = tuple_(*decode_cursor(after))
+            rows = query.filter(key < bound if descending else key > bound) \
+                .order_by(*forward).limit(per_page + 1).all()
+            self.has_next = len(rows) > per_page
+            self.items = rows[:per_page]
+            self.has_prev = True
+        elif before or last:
+            if before:
+                bound = tuple_(*decode_cursor(before))
+                query = query.filter(key > bound if descending else key < bound)
+            rows = query.order_by(*backward).limit(per_page + 1).all()
+            self.has_prev = len(rows) > per_page
+            self.items = list(reversed(rows[:per_page]))
+            self.has_next = bool(before)
+            if not self.has_prev:
+                self.page = 1
+        else:
+            page = self.page or 1
+            if page > max_offset_pages:
+                if error_out:
+                    abort(404)
+                page = 1
+            self.page = page
+            rows = query.order_by(*forward).offset((page - 1) * per_page).limit(per_page + 1).all()
+            if not rows and page != 1 and error_out:
+                abort(404)
+            self.has_next = len(rows) > per_page
+            self.items = rows[:per_page]
+            self.has_prev = page > 1
+
+    def _key(self, item):
+        return tuple(getattr(item, c.key) for c in self.columns)
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self._key(self.items[-1])) if self.items else None
+
+    @property
+    def prev_cursor(self):
+        return encode_cursor(self._key(self.items[0])) if self.items else None
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.page and self.has_next else None
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.page and self.has_prev else None
+
+    def next_args(self):
+        """Query string arguments for the next page."""
+        if not self.has_next:
+            return None
+        if self.next_num and self.next_num <= self.max_offset_pages:
+            return dict(page = self.next_num)
+        return dict(page = self.next_num, after = self.next_cursor)
+
+    def prev_args(self):
+        """Query string arguments for the previous page."""
+        if not self.has_prev:
+            return None
+        if self.prev_num and self.prev_num <= self.max_offset_pages:
+            return dict(page = self.prev_num)
+        return dict(page = self.prev_num, before = self.prev_cursor)
+
+    def iter_pages(self, left_edge = 2, left_current = 2, right_current = 5, right_edge = 2):
+        """
+        Yields the page numbers that can be linked to directly, i.e. the shallow pages reachable by
+        OFFSET that are known to exist. ``right_edge`` is accepted for compatibility, the last page is
+        unknown without a count.
+        """
+        if self.page is None:
+            return
+        known = self.page + 1 if self.has_next else self.page
+        last = min(known, self.max_offset_pages, self.page + right_current)
+        current = self.page if self.page <= self.max_offset_pages else None
+        shown = None
+        for num in range(1, last + 1):
+            if num <= left_edge or (current and current - left_current - 1 < num):
+                if shown is not None and num - shown > 1:
+                    yield None
+                yield num
+                shown = num
+
+
+def paginate_keyset(query, columns, page, per_page, after = None, before = None, last = False,
+                    descending = True, error_out = True):
+    return KeysetPagination(query, columns, page = page, per_page = per_page, after = after, before = before,
+                            last = last, descending = descending,
+                            max_offset_pages = current_app.config['FLASKY_MAX_OFFSET_PAGES'], error_out = error_out)
@@ -0,0 +1,187 @@
+"""
+Password hashing off the request threads.
+
+bcrypt is slow on purpose (about 250ms at the default cost), so hashes are computed by a small pool of
+worker processes (``PASSWORD_HASH_WORKERS``). A request waits at most ``PASSWORD_HASH_WAIT`` seconds for
+one of the ``PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE`` slots, and every client address and account
+may only have a few hashes in flight at once. A burst of sign in attempts therefore gets 429 responses
+instead of every web worker. Hashes made with another ``BCRYPT_LOG_ROUNDS`` are replaced on the next
+successful sign in.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+from flask import current_app
+
+MAX_PASSWORD_BYTES = 72  # bcrypt only reads this much, recent versions of the library refuse longer input
+
+
+class PasswordHashingBusy(Exception):
+    """The pool, or the caller's share of it, is full. Shown to the user as a 429."""
+
+
+# These run in the worker processes, so they only get plain arguments.
+
+def _encode(password):
+    return password.encode('utf-8')[:MAX_PASSWORD_BYTES]
+
+
+def hash_password(password, rounds):
+    return bcrypt.hashpw(_encode(password), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def check_password(pw_hash, password, rounds = None):
+    """
+    Returns ``(matches, new hash or None)``. With ``rounds`` a matching hash made with another cost is
+    recomputed in the same call.
+    """
+    try:
+        matches = bcrypt.checkpw(_encode(password), pw_hash.encode('utf-8'))
+    except ValueError:  # not a bcrypt hash
+        return False, None
+    if matches and rounds and hash_rounds(pw_hash) != rounds:
+        return True, hash_password(password, rounds)
+    return matches, None
+
+
+def hash_rounds(pw_hash):
+    """The cost a hash was made with, '$2b$12$...' -> 12."""
+    try:
+        return int(pw_hash.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class ConcurrencyLimiter(object):
+    """Hashes in flight per key (client address, account) within this process."""
+
+    def __init__(self):
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, limits):
+        """``limits`` maps keys to their limit, takes a slot on all of them or on none."""
+        with self._lock:
+            if any(self._in_flight.get(key, 0) >= limit for key, limit in limits.items()):
+                return False
+            for key in limits:
+                self._in_flight[key] = self._in_flight.get(key, 0) + 1
+            return True
+
+    def release(self, keys):
+        with self._lock:
+            for key in keys:
+                count = self._in_flight.pop(key) - 1
+                if count:
+                    self._in_flight[key] = count
+
+
+class _HashingPool(object):
+    """Per app state: the slots, the limiter and the worker processes, started on first use."""
+
+    def __init__(self, config):
+        self.workers = config['PASSWORD_HASH_WORKERS']
+        self.slots = threading.BoundedSemaphore(max(self.workers, 1) + config['PASSWORD_HASH_QUEUE'])
+        self.limiter = ConcurrencyLimiter()
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def executor(self):
+        if not self.workers:
+            return None
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():  # not shared with forked servers
+                # spawned rather than forked, the web process has threads (outbox, geolocation, ...)
+                self._executor = ProcessPoolExecutor(self.workers, mp_context = multiprocessing.get_context('spawn'))
+                self._pid = os.getpid()
+            return self._executor
+
+    def discard(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait = False)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+class PasswordHasher(object):
+    """Flask extension, the pool lives in ``app.extensions['password_hasher']``."""
+
+    def __init__(self, app = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)  # same setting as flask-bcrypt
+        app.config.setdefault('PASSWORD_HASH_WORKERS', 2)  # 0 hashes on the request thread
+        app.config.setdefault('PASSWORD_HASH_QUEUE', 8)  # requests allowed to wait for a busy pool
+        app.config.setdefault('PASSWORD_HASH_WAIT', 2)  # seconds
+        app.config.setdefault('PASSWORD_HASH_PER_CLIENT', 2)
+        app.config.setdefault('PASSWORD_HASH_PER_ACCOUNT', 1)
+        app.extensions['password_hasher'] = _HashingPool(app.config)
+
+    @property
+    def pool(self):
+        return current_app.extensions['password_hasher']
+
+    def _limits(self, client, account):
+        config = current_app.config
+        limits = {}
+        if client:
+            limits['client:' + client] = config['PASSWORD_HASH_PER_CLIENT']
+        if account:
+            limits['account:' + account.strip().lower()] = config['PASSWORD_HASH_PER_ACCOUNT']
+        return limits
+
+    def _run(self, function, args, client, account):
+        pool = self.pool
+        limits = self._limits(client, account)
+        if not pool.limiter.acquire(limits):
+            raise PasswordHashingBusy('Too many password checks in flight for this client or account')
+        try:
+            if not pool.slots.acquire(timeout = current_app.config['PASSWORD_HASH_WAIT']):
+                raise PasswordHashingBusy('Every password hashing slot is taken')
+            try:
+                executor = pool.executor()
+                if executor is None:
+                    return function(*args)
+                try:
+                    return executor.submit(function, *args).result()
+                except BrokenProcessPool:  # a worker died, start over with a fresh pool next time
+                    pool.discard(executor)
+                    return function(*args)
+            finally:
+                pool.slots.release()
+        finally:
+            pool.limiter.release(limits)
+
+    def hash(self, password, client = None, account = None):
+        """bcrypt hash of ``password`` at the configured cost."""
+        return self._run(hash_password, (password, current_app.config['BCRYPT_LOG_ROUNDS']), client, account)
+
+    def verify(self, user, password, client = None):
+        """
+        Checks ``password`` against ``user.password``. A match made with an outdated cost updates
+        ``user.password`` in the session, the caller commits it.
+        """
+        if not user.password:
+            return False
+        matches, new_hash = self._run(check_password, (user.password, password,
+                                                       current_app.config['BCRYPT_LOG_ROUNDS']),
+                                      client, user.email)
+        if new_hash:
+            user.password = new_hash
+        return matches
+
+
+passwords = PasswordHasher()
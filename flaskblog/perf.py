@@ -0,0 +1,306 @@
+"""
+Slow query log and index advisor.
+
+Statements taking longer than ``SLOW_QUERY_THRESHOLD`` seconds are recorded by their normalized form
+(whitespace collapsed, ``IN (?, ?, ...)`` lists folded) with their call count, total and worst time,
+and the database's query plan, captured with ``EXPLAIN [QUERY PLAN]`` the first time each statement
+is seen in a process. Every process appends what it saw to ``SLOW_QUERY_LOG`` (JSON lines) at most
+every ``SLOW_QUERY_FLUSH_INTERVAL`` seconds and when it exits.
+
+``flask perf advise`` reads the log, ranks the statements by total time and, for every table the plan
+reads in full or sorts in a temporary b-tree, suggests an index on the columns the statement filters
+and orders that table by, unless an existing index already starts with them.
+"""
+import atexit
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import click
+from flask import current_app, has_app_context
+from flask.cli import AppGroup
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+
+from flaskblog import db
+
+logger = logging.getLogger(__name__)
+
+perf_cli = AppGroup('perf', help = 'Inspect the slow query log.')
+
+IN_LIST_RE = re.compile(r'\bIN\s*\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,?)+\)', re.IGNORECASE)
+NUMBER_RE = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+EXPLAINED = ('SELECT', 'UPDATE', 'DELETE', 'WITH')
+EXPLAIN_SAVEPOINT = 'flaskblog_explain'
+
+
+def normalize(statement):
+    """The statement with literals and IN lists folded, so calls with other values group together."""
+    statement = ' '.join(statement.split())
+    statement = STRING_RE.sub('?', statement)
+    statement = NUMBER_RE.sub('?', statement)
+    return IN_LIST_RE.sub('IN (...)', statement)
+
+
+def digest(normalized):
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+
+
+def explain(connection, statement, parameters):
+    """The plan of ``statement`` as a list of lines, None when the database cannot explain it."""
+    dialect = connection.dialect.name
+    prefix = 'EXPLAIN QUERY PLAN ' if dialect == 'sqlite' else 'EXPLAIN '
+    # it runs in the request's transaction: on PostgreSQL a failed EXPLAIN would abort it, unless it is
+    # undone to a savepoint. SQLite carries on after a failed statement.
+    savepoint = dialect != 'sqlite'
+    cursor = connection.connection.cursor()  # a fresh DBAPI cursor, the statement's results are still unread
+    try:
+        if savepoint:
+            cursor.execute('SAVEPOINT ' + EXPLAIN_SAVEPOINT)
+        try:
+            cursor.execute(prefix + statement, parameters)
+            rows = cursor.fetchall()
+        except Exception as e:
+            logger.debug('Could not explain %s: %s', statement, e)
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT ' + EXPLAIN_SAVEPOINT)
+            return None
+        if savepoint:
+            cursor.execute('RELEASE SAVEPOINT ' + EXPLAIN_SAVEPOINT)
+    except Exception as e:  # no savepoint outside a transaction, or the connection is gone
+        logger.warning('Could not explain %s: %s', statement, e)
+        return None
+    finally:
+        cursor.close()
+    return [row[-1] for row in rows]  # SQLite: (id, parent, notused, detail), PostgreSQL: (line,)
+
+
+class SlowQueryLog(object):
+    """Per app aggregate of this process's slow statements, appended to the log file now and then."""
+
+    def __init__(self, path, threshold, flush_interval):
+        self.path = path
+        self.threshold = threshold
+        self.flush_interval = flush_interval
+        self._entries = OrderedDict()  # digest -> entry, counts since the last flush
+        self._explained = set()
+        self._lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    def record(self, connection, statement, parameters, executemany, seconds):
+        normalized = normalize(statement)
+        key = digest(normalized)
+        plan = None
+        if key not in self._explained and not executemany and normalized.lstrip('( ').upper().startswith(EXPLAINED):
+            self._explained.add(key)
+            plan = explain(connection, statement, parameters)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = dict(digest = key, statement = normalized, calls = 0, seconds = 0.0,
+                                                  max = 0.0, plan = None, dialect = connection.dialect.name)
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            if plan is not None:
+                entry['plan'] = plan
+            due = time.monotonic() - self._flushed_at >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            entries, self._entries = list(self._entries.values()), OrderedDict()
+            self._flushed_at = time.monotonic()
+        if not entries:
+            return
+        lines = ''.join(json.dumps(entry, sort_keys = True) + '\n' for entry in entries)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok = True)
+            with open(self.path, 'a', encoding = 'utf-8') as f:
+                f.write(lines)  # one append per flush, processes do not interleave their lines
+        except OSError as e:
+            logger.warning('Could not write the slow query log %s: %s', self.path, e)
+
+
+class SlowQueryRecorder(object):
+    """Flask extension, the log lives in ``app.extensions['slow_queries']``."""
+
+    def __init__(self, app = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SLOW_QUERY_THRESHOLD', 0.1)  # seconds, None turns the log off
+        app.config.setdefault('SLOW_QUERY_LOG', None)  # defaults to <instance>/slow_queries.jsonl
+        app.config.setdefault('SLOW_QUERY_FLUSH_INTERVAL', 30)  # seconds
+        log = SlowQueryLog(log_path(app), app.config['SLOW_QUERY_THRESHOLD'], app.config['SLOW_QUERY_FLUSH_INTERVAL'])
+        app.extensions['slow_queries'] = log
+        atexit.register(log.flush)
+
+    @property
+    def log(self):
+        return current_app.extensions['slow_queries']
+
+
+slow_queries = SlowQueryRecorder()
+
+
+def log_path(app):
+    return app.config['SLOW_QUERY_LOG'] or os.path.join(app.instance_path, 'slow_queries.jsonl')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.slow_query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, 'slow_query_start', None)
+    if start is None or not has_app_context():
+        return
+    seconds = time.perf_counter() - start
+    log = current_app.extensions.get('slow_queries')
+    if log is not None and log.threshold is not None and seconds >= log.threshold:
+        log.record(conn, statement, parameters, executemany, seconds)
+
+
+# The advisor
+
+SQLITE_SCAN_RE = re.compile(r'^SCAN (\w+)(?! USING (?:COVERING )?INDEX| VIRTUAL TABLE)')
+POSTGRES_SCAN_RE = re.compile(r'Seq Scan on (\w+)(?: (\w+))?')
+ALIAS_RE = re.compile(r'\b(?:FROM|JOIN|,) (\w+) AS (\w+)\b')
+CLAUSE_END_RE = re.compile(r'\b(?:GROUP BY|ORDER BY|LIMIT|OFFSET|HAVING|UNION|RETURNING)\b')
+TEMP_SORT = ('USE TEMP B-TREE FOR ORDER BY', 'Sort Key')
+
+
+def read_log(path):
+    """Sums the log's lines per statement, most total time first."""
+    statements = {}
+    with open(path, encoding = 'utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by a crash
+            total = statements.setdefault(entry['digest'], dict(entry, calls = 0, seconds = 0.0, max = 0.0))
+            total['calls'] += entry['calls']
+            total['seconds'] += entry['seconds']
+            total['max'] = max(total['max'], entry['max'])
+            if entry.get('plan'):
+                total['plan'] = entry['plan']
+    return sorted(statements.values(), key = lambda entry: -entry['seconds'])
+
+
+def scanned_tables(plan):
+    """``{name in the statement: sorted in a temp b-tree}`` for every table read in full."""
+    scans = OrderedDict()
+    for line in plan or ():
+        line = line.strip().lstrip('-> ')
+        match = SQLITE_SCAN_RE.match(line) or POSTGRES_SCAN_RE.search(line)
+        if match:
+            scans[match.group(match.lastindex)] = False
+        elif line.startswith(TEMP_SORT):
+            for name in scans:
+                scans[name] = True
+    return scans
+
+
+def _clause(statement, keyword):
+    match = re.search(r'\b{}\b'.format(keyword), statement)
+    if not match:
+        return ''
+    rest = statement[match.end():]
+    end = CLAUSE_END_RE.search(rest)
+    return rest[:end.start()] if end else rest
+
+
+def _filter_columns(conditions, name):
+    equal, ranged = [], []
+    for column, operator in re.findall(r'\b{}\.(\w+)\s*(=|IN\b|IS\b|<=|>=|<|>)'.format(name), conditions) + \
+            [(column, '=') for column in re.findall(r'=\s*{}\.(\w+)'.format(name), conditions)]:
+        target = equal if operator in ('=', 'IN', 'IS') else ranged
+        if column not in equal + ranged:
+            target.append(column)
+    return equal + ranged
+
+
+def index_columns(statement, alias):
+    """
+    Equality columns, then range columns, then ORDER BY columns of ``alias`` in the statement. A table
+    with none of those is reached through its join, its ON columns are used instead.
+    """
+    name = re.escape(alias)
+    columns = _filter_columns(_clause(statement, 'WHERE'), name)
+    columns += [column for column in re.findall(r'\b{}\.(\w+)'.format(name), _clause(statement, 'ORDER BY'))
+                if column not in columns]
+    if columns:
+        return columns
+    return _filter_columns(' '.join(re.findall(r'\bON (.+?)(?= (?:LEFT OUTER |INNER )?JOIN | WHERE |$)', statement)),
+                           name)
+
+
+def advise(entries, existing_indexes):
+    """
+    Yields ``(entry, table, columns)`` for the index each statement is missing. ``existing_indexes`` maps
+    table names to the column lists of their indexes, primary key included.
+    """
+    suggested = set()
+    for entry in entries:
+        aliases = {alias: table for table, alias in ALIAS_RE.findall(entry['statement'])}
+        for alias, sorted_in_temp in scanned_tables(entry.get('plan')).items():
+            table = aliases.get(alias, alias)
+            columns = index_columns(entry['statement'], alias)
+            if not columns or table not in existing_indexes:
+                continue  # nothing to seek on, e.g. count(*) of a whole table
+            if any(index[:len(columns)] == columns for index in existing_indexes[table]):
+                continue
+            key = (table, tuple(columns))
+            if key not in suggested:
+                suggested.add(key)
+                yield entry, table, columns
+
+
+def existing_indexes(engine):
+    inspector = inspect(engine)
+    indexes = {}
+    for table in inspector.get_table_names():
+        columns = [index['column_names'] for index in inspector.get_indexes(table)]
+        columns += [constraint['column_names'] for constraint in inspector.get_unique_constraints(table)]
+        columns.append(inspector.get_pk_constraint(table)['constrained_columns'])
+        indexes[table] = [c for c in columns if c]
+    return indexes
+
+
+@perf_cli.command('advise')
+@click.option('--log', 'path', help = 'Slow query log, defaults to SLOW_QUERY_LOG.')
+@click.option('--top', default = 10, help = 'Slowest statements to list.')
+def advise_command(path, top):
+    """Show the slowest statements and suggest the indexes they are missing."""
+    app = current_app._get_current_object()
+    path = path or log_path(app)
+    slow_queries.log.flush()
+    if not os.path.exists(path):
+        click.echo('No slow query log at {}, nothing was slower than SLOW_QUERY_THRESHOLD yet.'.format(path))
+        return
+    entries = read_log(path)
+    click.echo('Slowest statements by total time:')
+    for entry in entries[:top]:
+        click.echo('{:>9.2f} s {:>8} call(s) {:>9.1f} ms max  {}'.format(
+            entry['seconds'], entry['calls'], entry['max'] * 1000, entry['statement'][:200]))
+    suggestions = list(advise(entries, existing_indexes(db.engine)))
+    if not suggestions:
+        click.echo('\nNo missing indexes found.')
+        return
+    click.echo('\nSuggested indexes:')
+    for entry, table, columns in suggestions:
+        click.echo('CREATE INDEX ix_{0}_{1} ON {0} ({2});'.format(table, '_'.join(columns), ', '.join(columns)))
+        click.echo('    -- {} call(s), {:.2f} s: {}'.format(entry['calls'], entry['seconds'], entry['statement'][:200]))
@@ -1,7 +1,7 @@
 from flask_ckeditor import CKEditorField
 from flask_wtf import FlaskForm
-from wtforms import SubmitField
-from wtforms.fields import StringField
+from wtforms import SubmitField, SelectField
+from wtforms.fields import Field, StringField
 from wtforms.validators import DataRequired, Length
 from wtforms.widgets import TextInput
 
@@ -66,3 +66,23 @@ class CommentForm(FlaskForm):
 class SearchForm(FlaskForm):
     search = StringField('Search', validators = [DataRequired()])
     submit = SubmitField('Search')
+
+
+class IdListField(Field):
+    """The ids of the checked rows, sent as repeated form values or a JSON list"""
+
+    def __init__(self, label = None, validators = None, **kwargs):
+        super(IdListField, self).__init__(label, validators, **kwargs)
+        self.data = []
+
+    def process_formdata(self, valuelist):
+        try:
+            self.data = sorted({int(value) for value in valuelist})
+        except (TypeError, ValueError):
+            self.data = []
+            raise ValueError('Not a valid list of ids')
+
+
+class BulkModerationForm(FlaskForm):
+    ids = IdListField('Comments', validators = [DataRequired('Select at least one comment')])
+    action = SelectField('Action', choices = [('enable', 'Enable'), ('disable', 'Disable')])
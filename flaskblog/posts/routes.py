@@ -1,13 +1,18 @@
-import bleach  # secure against script injection by stripping html tags
 from flask import (render_template, url_for, flash,
-                   redirect, request, abort, current_app, Blueprint)
+                   redirect, request, abort, current_app, Blueprint, jsonify)
 from flask_login import current_user, login_required
 from sqlalchemy import exc
 
 from flaskblog import db
+from flaskblog.caching import response_cache
 from flaskblog.decorators import permission_required, moderator_required
+from flaskblog.feed import posts_by_tag
 from flaskblog.models import Post, Tag, Comment, Permission
-from flaskblog.posts.forms import PostForm, CommentForm
+from flaskblog.moderation import MODERATION_STATUSES, moderation_queue, set_comments_disabled
+from flaskblog.pagination import paginate_keyset
+from flaskblog.posts.forms import PostForm, CommentForm, BulkModerationForm
+from flaskblog.rendering import sanitize_post  # secure against script injection by escaping html tags
+from flaskblog.tags import set_post_tags
 
 posts = Blueprint('posts', __name__)
 
@@ -18,14 +23,10 @@ posts = Blueprint('posts', __name__)
 def new_post():
     form = PostForm()
     if form.validate_on_submit():
-        cleaned_content = bleach.clean(form.content.data, tags = bleach.sanitizer.ALLOWED_TAGS + ['p'])
+        cleaned_content = sanitize_post(form.content.data)
         create_post = Post(title = form.title.data, content = cleaned_content,
                            author = current_user._get_current_object())
-
-        if form.tags.data[0]:
-            for i in form.tags.data:
-                tags = Tag(name = i)  # adds tag to TAG db Table
-                create_post.tag.append(tags)  # adds tag to post_tag table with post id.
+        set_post_tags(create_post, form.tags.data)  # existing tags are reused, new ones created
 
         db.session.add(create_post)
         db.session.commit()
@@ -38,10 +39,11 @@ def new_post():
 
 # for viewing a selected post and comments
 @posts.route("/post/<int:post_id>", methods = ['GET', 'POST'])
+@response_cache.cached(tags = lambda post_id: ('post:{}'.format(post_id), 'users'))
 def post(post_id):
     # get_or_404() method gets the post with the post_id and if it doesn't exist it returns a 404 error (
     # page doesn't exist)
-    view_post = Post.query.get_or_404(post_id)
+    view_post = Post.query.options(db.joinedload(Post.author)).get_or_404(post_id)
     form = CommentForm()
 
     if form.validate_on_submit():
@@ -53,15 +55,34 @@ def post(post_id):
         return redirect(url_for('.post', post_id = view_post.id, page = -1))
 
     page = request.args.get('page', 1, type = int)
-    if page == -1:
-        page = (view_post.comments.count() - 1) // current_app.config['FLASKY_COMMENTS_PER_PAGE'] + 1
-
-    pagination = view_post.comments.order_by(Comment.timestamp.asc()).paginate(page, per_page = current_app.config[
-        'FLASKY_COMMENTS_PER_PAGE'], error_out = False)
-    comments = pagination.items
-
-    return render_template('post.html', title = view_post.title, post = view_post, form = form, comments = comments,
-                           pagination = pagination)
+    after, before = request.args.get('after'), request.args.get('before')
+
+    def render_comments():
+        # page -1 is the newest comments, fetched by seeking from the end instead of counting the pages
+        pagination = paginate_keyset(view_post.comments.options(db.joinedload(Comment.author)),
+                                     (Comment.timestamp, Comment.id), page,
+                                     current_app.config['FLASKY_COMMENTS_PER_PAGE'], after = after, before = before,
+                                     last = page == -1, descending = False, error_out = False)
+        return render_template('_comments.html', post = view_post, comments = pagination.items,
+                               pagination = pagination)
+
+    # the same for every visitor, rebuilt once a comment on the post or a user changes
+    comments = ''
+    if view_post.comment_count > 0:
+        comments = response_cache.fragment('comments:{}:{}:{}:{}'.format(view_post.id, page, after, before),
+                                           ('post:{}'.format(view_post.id), 'users'), render_comments)
+
+    return render_template('post.html', title = view_post.title, post = view_post, form = form, comments = comments)
+
+
+@posts.route("/tag/<string:slug>")
+@response_cache.cached(tags = lambda slug: ('posts', 'users', 'tags'))
+def tag(slug):
+    view_tag = Tag.query.filter_by(slug = slug).first_or_404()
+    page = request.args.get('page', 1, type = int)
+    tagged_posts = posts_by_tag(view_tag, page, current_app.config['FLASKY_POSTS_PER_PAGE'],
+                                after = request.args.get('after'), before = request.args.get('before'))
+    return render_template('tag_posts.html', title = view_tag.name, tag = view_tag, posts = tagged_posts)
 
 
 @posts.route("/post/<int:post_id>/update", methods = ['GET', 'POST'])
@@ -74,12 +95,8 @@ def update_post(post_id):
     form = PostForm()
     if form.validate_on_submit():
         post_update.title = form.title.data
-        post_update.content = bleach.clean(form.content.data, tags = bleach.sanitizer.ALLOWED_TAGS + ['p'])
-        for i in form.tags.data:
-            exists = db.session.query(db.exists().where(Tag.name == i)).scalar()
-            if not exists:
-                tags = Tag(name = i)  # adds tag to TAG db Table
-                post_update.tag.append(tags)  # adds tag to post_tag table with post id.
+        post_update.content = sanitize_post(form.content.data)
+        set_post_tags(post_update, form.tags.data)
         try:
             db.session.commit()
             flash('Your post has been updated!', 'success')
@@ -114,14 +131,44 @@ def delete_post(post_id):
 @login_required
 @moderator_required
 def moderate():
-    form = CommentForm()
+    form = BulkModerationForm()
     page = request.args.get('page', 1, type = int)
-    pagination = Comment.query.order_by(Comment.timestamp.asc()).paginate(page, per_page = current_app.config[
-        'FLASKY_COMMENTS_PER_PAGE'], error_out = False)
+    status = request.args.get('status', 'all')
+    if status not in MODERATION_STATUSES:
+        abort(404)
+    author = request.args.get('author') or None
+    post_id = request.args.get('post', type = int)
+    pagination = moderation_queue(page, current_app.config['FLASKY_COMMENTS_PER_PAGE'], status = status,
+                                  author = author, post_id = post_id,
+                                  after = request.args.get('after'), before = request.args.get('before'))
     comments = pagination.items
-    print(comments)
-    return render_template('moderate_comments.html', comments = comments,
-                           pagination = pagination, page = page, form = form)
+    return render_template('moderate_comments.html', comments = comments, pagination = pagination, page = page,
+                           form = form, status = status, statuses = MODERATION_STATUSES, author = author,
+                           post_id = post_id)
+
+
+# enables or disables many comments at once, from the moderation page or as JSON
+# ({"ids": [...], "action": "disable", "csrf_token": ...})
+@posts.route('/moderate/bulk', methods = ['POST'])
+@login_required
+@permission_required(Permission.MODERATE_COMMENTS)
+def moderate_bulk():
+    form = BulkModerationForm()
+    valid = form.validate_on_submit()
+    if valid and len(form.ids.data) > current_app.config['FLASKY_MODERATION_BATCH']:
+        form.ids.errors.append('At most {} comments at a time'.format(current_app.config['FLASKY_MODERATION_BATCH']))
+        valid = False
+    if request.is_json:
+        if not valid:
+            return jsonify(errors = form.errors), 400
+        return jsonify(updated = set_comments_disabled(form.ids.data, form.action.data == 'disable'))
+    if valid:
+        changed = set_comments_disabled(form.ids.data, form.action.data == 'disable')
+        flash('{} comment(s) {}d.'.format(changed, form.action.data), 'success')
+    else:
+        for errors in form.errors.values():
+            flash(' '.join(errors), 'danger')
+    return redirect(url_for('.moderate', **request.args.to_dict()))
 
 
 @posts.route('/moderate/enable/<int:id>')
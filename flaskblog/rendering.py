@@ -0,0 +1,90 @@
+"""
+Write time rendering of user content.
+
+Posts and comments are sanitized, linkified and (for posts) cut down to a plain text excerpt when
+their body is set, so listing pages only read stored columns. Every rendered row records
+``RENDER_VERSION``, a digest of the sanitizer settings and library versions below: after changing
+any of them run ``flask content rerender`` to bring the stored HTML up to date.
+"""
+import hashlib
+import html
+import json
+import re
+
+import bleach
+import click
+import markdown
+from flask.cli import AppGroup
+
+POST_TAGS = bleach.sanitizer.ALLOWED_TAGS + ['p']
+POST_ATTRIBUTES = bleach.sanitizer.ALLOWED_ATTRIBUTES
+COMMENT_TAGS = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code', 'em', 'i', 'li', 'ol', 'strong', 'ul', 's',
+                'pre', 'p']
+EXCERPT_LENGTH = 400
+TRUNCATION_MARK = '...'
+
+RENDER_VERSION = hashlib.sha1(json.dumps([
+    bleach.__version__, markdown.__version__, POST_TAGS, POST_ATTRIBUTES, COMMENT_TAGS, EXCERPT_LENGTH,
+], sort_keys = True).encode('utf-8')).hexdigest()[:12]
+
+WHITESPACE_RE = re.compile(r'\s+')
+
+content_cli = AppGroup('content', help = 'Maintain the rendered HTML of posts and comments.')
+
+
+def sanitize_post(value):
+    """The stored ``Post.content``: what the author submitted with anything unsafe escaped."""
+    return bleach.clean(value or '', tags = POST_TAGS, attributes = POST_ATTRIBUTES)
+
+
+def plain_text(content):
+    """Sanitized HTML down to its words."""
+    return WHITESPACE_RE.sub(' ', html.unescape(bleach.clean(content or '', tags = [], strip = True))).strip()
+
+
+def excerpt(text, length = EXCERPT_LENGTH, leeway = 5):
+    """Same cut as Jinja's ``truncate`` filter: whole words, marked with '...', short texts left alone."""
+    if len(text) <= length + leeway:
+        return text
+    return text[:length - len(TRUNCATION_MARK)].rsplit(' ', 1)[0] + TRUNCATION_MARK
+
+
+def render_post(post, content):
+    post.content_html = bleach.linkify(sanitize_post(content))
+    post.excerpt = excerpt(plain_text(content))
+    post.render_version = RENDER_VERSION
+
+
+def render_comment(comment, body):
+    comment.body_html = bleach.linkify(bleach.clean(markdown.markdown(body or '', output_format = 'html'),
+                                                    tags = COMMENT_TAGS, strip = True))
+    comment.render_version = RENDER_VERSION
+
+
+def rerender(everything = False, batch_size = 500):
+    """Re-renders the posts and comments stored with another RENDER_VERSION, returns how many were updated."""
+    from flaskblog import db
+    from flaskblog.models import Post, Comment  # the models render through this module
+    updated = 0
+    for model, render, source in ((Post, render_post, 'content'), (Comment, render_comment, 'body')):
+        query = model.query
+        if not everything:
+            query = query.filter(db.or_(model.render_version.is_(None), model.render_version != RENDER_VERSION))
+        last_id = 0
+        while True:
+            batch = query.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not batch:
+                break
+            for row in batch:
+                render(row, getattr(row, source))
+            db.session.commit()
+            updated += len(batch)
+            last_id = batch[-1].id
+    return updated
+
+
+@content_cli.command('rerender')
+@click.option('--all', 'everything', is_flag = True, help = 'Re-render every row, not only outdated ones.')
+def rerender_command(everything):
+    """Refresh the stored HTML and excerpts of posts and comments."""
+    click.echo('Rendered {} row(s) with version {}.'.format(rerender(everything), RENDER_VERSION))
@@ -0,0 +1,358 @@
+"""
+Post search.
+
+The database backends keep their index in a ``post_search`` table, created by ``flask search init``
+(run it with ``flask db upgrade`` on deploy). Requests never create it: a read request may be served by
+a read-only replica, and one that only reads rolls its transaction back. Until the table exists,
+searches find nothing and post changes are not indexed, which is logged.
+"""
+import logging
+import math
+import re
+import threading
+from collections import defaultdict
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from flask_sqlalchemy import Pagination
+from sqlalchemy import text
+from sqlalchemy.orm import attributes, selectinload
+
+from flaskblog import db
+from flaskblog.models import Post
+from flaskblog.rendering import plain_text
+
+logger = logging.getLogger(__name__)
+
+search_cli = AppGroup('search', help = 'Manage the post search index.')
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+STOP_WORDS = frozenset(['a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in', 'is', 'it', 'of',
+                        'on', 'or', 'that', 'the', 'this', 'to', 'with'])
+
+
+def tokenize(value):
+    return [t for t in TOKEN_RE.findall(value.lower()) if t not in STOP_WORDS]
+
+
+def post_document(post, tag_names):
+    return dict(title = post.title or '', tags = ' '.join(tag_names), content = plain_text(post.content))
+
+
+class PythonSearchBackend(object):
+    """
+    In-process inverted index, used when the database has no full text search of its own.
+
+    Terms map to ``{post_id: weight}`` with title and tag matches weighted above body matches; results
+    are ranked by tf-idf and must contain every term of the query. The index is built from the database
+    on first use and then kept current by the commit hooks below, so it only sees writes made by this
+    process - run ``flask search reindex`` or restart to pick up the rest.
+    """
+    name = 'python'
+    FIELD_WEIGHTS = dict(title = 3.0, tags = 2.0, content = 1.0)
+
+    def __init__(self):
+        self._postings = defaultdict(dict)
+        self._terms = {}  # post_id -> set of terms, for removal
+        self._lock = threading.RLock()
+        self._built = False
+
+    def has_schema(self, connection):
+        return True  # built on first search instead
+
+    def create_schema(self, connection):
+        pass
+
+    def index(self, connection, post_id, document):
+        with self._lock:
+            self._remove(post_id)
+            weights = defaultdict(float)
+            for field, weight in self.FIELD_WEIGHTS.items():
+                for term in tokenize(document[field]):
+                    weights[term] += weight
+            for term, weight in weights.items():
+                self._postings[term][post_id] = weight
+            self._terms[post_id] = set(weights)
+
+    def remove(self, connection, post_id):
+        with self._lock:
+            self._remove(post_id)
+
+    def _remove(self, post_id):
+        for term in self._terms.pop(post_id, ()):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(post_id, None)
+                if not postings:
+                    del self._postings[term]
+
+    def clear(self, connection):
+        with self._lock:
+            self._postings.clear()
+            self._terms.clear()
+            self._built = True
+
+    def search(self, connection, query, offset, limit):
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    index_all_posts(self, connection)
+                    self._built = True
+        terms = set(tokenize(query))
+        if not terms:
+            return [], 0
+        with self._lock:
+            postings = [self._postings.get(term, {}) for term in terms]
+            if not all(postings):
+                return [], 0
+            total_docs = len(self._terms)
+            postings.sort(key = len)
+            matches = set(postings[0]).intersection(*postings[1:])
+            scores = {}
+            for post_id in matches:
+                scores[post_id] = sum(p[post_id] * math.log(1 + total_docs / len(p)) for p in postings)
+        ranked = sorted(scores, key = lambda post_id: (-scores[post_id], -post_id))
+        return ranked[offset:offset + limit], len(ranked)
+
+
+class SQLiteSearchBackend(object):
+    """SQLite FTS5 virtual table ranked with bm25(), the rowid is the post id."""
+    name = 'sqlite'
+
+    def has_schema(self, connection):
+        return bool(connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'post_search'")).scalar())
+
+    def create_schema(self, connection):
+        connection.execute(text("CREATE VIRTUAL TABLE post_search "
+                                "USING fts5(title, tags, content, tokenize = 'porter unicode61')"))
+
+    def index(self, connection, post_id, document):
+        self.remove(connection, post_id)
+        connection.execute(text("INSERT INTO post_search (rowid, title, tags, content) "
+                                "VALUES (:post_id, :title, :tags, :content)"), post_id = post_id, **document)
+
+    def remove(self, connection, post_id):
+        connection.execute(text("DELETE FROM post_search WHERE rowid = :post_id"), post_id = post_id)
+
+    def clear(self, connection):
+        connection.execute(text("DELETE FROM post_search"))
+
+    def search(self, connection, query, offset, limit):
+        # quoting every term keeps FTS5 query syntax (NEAR, *, column filters...) out of user input
+        match = ' '.join('"{}"'.format(t) for t in tokenize(query))
+        if not match:
+            return [], 0
+        total = connection.execute(text("SELECT count(*) FROM post_search WHERE post_search MATCH :match"),
+                                   match = match).scalar()
+        rows = connection.execute(text("SELECT rowid FROM post_search WHERE post_search MATCH :match "
+                                       "ORDER BY bm25(post_search, 10.0, 5.0, 1.0), rowid DESC "
+                                       "LIMIT :limit OFFSET :offset"),
+                                  match = match, limit = limit, offset = offset)
+        return [row[0] for row in rows], total
+
+
+class PostgresSearchBackend(object):
+    """Weighted tsvector per post in ``post_search`` with a GIN index, ranked with ts_rank()."""
+    name = 'postgres'
+    DOCUMENT = "setweight(to_tsvector(:config, :title), 'A') || setweight(to_tsvector(:config, :tags), 'B') || " \
+               "setweight(to_tsvector(:config, :content), 'C')"
+
+    def __init__(self, config = 'english'):
+        self.config = config
+
+    def has_schema(self, connection):
+        return bool(connection.execute(text("SELECT to_regclass('post_search')")).scalar())
+
+    def create_schema(self, connection):
+        connection.execute(text("CREATE TABLE post_search ("
+                                "post_id INTEGER PRIMARY KEY REFERENCES post (id) ON DELETE CASCADE, "
+                                "document TSVECTOR NOT NULL)"))
+        connection.execute(text("CREATE INDEX ix_post_search_document ON post_search USING GIN (document)"))
+
+    def index(self, connection, post_id, document):
+        connection.execute(text("INSERT INTO post_search (post_id, document) VALUES (:post_id, " + self.DOCUMENT +
+                                ") ON CONFLICT (post_id) DO UPDATE SET document = EXCLUDED.document"),
+                           post_id = post_id, config = self.config, **document)
+
+    def remove(self, connection, post_id):
+        connection.execute(text("DELETE FROM post_search WHERE post_id = :post_id"), post_id = post_id)
+
+    def clear(self, connection):
+        connection.execute(text("DELETE FROM post_search"))
+
+    def search(self, connection, query, offset, limit):
+        params = dict(config = self.config, query = query)
+        total = connection.execute(text("SELECT count(*) FROM post_search "
+                                        "WHERE document @@ plainto_tsquery(:config, :query)"), **params).scalar()
+        rows = connection.execute(text("SELECT post_id FROM post_search, plainto_tsquery(:config, :query) q "
+                                       "WHERE document @@ q ORDER BY ts_rank(document, q) DESC, post_id DESC "
+                                       "LIMIT :limit OFFSET :offset"), limit = limit, offset = offset, **params)
+        return [row[0] for row in rows], total
+
+
+def _sqlite_has_fts5(connection):
+    options = [row[0] for row in connection.execute(text('PRAGMA compile_options'))]
+    return 'ENABLE_FTS5' in options
+
+
+def create_backend(app, connection):
+    """Picks the backend named by ``SEARCH_BACKEND``, 'auto' uses the database's own full text search."""
+    choice = app.config.get('SEARCH_BACKEND', 'auto')
+    if choice == 'auto':
+        dialect = connection.dialect.name
+        if dialect == 'postgresql':
+            choice = 'postgres'
+        elif dialect == 'sqlite' and _sqlite_has_fts5(connection):
+            choice = 'sqlite'
+        else:
+            choice = 'python'
+    if choice == 'postgres':
+        return PostgresSearchBackend(app.config.get('SEARCH_POSTGRES_CONFIG', 'english'))
+    elif choice == 'sqlite':
+        return SQLiteSearchBackend()
+    elif choice == 'python':
+        return PythonSearchBackend()
+    raise ValueError('Unknown SEARCH_BACKEND {!r}'.format(choice))
+
+
+def get_backend(connection = None):
+    """The search backend of the current app, picked on first use."""
+    backend = current_app.extensions.get('search')
+    if backend is None:
+        backend = create_backend(current_app, connection or db.session.connection())
+        backend.ready = False  # whether its schema has been seen, it never goes away once created
+        current_app.extensions['search'] = backend
+    return backend
+
+
+def ready_backend(connection):
+    """The search backend if its schema exists, else None."""
+    backend = get_backend(connection)
+    if not backend.ready:
+        backend.ready = backend.has_schema(connection)
+        if not backend.ready:
+            logger.warning('The search index does not exist yet, run `flask search init`')
+            return None
+    return backend
+
+
+def init_index():
+    """Creates the index schema if it is missing and indexes the existing posts, returns the number indexed."""
+    connection = db.session.connection()
+    backend = get_backend(connection)
+    if backend.has_schema(connection):
+        return 0
+    backend.create_schema(connection)
+    count = index_all_posts(backend, connection)
+    db.session.commit()
+    backend.ready = True
+    return count
+
+
+def index_all_posts(backend, connection, batch_size = 500):
+    count = 0
+    last_id = 0
+    while True:
+        batch = Post.query.options(selectinload(Post.tags)).filter(Post.id > last_id) \
+            .order_by(Post.id).limit(batch_size).all()
+        if not batch:
+            return count
+        for post in batch:
+            backend.index(connection, post.id, post_document(post, [t.name for t in post.tags]))
+        count += len(batch)
+        last_id = batch[-1].id
+
+
+def search_posts(query, page, per_page, max_results):
+    """Ranked search over titles, tags and content, returns a Pagination of posts with their authors."""
+    from flaskblog.feed import feed_query
+    page = max(page, 1)  # ?page=0 or below would be a negative OFFSET
+    offset = (page - 1) * per_page
+    limit = max(0, min(per_page, max_results - offset))
+    connection = db.session.connection()
+    backend = ready_backend(connection)
+    ids, total = backend.search(connection, query, offset, limit) if limit and backend else ([], 0)
+    total = min(total, max_results)
+    posts = {post.id: post for post in feed_query().filter(Post.id.in_(ids))} if ids else {}
+    items = [posts[post_id] for post_id in ids if post_id in posts]
+    return Pagination(None, page, per_page, total, items)
+
+
+def reindex():
+    """Rebuilds the whole index from the post table, returns the number of posts indexed."""
+    connection = db.session.connection()
+    backend = get_backend(connection)
+    if not backend.has_schema(connection):
+        backend.create_schema(connection)
+    else:
+        backend.clear(connection)
+    count = index_all_posts(backend, connection)
+    db.session.commit()
+    backend.ready = True
+    return count
+
+
+# Incremental sync: posts whose title, content or tags changed are re-indexed when the session flushes.
+# Database backends write on the flush connection so the index commits or rolls back with the post,
+# the in-process index only applies the changes once the transaction has committed.
+
+SEARCHED_ATTRIBUTES = ('title', 'content', 'tag')
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def collect_search_changes(session, flush_context):
+    changes = []
+    with session.no_autoflush:
+        for obj in session.new.union(session.dirty):
+            if isinstance(obj, Post) and obj not in session.deleted and \
+                    any(attributes.get_history(obj, name).has_changes() for name in SEARCHED_ATTRIBUTES):
+                changes.append((obj.id, post_document(obj, [t.name for t in obj.tag])))
+        for obj in session.deleted:
+            if isinstance(obj, Post):
+                changes.append((obj.id, None))
+    if not changes:
+        return
+    connection = session.connection()
+    backend = ready_backend(connection)
+    if backend is None:
+        return  # `flask search init` indexes them
+    if isinstance(backend, PythonSearchBackend):
+        session.info.setdefault('search_changes', []).extend(changes)
+        return
+    for post_id, document in changes:
+        if document is None:
+            backend.remove(connection, post_id)
+        else:
+            backend.index(connection, post_id, document)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def apply_search_changes(session):
+    changes = session.info.pop('search_changes', None)
+    if not changes:
+        return
+    backend = get_backend()
+    for post_id, document in changes:
+        if document is None:
+            backend.remove(None, post_id)
+        else:
+            backend.index(None, post_id, document)
+
+
+@db.event.listens_for(db.session, 'after_soft_rollback')
+def discard_search_changes(session, previous_transaction):
+    session.info.pop('search_changes', None)
+
+
+@search_cli.command('init')
+def init_command():
+    """Create the post search index if it does not exist yet, run it on deploy."""
+    count = init_index()
+    click.echo('Search index ready ({} backend, {} post(s) indexed).'.format(get_backend().name, count))
+
+
+@search_cli.command('reindex')
+def reindex_command():
+    """Rebuild the post search index from scratch."""
+    click.echo('Indexed {} post(s) with the {} backend.'.format(reindex(), get_backend().name))
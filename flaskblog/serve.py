@@ -0,0 +1,333 @@
+"""
+Production HTTP server.
+
+    python -m flaskblog.serve [--bind 127.0.0.1:8000] [--workers 4] [--threads 4] [--max-requests 1000]
+                              [--max-requests-jitter 100] [--warmup /] [--timeout 30] [--graceful-timeout 30]
+
+The master process creates the app once (``--config`` or FLASK_CONFIG picks the config), compiles every
+template and sends the ``--warmup`` paths through the app, so the response cache, the country list and
+the other lazily built state are filled in. It then closes its database connections, binds the socket
+and forks ``--workers`` processes. The workers share the listening socket and, copy-on-write, the
+warmed up memory. Each worker disposes its copy of the SQLAlchemy engine so pooled connections are
+never shared between processes, and it serves up to ``--threads`` requests at a time. A busy worker
+leaves new connections in the backlog for its idle siblings. After ``--max-requests`` requests, plus
+a random part of ``--max-requests-jitter`` so workers do not restart together, a worker finishes what
+it has and exits, and the master forks a replacement.
+
+Signals to the master:
+
+    TERM, INT  stop the workers gracefully, killing those still busy after ``--graceful-timeout``
+    HUP        create and warm up a new app (the config file is read again), fork new workers from
+               it, then stop the old ones gracefully. Code changes need a restart.
+
+The memory response cache is per worker, an invalidation would not reach the other workers. With more
+than one worker it is replaced by the filesystem backend, use redis to share the cache between hosts.
+The numbers at /metrics are added up over the workers through ``METRICS_DIR``, a temporary directory
+unless the config names one (see flaskblog/metrics.py).
+"""
+import logging
+import os
+import random
+import select
+import shutil
+import signal
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from jinja2 import TemplateError
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+from flaskblog import create_app, db
+from flaskblog.caching import create_backend
+from flaskblog.metrics import SharedMetrics, metrics
+
+logger = logging.getLogger('flaskblog.serve')  # not __main__ under python -m
+
+WARMUP_PATHS = ('/', '/about', '/login', '/register')
+HANDLED_SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD)
+
+
+class RequestHandler(WSGIRequestHandler):
+    timeout = 30  # seconds a client may be silent before its connection is dropped, see --timeout
+
+    def log_request(self, code = '-', size = '-'):
+        self.log('info', '"%s" %s %s', self.requestline, code, size)  # werkzeug's colours are for terminals
+
+
+class WorkerServer(BaseWSGIServer):
+    """The listening socket, bound by the master and served by each worker on a pool of threads."""
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, host, port, app):
+        super(WorkerServer, self).__init__(host, port, app, RequestHandler)
+        self.stopping = threading.Event()
+        self.handled = 0
+
+    def serve(self, threads, max_requests, master_pid):
+        """Accepts connections until stopped, recycled after ``max_requests`` or orphaned by the master."""
+        slots = threading.BoundedSemaphore(threads)
+        pool = ThreadPoolExecutor(threads, thread_name_prefix = 'request')
+        self.socket.setblocking(False)  # every worker is woken for a connection, only one gets it
+        while not self.stopping.is_set() and os.getppid() == master_pid:
+            if not slots.acquire(timeout = 1):
+                continue  # every thread is busy, leave the connection to another worker
+            try:
+                readable = select.select([self.socket], [], [], 1)[0]
+                connection, address = self.get_request() if readable else (None, None)
+            except OSError:  # taken by another worker
+                connection = None
+            if connection is None:
+                slots.release()
+                continue
+            pool.submit(self.process, connection, address, slots)
+            self.handled += 1
+            if max_requests and self.handled >= max_requests:
+                break
+        pool.shutdown(wait = True)
+        self.socket.close()
+
+    def process(self, connection, address, slots):
+        try:
+            self.finish_request(connection, address)
+        except Exception:
+            self.handle_error(connection, address)
+        finally:
+            self.shutdown_request(connection)
+            slots.release()
+
+
+def warm_up(app, paths):
+    """Compiles every template and requests ``paths`` anonymously, then closes the database connections."""
+    started = time.perf_counter()
+    for name in app.jinja_env.list_templates(extensions = ['html', 'xml', 'txt']):
+        try:
+            app.jinja_env.get_template(name)
+        except TemplateError as e:
+            logger.warning('Template %s does not compile: %s', name, e)
+    client = app.test_client()
+    for path in paths:
+        response = client.get(path, environ_base = {'REMOTE_ADDR': '127.0.0.1'})
+        if response.status_code >= 500:
+            logger.warning('Warm-up request %s failed: %s', path, response.status)
+    with app.app_context():
+        db.session.remove()
+        db.dispose_all(app)
+    app.extensions['metrics'].registry.clear()  # warm-up requests are not traffic
+    app.extensions['metrics'].dump(app)
+    app.extensions['slow_queries'].flush()  # otherwise every worker would write the master's entries
+    logger.info('Warmed up in %.0f ms', (time.perf_counter() - started) * 1000)
+
+
+class Master(object):
+    """Forks, watches and replaces the workers, see the module docstring."""
+
+    def __init__(self, host, port, config_name, workers, threads, max_requests, max_requests_jitter, warmup,
+                 graceful_timeout):
+        self.host = host
+        self.port = port
+        self.config_name = config_name
+        self.workers = workers
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.warmup = warmup
+        self.graceful_timeout = graceful_timeout
+        self.pid = os.getpid()
+        self.app = None
+        self.server = None
+        self.generation = 0
+        self.children = {}  # pid -> generation
+        self.retiring = {}  # pid -> time it gets killed
+        self.respawn_after = 0
+        self.metrics_dir = None  # made by us, removed on exit
+        self._signals = None
+
+    def load(self):
+        app = create_app(self.config_name)
+        if self.workers > 1 and app.config['RESPONSE_CACHE_BACKEND'] == 'memory':
+            logger.warning('The memory response cache is per worker, using the filesystem backend so '
+                           'invalidations reach every worker')
+            app.config['RESPONSE_CACHE_BACKEND'] = 'filesystem'
+            app.extensions['response_cache'] = create_backend(app)
+        warm_up(app, self.warmup)
+        if self.workers > 1 and not app.config['METRICS_DIR']:
+            if self.metrics_dir is None:
+                self.metrics_dir = tempfile.mkdtemp(prefix = 'flaskblog-metrics-')
+            app.config['METRICS_DIR'] = self.metrics_dir
+        return app
+
+    def run(self):
+        self.app = self.load()
+        self.server = WorkerServer(self.host, self.port, self.app)
+        if self.app.config['METRICS_DIR']:
+            SharedMetrics(self.app.config['METRICS_DIR']).clear()  # numbers of an earlier run
+        read_end, write_end = os.pipe()
+        os.set_blocking(write_end, False)
+        self._signals = (read_end, write_end)
+        signal.set_wakeup_fd(write_end)
+        for signum in HANDLED_SIGNALS:
+            signal.signal(signum, lambda signum, frame: None)  # handled by the loop, woken through the pipe
+        logger.info('Listening at http://%s:%d', *self.server.server_address[:2])
+        while True:
+            self.reap()
+            self.kill_overdue()
+            self.spawn_missing()
+            received = set()
+            if select.select([read_end], [], [], 1)[0]:
+                received.update(os.read(read_end, 64))
+            if received & {signal.SIGTERM, signal.SIGINT}:
+                self.stop()
+                return
+            if signal.SIGHUP in received:
+                self.reload()
+
+    def spawn_missing(self):
+        if time.monotonic() < self.respawn_after:
+            return
+        current = [pid for pid, generation in self.children.items() if generation == self.generation]
+        for _ in range(self.workers - len(current)):
+            self.spawn()
+
+    def spawn(self):
+        max_requests = self.max_requests + random.randint(0, self.max_requests_jitter) if self.max_requests else 0
+        # held back until the worker has its own handlers, the master's would swallow them
+        signal.pthread_sigmask(signal.SIG_BLOCK, HANDLED_SIGNALS)
+        pid = os.fork()
+        if pid:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, HANDLED_SIGNALS)
+            self.children[pid] = self.generation
+            return
+        status = 1
+        try:
+            self.run_worker(max_requests)
+            status = 0
+        except BaseException:
+            logger.exception('Worker failed')
+        finally:
+            os._exit(status)
+
+    def run_worker(self, max_requests):
+        signal.set_wakeup_fd(-1)
+        for fd in self._signals:
+            os.close(fd)
+        for signum in (signal.SIGTERM, signal.SIGINT):  # a Ctrl-C reaches the whole process group
+            signal.signal(signum, lambda signum, frame: self.server.stopping.set())
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, HANDLED_SIGNALS)
+        with self.app.app_context():
+            db.dispose_all(self.app)  # the pools of the master's engines must not be shared
+        self.server.app = self.app
+        logger.info('Worker %d serving, recycled after %s requests', os.getpid(), max_requests or 'no')
+        self.server.serve(self.threads, max_requests, self.pid)
+        self.app.extensions['slow_queries'].flush()
+        metrics.dump(self.app)  # the master adds them to the retired totals
+        if max_requests and self.server.handled >= max_requests:
+            logger.info('Worker %d recycled after %d requests', os.getpid(), self.server.handled)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            self.children.pop(pid, None)
+            self.retiring.pop(pid, None)
+            self.retire_metrics(pid)
+            code = os.waitstatus_to_exitcode(status)
+            if code:
+                logger.warning('Worker %d exited with %d', pid, code)
+                self.respawn_after = time.monotonic() + 1  # do not fork in a tight loop if workers crash
+
+    def retire_metrics(self, pid):
+        directory = self.app.config['METRICS_DIR']
+        if not directory:
+            return
+        try:
+            SharedMetrics(directory).retire(metrics.registry, pid)
+        except OSError as e:
+            logger.warning('Could not keep the metrics of worker %d: %s', pid, e)
+
+    def retire(self, pids):
+        deadline = time.monotonic() + self.graceful_timeout
+        for pid in pids:
+            self.retiring[pid] = deadline
+            self.signal(pid, signal.SIGTERM)
+
+    def kill_overdue(self):
+        now = time.monotonic()
+        for pid, deadline in list(self.retiring.items()):
+            if now >= deadline:
+                logger.warning('Worker %d still busy after %s seconds, killing it', pid, self.graceful_timeout)
+                self.signal(pid, signal.SIGKILL)
+                del self.retiring[pid]
+
+    @staticmethod
+    def signal(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def reload(self):
+        logger.info('Reloading')
+        try:
+            app = self.load()
+        except Exception:
+            logger.exception('Could not create the new app, the workers keep running the old one')
+            return
+        old = list(self.children)
+        self.app = app
+        self.generation += 1
+        self.respawn_after = 0
+        self.spawn_missing()
+        self.retire(old)
+
+    def stop(self):
+        logger.info('Stopping')
+        self.retire(list(self.children))
+        while self.children:
+            self.reap()
+            self.kill_overdue()
+            time.sleep(0.1)
+        self.server.server_close()
+        if self.metrics_dir is not None:
+            shutil.rmtree(self.metrics_dir, ignore_errors = True)
+
+
+def parse_bind(bind):
+    host, _, port = bind.rpartition(':')
+    return host.strip('[]') or '127.0.0.1', int(port)
+
+
+@click.command()
+@click.option('--bind', default = '127.0.0.1:8000', show_default = True, help = 'Address to listen on, host:port.')
+@click.option('--config', 'config_name', help = 'Config name, defaults to FLASK_CONFIG or production.')
+@click.option('--workers', default = os.cpu_count() or 1, show_default = True, help = 'Worker processes.')
+@click.option('--threads', default = 4, show_default = True, help = 'Requests each worker handles at a time.')
+@click.option('--max-requests', default = 1000, show_default = True,
+              help = 'Requests after which a worker is replaced, 0 never replaces it.')
+@click.option('--max-requests-jitter', default = 100, show_default = True,
+              help = 'Up to this many more requests, chosen at random per worker.')
+@click.option('--warmup', multiple = True, type = str, default = WARMUP_PATHS, show_default = True,
+              help = 'Path requested before the workers start, can be repeated.')
+@click.option('--timeout', default = 30, show_default = True, help = 'Seconds a client may be silent.')
+@click.option('--graceful-timeout', default = 30, show_default = True,
+              help = 'Seconds a stopping worker has to finish its requests.')
+def main(bind, config_name, workers, threads, max_requests, max_requests_jitter, warmup, timeout, graceful_timeout):
+    """Serve the blog from a preloaded app and a pool of forked workers."""
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s')
+    RequestHandler.timeout = timeout
+    host, port = parse_bind(bind)
+    Master(host, port, config_name, workers, threads, max_requests, max_requests_jitter, warmup,
+           graceful_timeout).run()
+
+
+if __name__ == '__main__':
+    main()
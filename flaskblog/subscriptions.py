@@ -0,0 +1,234 @@
+import json
+import logging
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import click
+import requests
+from flask import current_app
+from flask.cli import AppGroup
+from requests.adapters import HTTPAdapter
+
+from flaskblog import db
+from flaskblog.metrics import metrics
+from flaskblog.models import ListSubscription
+
+logger = logging.getLogger(__name__)
+
+subscriptions_cli = AppGroup('subscriptions', help = 'Push the queued mailing list signups to Mailgun.')
+
+DEVELOPERS_LIST = 'devs@app.afridevsforum.com'
+NEWSLETTER_LIST = 'newsletter@app.afridevsforum.com'
+
+MAILGUN_MAX_MEMBERS = 1000  # per call to the bulk members endpoint
+ADDRESS_ERRORS = (400, 422)  # some address in the request was refused
+CONFIGURATION_ERRORS = (401, 403, 404)  # wrong MAIL_API_KEY or list, no signup is at fault
+MAX_RETRY_DELAY = 24 * 60 * 60
+
+
+class MailingListSubscriber(object):
+    """
+    Queued Mailgun mailing list signups.
+
+    ``subscribe`` stores the address in the ``list_subscription`` table and returns straight away.
+    Worker threads (``SUBSCRIPTION_WORKERS``, started on the first subscribe) wait
+    ``SUBSCRIPTION_BATCH_WINDOW`` seconds for more signups to arrive, then post everything due for a
+    list in one call to Mailgun's bulk members endpoint over a pooled HTTP session. Network errors,
+    429 and 5xx answers are retried with exponential backoff, other rejections are final. A batch
+    refused for its addresses (400, 422) is split in halves and pushed again, so only the addresses
+    Mailgun refuses fail. 401, 403 and 404 mean the key or the list is wrong: they are logged and the
+    signups stay queued, retried with backoff until the configuration is fixed. Set
+    ``SUBSCRIPTION_WORKERS`` to 0 and run ``flask subscriptions worker`` to push from a separate process.
+    """
+
+    def __init__(self, app = None):
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._session = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MAILGUN_API_URL', 'https://api.eu.mailgun.net/v3')
+        app.config.setdefault('MAILGUN_TIMEOUT', 10)  # seconds
+        app.config.setdefault('SUBSCRIPTION_WORKERS', 1)
+        app.config.setdefault('SUBSCRIPTION_BATCH_SIZE', MAILGUN_MAX_MEMBERS)
+        app.config.setdefault('SUBSCRIPTION_BATCH_WINDOW', 5)  # seconds to collect signups before a push
+        app.config.setdefault('SUBSCRIPTION_MAX_ATTEMPTS', 8)
+        app.config.setdefault('SUBSCRIPTION_RETRY_DELAY', 60)  # seconds, doubled after every failure
+        app.config.setdefault('SUBSCRIPTION_POLL_INTERVAL', 30)
+        app.config.setdefault('SUBSCRIPTION_LEASE', 300)  # a claimed batch is retried if not done by then
+        app.extensions['subscriptions'] = self
+
+    @property
+    def session(self):
+        """One keep-alive connection pool to Mailgun shared by all the workers."""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    size = max(current_app.config['SUBSCRIPTION_WORKERS'], 1)
+                    session.mount('https://', HTTPAdapter(pool_connections = 1, pool_maxsize = size))
+                    session.mount('http://', HTTPAdapter(pool_connections = 1, pool_maxsize = size))
+                    session.hooks['response'].append(metrics.record_http)
+                    self._session = session
+        return self._session
+
+    def subscribe(self, email, list_address):
+        """Queues ``email`` for ``list_address``, commits the current session."""
+        row = ListSubscription(email = email.strip().lower(), list_address = list_address)
+        db.session.add(row)
+        db.session.commit()
+        if current_app.config['SUBSCRIPTION_WORKERS']:
+            self.start_workers(current_app._get_current_object(), current_app.config['SUBSCRIPTION_WORKERS'])
+            self._wakeup.set()
+        return row
+
+    def start_workers(self, app, count):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            for i in range(len(self._threads), count):
+                thread = threading.Thread(target = self.run_worker, args = [app],
+                                          name = 'list-subscriptions-{}'.format(i), daemon = True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def run_worker(self, app):
+        while not self._stop.is_set():
+            self._stop.wait(app.config['SUBSCRIPTION_BATCH_WINDOW'])
+            try:
+                with app.app_context():
+                    processed = self.process_batch()
+            except Exception:
+                logger.exception('Mailing list subscription worker failed')
+                processed = 0
+            if not processed:
+                self._wakeup.wait(app.config['SUBSCRIPTION_POLL_INTERVAL'])
+                self._wakeup.clear()
+
+    def claim_batch(self):
+        """Marks up to SUBSCRIPTION_BATCH_SIZE due signups as ours and returns them."""
+        config = current_app.config
+        now = datetime.utcnow()
+        token = secrets.token_hex(16)
+        due = db.and_(ListSubscription.status.in_(['pending', 'sending']), ListSubscription.next_attempt_at <= now)
+        ids = db.session.query(ListSubscription.id).filter(due) \
+            .order_by(ListSubscription.next_attempt_at, ListSubscription.id) \
+            .limit(config['SUBSCRIPTION_BATCH_SIZE']) \
+            .subquery()
+        # ``due`` is repeated so a row claimed by another worker in the meantime is skipped
+        ListSubscription.query.filter(ListSubscription.id.in_(db.session.query(ids.c.id)), due) \
+            .update({'status': 'sending', 'claim': token,
+                     'next_attempt_at': now + timedelta(seconds = config['SUBSCRIPTION_LEASE'])},
+                    synchronize_session = False)
+        db.session.commit()
+        return ListSubscription.query.filter_by(claim = token).order_by(ListSubscription.id).all()
+
+    def process_batch(self):
+        """Pushes one batch to Mailgun, a single request per list, returns the number of signups handled."""
+        if not current_app.config.get('MAIL_API_KEY'):
+            logger.warning('MAIL_API_KEY is not set, leaving mailing list signups queued')
+            return 0
+        batch = self.claim_batch()
+        if not batch:
+            return 0
+        lists = OrderedDict()
+        for row in batch:
+            lists.setdefault(row.list_address, []).append(row)
+        for list_address, rows in lists.items():
+            self.push(list_address, rows)
+        db.session.commit()
+        return len(batch)
+
+    def push(self, list_address, rows):
+        """Adds the ``rows`` to the list in one request, halving a rejected request until the bad rows are found."""
+        emails = list(OrderedDict.fromkeys(row.email for row in rows))
+        try:
+            response = self.add_members(list_address, emails)
+        except requests.RequestException as e:
+            logger.warning('Mailgun request for %s failed, retrying later: %s', list_address, e)
+            for row in rows:
+                self._failed(row, e)
+            return
+        if response.ok:
+            for row in rows:
+                row.status = 'done'
+                row.claim = None
+            return
+        status = response.status_code
+        error = 'HTTP {}: {}'.format(status, response.text[:500])
+        if status in CONFIGURATION_ERRORS:
+            logger.error('Mailgun refused the request for %s, check MAIL_API_KEY and the list: %s',
+                         list_address, error)
+            for row in rows:
+                self._failed(row, error, give_up = False)
+            return
+        if status in ADDRESS_ERRORS and len(emails) > 1:
+            # one malformed address fails the whole call, the others must not fail with it
+            first = set(emails[:len(emails) // 2])
+            self.push(list_address, [row for row in rows if row.email in first])
+            self.push(list_address, [row for row in rows if row.email not in first])
+            return
+        final = status < 500 and status != 429
+        for row in rows:
+            self._failed(row, error, final = final)
+
+    def add_members(self, list_address, emails):
+        config = current_app.config
+        members = [dict(address = email, subscribed = True) for email in emails]
+        return self.session.post('{}/lists/{}/members.json'.format(config['MAILGUN_API_URL'].rstrip('/'),
+                                                                    list_address),
+                                 auth = ('api', config['MAIL_API_KEY']),
+                                 data = dict(members = json.dumps(members), upsert = 'yes'),
+                                 timeout = config['MAILGUN_TIMEOUT'])
+
+    def _failed(self, row, error, final = False, give_up = True):
+        """``give_up = False`` retries however many attempts it takes, for errors that are not the row's."""
+        config = current_app.config
+        row.attempts += 1
+        row.last_error = (error if isinstance(error, str) else repr(error))[:1000]
+        row.claim = None
+        if final or give_up and row.attempts >= config['SUBSCRIPTION_MAX_ATTEMPTS']:
+            row.status = 'failed'
+            logger.error('Giving up on %r: %s', row, row.last_error)
+        else:
+            row.status = 'pending'
+            delay = min(config['SUBSCRIPTION_RETRY_DELAY'] * 2 ** min(row.attempts - 1, 20), MAX_RETRY_DELAY)
+            row.next_attempt_at = datetime.utcnow() + timedelta(seconds = delay)
+
+
+subscriptions = MailingListSubscriber()
+
+
+@subscriptions_cli.command('worker')
+@click.option('--workers', default = None, type = int, help = 'Number of worker threads.')
+@click.option('--once', is_flag = True, help = 'Push what is due and exit.')
+def worker_command(workers, once):
+    """Push queued mailing list signups until interrupted."""
+    if once:
+        total = 0
+        while True:
+            processed = subscriptions.process_batch()
+            if not processed:
+                break
+            total += processed
+        click.echo('Processed {} signup(s).'.format(total))
+        return
+    app = current_app._get_current_object()
+    workers = workers or app.config['SUBSCRIPTION_WORKERS'] or 1
+    click.echo('Pushing signups with {} worker(s), press CTRL+C to quit.'.format(workers))
+    subscriptions.start_workers(app, workers)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        subscriptions.stop()
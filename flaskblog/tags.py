@@ -0,0 +1,136 @@
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import exc
+from sqlalchemy.orm import attributes
+
+from flaskblog import db
+from flaskblog.models import Post, Tag, post_tag, slugify_tag
+
+MAX_TAG_LENGTH = 64
+POPULARITY_EPOCH = datetime(2020, 1, 1)
+
+tags_cli = AppGroup('tags', help = 'Maintain the tags and their popularity scores.')
+
+
+def normalize_tag_names(names):
+    """Drops blanks and slug duplicates, keeping the first spelling of every tag in the order given."""
+    seen = {}
+    for name in names or ():
+        name = (name or '').strip()[:MAX_TAG_LENGTH]
+        slug = slugify_tag(name)
+        if slug and slug not in seen:
+            seen[slug] = name
+    return seen
+
+
+def get_or_create_tags(names):
+    """
+    Returns the Tag rows for ``names`` in the same order, creating the missing ones. Existing tags
+    are found with a single SELECT ... WHERE slug IN (...); a tag created by a concurrent request
+    between that SELECT and our INSERT is picked up by retrying the lookup.
+    """
+    wanted = normalize_tag_names(names)
+    if not wanted:
+        return []
+    found = {tag.slug: tag for tag in Tag.query.filter(Tag.slug.in_(list(wanted)))}
+    missing = [name for slug, name in wanted.items() if slug not in found]
+    if missing:
+        try:
+            with db.session.begin_nested():
+                created = [Tag(name = name) for name in missing]
+                db.session.add_all(created)
+        except exc.IntegrityError:
+            found = {tag.slug: tag for tag in Tag.query.filter(Tag.slug.in_(list(wanted)))}
+            created = [Tag(name = name) for slug, name in wanted.items() if slug not in found]
+            db.session.add_all(created)
+        found.update((tag.slug, tag) for tag in created)
+    return [found[slug] for slug in wanted]
+
+
+def set_post_tags(post, names):
+    """Makes ``names`` the tags of ``post``, only the post_tag rows that changed are written."""
+    tags = get_or_create_tags(names)
+    current = post.tag.all() if post.id is not None else []
+    keep = {tag.id for tag in tags if tag.id is not None}
+    for tag in current:
+        if tag.id not in keep:
+            post.tag.remove(tag)
+    current_ids = {tag.id for tag in current}
+    for tag in tags:
+        if tag.id is None or tag.id not in current_ids:
+            post.tag.append(tag)
+    return tags
+
+
+# Popularity is a post count in which every post loses half its weight each TAG_POPULARITY_HALF_LIFE
+# days. Rather than decaying every tag as time passes, a post adds 2 ** (age of the site when posted /
+# half life) to the score of its tags: the scores all shrink by the same factor over time, so ordering
+# by the stored value gives the decayed ranking and only the tags of a changed post are ever written.
+# A float holds the weights for about 80 years at the default 30 day half life.
+
+def post_weight(date_posted, half_life = None):
+    half_life = half_life or current_app.config['TAG_POPULARITY_HALF_LIFE']
+    days = ((date_posted or datetime.utcnow()) - POPULARITY_EPOCH).total_seconds() / 86400.0
+    return 2.0 ** (days / half_life)
+
+
+def popular_tags(limit = None):
+    """The top tags by decayed post count, one query on the popularity index."""
+    limit = limit or current_app.config['FLASKY_POPULAR_TAGS']
+    return Tag.query.filter(Tag.popularity > 0).order_by(Tag.popularity.desc(), Tag.id).limit(limit).all()
+
+
+@db.event.listens_for(db.session, 'before_flush')
+def collect_popularity_changes(session, flush_context, instances):
+    changes = []
+    for obj in session.new.union(session.dirty):
+        if isinstance(obj, Post) and obj not in session.deleted:
+            history = attributes.get_history(obj, 'tag')
+            if history.added or history.deleted:
+                weight = post_weight(obj.date_posted)
+                changes.extend((tag, weight) for tag in history.added)
+                changes.extend((tag, -weight) for tag in history.deleted)
+    with session.no_autoflush:
+        for obj in session.deleted:
+            if isinstance(obj, Post):
+                weight = post_weight(obj.date_posted)
+                changes.extend((tag, -weight) for tag in obj.tag)
+    if changes:
+        session.info.setdefault('tag_popularity_changes', []).extend(changes)
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def apply_popularity_changes(session, flush_context):
+    changes = session.info.pop('tag_popularity_changes', None)
+    if not changes:
+        return
+    deltas = {}
+    for tag, delta in changes:  # new tags only have an id once the flush has run
+        deltas[tag.id] = deltas.get(tag.id, 0.0) + delta
+    table = Tag.__table__
+    connection = session.connection()
+    for tag_id, delta in deltas.items():
+        if tag_id is not None and delta:
+            connection.execute(table.update().where(table.c.id == tag_id)
+                               .values(popularity = table.c.popularity + delta))
+
+
+def rescore():
+    """Recomputes every popularity score from post_tag, returns the number of tags scored."""
+    half_life = current_app.config['TAG_POPULARITY_HALF_LIFE']
+    scores = dict.fromkeys((tag_id for tag_id, in db.session.query(Tag.id)), 0.0)
+    rows = db.session.query(post_tag.c.tag_id, Post.date_posted).join(Post, Post.id == post_tag.c.post_id)
+    for tag_id, date_posted in rows.yield_per(1000):
+        scores[tag_id] += post_weight(date_posted, half_life)
+    db.session.bulk_update_mappings(Tag, [dict(id = tag_id, popularity = score) for tag_id, score in scores.items()])
+    db.session.commit()
+    return len(scores)
+
+
+@tags_cli.command('rescore')
+def rescore_command():
+    """Recompute the popularity of every tag, e.g. after changing TAG_POPULARITY_HALF_LIFE."""
+    click.echo('Scored {} tag(s).'.format(rescore()))
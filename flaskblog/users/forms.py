@@ -4,6 +4,7 @@ from flask_wtf.file import FileField, FileAllowed
 from wtforms import StringField, PasswordField, SubmitField, BooleanField, SelectField, TextAreaField
 from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError, Regexp
 
+from flaskblog.avatars import avatars, InvalidAvatar
 from flaskblog.models import User, Role
 
 
@@ -41,7 +42,7 @@ class UpdateAccountForm(FlaskForm):
     email = StringField('Email', validators = [DataRequired(), Email()])
     country = SelectField('Country', validate_choice = True)
     about_me = TextAreaField('About me')
-    picture = FileField('Update Profile Picture', validators = [FileAllowed(['jpg', 'png', 'jpeg'])])
+    picture = FileField('Update Profile Picture', validators = [FileAllowed(['jpg', 'png', 'jpeg', 'gif', 'webp'])])
     submit = SubmitField('Update')
 
     # for validating if username already exists in database
@@ -58,6 +59,14 @@ class UpdateAccountForm(FlaskForm):
             if user:
                 raise ValidationError('That email is taken. Please choose a different one')
 
+    # size and pixel count limits, checked from the image header before anything is decoded
+    def validate_picture(self, picture):
+        if picture.data:
+            try:
+                avatars.check(picture.data.stream)
+            except InvalidAvatar as e:
+                raise ValidationError(str(e))
+
 
 class RequestResetForm(FlaskForm):
     email = StringField('Email', validators = [DataRequired(), Email()])
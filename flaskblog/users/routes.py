@@ -1,39 +1,25 @@
-import json
-
-import requests
 from flask import render_template, url_for, flash, redirect, request, abort, current_app, Blueprint
 from flask_login import login_user, current_user, logout_user, login_required
 
-from flaskblog import db, bcrypt
+from flaskblog import db
+from flaskblog.auth import session_guard, client_address
+from flaskblog.avatars import avatars, avatar_url
+from flaskblog.caching import response_cache
+from flaskblog.counters import get_count, USERS
+from flaskblog.countries import country_choices
 from flaskblog.decorators import admin_required
+from flaskblog.feed import posts_by_author
 from flaskblog.models import User, Post, Role
+from flaskblog.passwords import passwords
+from flaskblog.subscriptions import subscriptions, DEVELOPERS_LIST
 from flaskblog.users.forms import (RegistrationForm, LoginForm, UpdateAccountForm,
                                    RequestResetForm, ResetPasswordForm, EditProfileAdminForm)
-from flaskblog.users.utils import save_picture, send_reset_email, send_confirmation_email
-
-app = current_app._get_current_object()
+from flaskblog.users.utils import send_reset_email, send_confirmation_email
 
 users = Blueprint('users', __name__)
 
-try:
-    r = requests.get('https://restcountries.eu/rest/v2/region/africa')
-    countries = r.json()
-except ValueError:
-    with open('flaskblog\static\json\countries.json') as json_file:
-        countries = json.load(json_file)
 
-
-@users.before_app_request
-def before_request():
-    # user = Comment.query.get(2)
-    # db.session.delete(user)
-    # db.session.commit()
-    if current_user.is_authenticated:
-        if not current_user.confirmed \
-                and request.endpoint \
-                and request.blueprint != 'users' \
-                and request.endpoint != 'static':
-            return redirect(url_for('users.unconfirmed'))
+# unconfirmed accounts are sent to users.unconfirmed by flaskblog/auth.py
 
 
 @users.route("/unconfirmed")
@@ -43,26 +29,18 @@ def unconfirmed():
     return render_template('unconfirmed.html')
 
 
-def subscribe_user(email, user_group, api_key):
-    resp = requests.post(f"https://api.eu.mailgun.net/v3/lists/{user_group}/members",
-                         auth = ("api", api_key),
-                         data = {"subscribed": True, "address": email})
-
-    print(resp.status_code)
-
-
 @users.route("/register", methods = ['GET', 'POST'])
 def register():
-    user_count = db.session.query(User).count()
+    user_count = get_count(USERS)
 
     if current_user.is_authenticated:
         return redirect(url_for('main.home'))
 
     form = RegistrationForm()
-    form.country.choices = [(i['name'], i['name']) for i in countries]
+    form.country.choices = country_choices()
 
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        hashed_password = passwords.hash(form.password.data, client = client_address(), account = form.email.data)
         user = User(username = form.username.data, email = form.email.data, country = form.country.data,
                     password = hashed_password)
         db.session.add(user)
@@ -71,7 +49,7 @@ def register():
         flash('A confirmation email has been sent to you by email. Please check your inbox or spam folder.', 'info')
         # flash('Your account has been created! You are now able to log in',
         #     'success')  # messages that pop up, 'success' is used for bootstrap
-        subscribe_user(user.email, "devs@app.afridevsforum.com", app.config['MAIL_API_KEY'])
+        subscriptions.subscribe(user.email, DEVELOPERS_LIST)
         return redirect(url_for('users.login'))
     return render_template('register.html', title = 'Register', form = form, user_count = user_count)
 
@@ -83,8 +61,9 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(email = form.email.data).first()
-        if user and bcrypt.check_password_hash(user.password, form.password.data):
+        if user and passwords.verify(user, form.password.data, client = client_address()):
             login_user(user, remember = form.remember.data)
+            db.session.commit()  # saves the password rehashed at the current BCRYPT_LOG_ROUNDS, if any
             next_page = request.args.get('next')  # gets the 'next 'parameter(s) from url if it exists
             return redirect(next_page) if next_page else redirect(
                 url_for('main.home'))  # ternary condition for next_page
@@ -100,13 +79,13 @@ def logout():
 
 
 @users.route("/user-profile/<string:username>")
+@response_cache.cached(tags = lambda username: ('posts', 'users'))
 def user_profile(username):
     page = request.args.get('page', 1, type = int)
     user = User.query.filter_by(username = username).first_or_404()
-    image_file = url_for('static', filename = 'profile_pics/' + user.image_file)
-    posts = Post.query.filter_by(author = user) \
-        .order_by(Post.date_posted.desc()) \
-        .paginate(page = page, per_page = current_app.config['FLASKY_POSTS_PER_PAGE'])
+    image_file = avatar_url(user.image_file, 256)
+    posts = posts_by_author(user, page, current_app.config['FLASKY_POSTS_PER_PAGE'],
+                            after = request.args.get('after'), before = request.args.get('before'))
     if user and posts is None:
         abort(404)
     return render_template('user_profile.html', user = user, image_file = image_file, posts = posts)
@@ -116,12 +95,11 @@ def user_profile(username):
 @login_required  # decorator to tell the user must be logged in in order to access the account page/view
 def account():
     form = UpdateAccountForm()
-    form.country.choices = [(i['name'], i['name']) for i in countries]
+    form.country.choices = country_choices()
 
     if form.validate_on_submit():
         if form.picture.data:
-            picture_file = save_picture(form.picture.data)
-            current_user.image_file = picture_file
+            avatars.submit(current_user, form.picture.data)  # the new picture shows once it is processed
         current_user.username = form.username.data  # update the current user's username with the one if form
         current_user.email = form.email.data
         current_user.country = form.country.data
@@ -134,7 +112,7 @@ def account():
         form.email.data = current_user.email
         form.country.data = current_user.country
         form.about_me.data = current_user.about_me
-    image_file = url_for('static', filename = 'profile_pics/' + current_user.image_file)
+    image_file = avatar_url(current_user.image_file, 256)
     return render_template('account.html', title = 'Account', image_file = image_file, form = form)
 
 
@@ -145,6 +123,7 @@ def account():
 def edit_profile_admin(id):
     user = User.query.get_or_404(id)
     form = EditProfileAdminForm(user = user)
+    form.country.choices = country_choices()
     if form.validate_on_submit():
         user.email = form.email.data
         user.username = form.username.data
@@ -189,7 +168,7 @@ def reset_token(token):
         return redirect(url_for('users.reset_request'))
     form = ResetPasswordForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        hashed_password = passwords.hash(form.password.data, client = client_address(), account = user.email)
         user.password = hashed_password
         db.session.commit()
         flash('Your password has been updated! You are now able to log in',
@@ -205,6 +184,7 @@ def confirm(token):
         return redirect(url_for('main.home'))
     if current_user.confirm(token):
         db.session.commit()
+        session_guard.stamp(current_user)
         flash('You have confirmed your account. Thanks!', 'success')
     else:
         flash('The confirmation link is invalid or has expired.', 'warning')
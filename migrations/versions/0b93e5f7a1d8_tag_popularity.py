@@ -0,0 +1,43 @@
+"""Tag popularity
+
+Revision ID: 0b93e5f7a1d8
+Revises: f2b8d61c4e07
+Create Date: 2026-10-18 13:41:55.318602
+
+"""
+from datetime import datetime
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '0b93e5f7a1d8'
+down_revision = 'f2b8d61c4e07'
+branch_labels = None
+depends_on = None
+
+# flaskblog.tags as of this revision, `flask tags rescore` redoes this with the configured half life
+POPULARITY_EPOCH = datetime(2020, 1, 1)
+HALF_LIFE = 30
+
+
+def upgrade():
+    op.add_column('tag', sa.Column('popularity', sa.Float(), nullable = False, server_default = '0'))
+    op.create_index(op.f('ix_tag_popularity'), 'tag', ['popularity'], unique = False)
+
+    # backfill, afterwards the post events keep the scores current
+    connection = op.get_bind()
+    scores = {}
+    for tag_id, date_posted in connection.execute(sa.text('SELECT post_tag.tag_id, post.date_posted FROM post_tag '
+                                                          'JOIN post ON post.id = post_tag.post_id')):
+        if isinstance(date_posted, str):  # SQLite hands back text
+            date_posted = datetime.fromisoformat(date_posted)
+        days = (date_posted - POPULARITY_EPOCH).total_seconds() / 86400.0
+        scores[tag_id] = scores.get(tag_id, 0.0) + 2.0 ** (days / HALF_LIFE)
+    for tag_id, score in scores.items():
+        connection.execute(sa.text('UPDATE tag SET popularity = :score WHERE id = :id'), score = score, id = tag_id)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_tag_popularity'), table_name = 'tag')
+    op.drop_column('tag', 'popularity')
@@ -0,0 +1,28 @@
+"""Keyset pagination indexes
+
+Revision ID: 3b7e1c9d2a40
+Revises: e52da0390328
+Create Date: 2026-10-18 09:12:31.402118
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '3b7e1c9d2a40'
+down_revision = 'e52da0390328'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_post_date_posted_id', 'post', ['date_posted', 'id'], unique = False)
+    op.create_index('ix_post_user_id_date_posted_id', 'post', ['user_id', 'date_posted', 'id'], unique = False)
+    op.create_index('ix_comment_timestamp_id', 'comment', ['timestamp', 'id'], unique = False)
+    op.create_index('ix_comment_post_id_timestamp_id', 'comment', ['post_id', 'timestamp', 'id'], unique = False)
+
+
+def downgrade():
+    op.drop_index('ix_comment_post_id_timestamp_id', table_name = 'comment')
+    op.drop_index('ix_comment_timestamp_id', table_name = 'comment')
+    op.drop_index('ix_post_user_id_date_posted_id', table_name = 'post')
+    op.drop_index('ix_post_date_posted_id', table_name = 'post')
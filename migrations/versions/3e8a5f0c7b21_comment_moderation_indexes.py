@@ -0,0 +1,24 @@
+"""Comment moderation indexes
+
+Revision ID: 3e8a5f0c7b21
+Revises: 7c4e1b9d2a60
+Create Date: 2026-10-18 14:52:09.774310
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '3e8a5f0c7b21'
+down_revision = '7c4e1b9d2a60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_comment_disabled_timestamp_id', 'comment', ['disabled', 'timestamp', 'id'], unique = False)
+    op.create_index('ix_comment_author_id_timestamp_id', 'comment', ['author_id', 'timestamp', 'id'], unique = False)
+
+
+def downgrade():
+    op.drop_index('ix_comment_author_id_timestamp_id', table_name = 'comment')
+    op.drop_index('ix_comment_disabled_timestamp_id', table_name = 'comment')
@@ -0,0 +1,28 @@
+"""Worker claim indexes
+
+Revision ID: 5d2c8e7a4b19
+Revises: 3e8a5f0c7b21
+Create Date: 2026-10-18 17:21:40.318254
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5d2c8e7a4b19'
+down_revision = '3e8a5f0c7b21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_outbox_message_claim'), 'outbox_message', ['claim'], unique = False)
+    op.create_index(op.f('ix_list_subscription_claim'), 'list_subscription', ['claim'], unique = False)
+    op.create_index(op.f('ix_avatar_job_claim'), 'avatar_job', ['claim'], unique = False)
+    op.create_index('ix_avatar_job_user_id_id', 'avatar_job', ['user_id', 'id'], unique = False)
+
+
+def downgrade():
+    op.drop_index('ix_avatar_job_user_id_id', table_name = 'avatar_job')
+    op.drop_index(op.f('ix_avatar_job_claim'), table_name = 'avatar_job')
+    op.drop_index(op.f('ix_list_subscription_claim'), table_name = 'list_subscription')
+    op.drop_index(op.f('ix_outbox_message_claim'), table_name = 'outbox_message')
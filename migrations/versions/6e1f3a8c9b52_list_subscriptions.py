@@ -0,0 +1,37 @@
+"""Mailing list subscription queue
+
+Revision ID: 6e1f3a8c9b52
+Revises: c5a9e27b4f13
+Create Date: 2026-10-18 11:48:31.207415
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '6e1f3a8c9b52'
+down_revision = 'c5a9e27b4f13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('list_subscription',
+                    sa.Column('id', sa.Integer(), nullable = False),
+                    sa.Column('list_address', sa.String(length = 120), nullable = False),
+                    sa.Column('email', sa.String(length = 120), nullable = False),
+                    sa.Column('status', sa.String(length = 10), nullable = False),
+                    sa.Column('attempts', sa.Integer(), nullable = False),
+                    sa.Column('last_error', sa.Text(), nullable = True),
+                    sa.Column('claim', sa.String(length = 32), nullable = True),
+                    sa.Column('created_at', sa.DateTime(), nullable = False),
+                    sa.Column('next_attempt_at', sa.DateTime(), nullable = False),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index('ix_list_subscription_status_next_attempt_at', 'list_subscription',
+                    ['status', 'next_attempt_at'], unique = False)
+
+
+def downgrade():
+    op.drop_index('ix_list_subscription_status_next_attempt_at', table_name = 'list_subscription')
+    op.drop_table('list_subscription')
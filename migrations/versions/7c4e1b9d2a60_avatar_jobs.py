@@ -0,0 +1,45 @@
+"""Avatar jobs
+
+Revision ID: 7c4e1b9d2a60
+Revises: 0b93e5f7a1d8
+Create Date: 2026-10-18 14:20:43.581907
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '7c4e1b9d2a60'
+down_revision = '0b93e5f7a1d8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('avatar_job',
+                    sa.Column('id', sa.Integer(), nullable = False),
+                    sa.Column('user_id', sa.Integer(), nullable = False),
+                    sa.Column('upload', sa.String(length = 80), nullable = False),
+                    sa.Column('status', sa.String(length = 10), nullable = False),
+                    sa.Column('attempts', sa.Integer(), nullable = False),
+                    sa.Column('last_error', sa.Text(), nullable = True),
+                    sa.Column('claim', sa.String(length = 32), nullable = True),
+                    sa.Column('created_at', sa.DateTime(), nullable = False),
+                    sa.Column('next_attempt_at', sa.DateTime(), nullable = False),
+                    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index('ix_avatar_job_status_next_attempt_at', 'avatar_job', ['status', 'next_attempt_at'],
+                    unique = False)
+    # content addressed names ('<digest>-125.jpg') are longer than the old random ones
+    with op.batch_alter_table('user', schema = None) as batch_op:
+        batch_op.alter_column('image_file', existing_type = sa.String(length = 20), type_ = sa.String(length = 64),
+                              existing_nullable = False)
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema = None) as batch_op:
+        batch_op.alter_column('image_file', existing_type = sa.String(length = 64), type_ = sa.String(length = 20),
+                              existing_nullable = False)
+    op.drop_index('ix_avatar_job_status_next_attempt_at', table_name = 'avatar_job')
+    op.drop_table('avatar_job')
@@ -0,0 +1,37 @@
+"""Site counters
+
+Revision ID: 8d41f0a6c2b7
+Revises: 3b7e1c9d2a40
+Create Date: 2026-10-18 10:02:47.118305
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '8d41f0a6c2b7'
+down_revision = '3b7e1c9d2a40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('counter',
+                    sa.Column('name', sa.String(length = 80), nullable = False),
+                    sa.Column('value', sa.Integer(), nullable = False),
+                    sa.PrimaryKeyConstraint('name')
+                    )
+    op.add_column('post', sa.Column('comment_count', sa.Integer(), nullable = False, server_default = '0'))
+
+    # backfill, afterwards the model events keep the values current
+    op.execute("INSERT INTO counter (name, value) SELECT 'users', count(*) FROM \"user\"")
+    op.execute("INSERT INTO counter (name, value) SELECT 'posts', count(*) FROM post")
+    op.execute("INSERT INTO counter (name, value) "
+               "SELECT 'tag_posts:' || tag.slug, count(*) FROM post_tag JOIN tag ON tag.id = post_tag.tag_id "
+               "WHERE tag.slug IS NOT NULL GROUP BY tag.slug")
+    op.execute("UPDATE post SET comment_count = (SELECT count(*) FROM comment WHERE comment.post_id = post.id)")
+
+
+def downgrade():
+    op.drop_column('post', 'comment_count')
+    op.drop_table('counter')
@@ -0,0 +1,31 @@
+"""Rendered post and comment content
+
+Revision ID: a4d7c2e81f36
+Revises: 6e1f3a8c9b52
+Create Date: 2026-10-18 12:16:42.530918
+
+Existing rows are left unrendered, fill them with `flask content rerender` after upgrading.
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'a4d7c2e81f36'
+down_revision = '6e1f3a8c9b52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('post', sa.Column('content_html', sa.Text(), nullable = True))
+    op.add_column('post', sa.Column('excerpt', sa.Text(), nullable = True))
+    op.add_column('post', sa.Column('render_version', sa.String(length = 12), nullable = True))
+    op.add_column('comment', sa.Column('render_version', sa.String(length = 12), nullable = True))
+
+
+def downgrade():
+    op.drop_column('comment', 'render_version')
+    op.drop_column('post', 'render_version')
+    op.drop_column('post', 'excerpt')
+    op.drop_column('post', 'content_html')
@@ -0,0 +1,42 @@
+"""Mail outbox
+
+Revision ID: c5a9e27b4f13
+Revises: 8d41f0a6c2b7
+Create Date: 2026-10-18 11:20:05.664810
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c5a9e27b4f13'
+down_revision = '8d41f0a6c2b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('outbox_message',
+                    sa.Column('id', sa.Integer(), nullable = False),
+                    sa.Column('subject', sa.String(length = 255), nullable = False),
+                    sa.Column('sender', sa.String(length = 255), nullable = True),
+                    sa.Column('recipients', sa.Text(), nullable = False),
+                    sa.Column('reply_to', sa.String(length = 255), nullable = True),
+                    sa.Column('body', sa.Text(), nullable = True),
+                    sa.Column('html', sa.Text(), nullable = True),
+                    sa.Column('status', sa.String(length = 10), nullable = False),
+                    sa.Column('attempts', sa.Integer(), nullable = False),
+                    sa.Column('last_error', sa.Text(), nullable = True),
+                    sa.Column('claim', sa.String(length = 32), nullable = True),
+                    sa.Column('created_at', sa.DateTime(), nullable = False),
+                    sa.Column('next_attempt_at', sa.DateTime(), nullable = False),
+                    sa.Column('sent_at', sa.DateTime(), nullable = True),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index('ix_outbox_message_status_next_attempt_at', 'outbox_message', ['status', 'next_attempt_at'],
+                    unique = False)
+
+
+def downgrade():
+    op.drop_index('ix_outbox_message_status_next_attempt_at', table_name = 'outbox_message')
+    op.drop_table('outbox_message')
@@ -0,0 +1,76 @@
+"""Unique tag slugs and post_tag keys
+
+Revision ID: f2b8d61c4e07
+Revises: a4d7c2e81f36
+Create Date: 2026-10-18 13:02:17.904125
+
+Tags with the same slug are merged into the oldest one and post_tag is rebuilt without duplicate
+rows. The merge is not undone by the downgrade.
+
+"""
+import re
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'f2b8d61c4e07'
+down_revision = 'a4d7c2e81f36'
+branch_labels = None
+depends_on = None
+
+
+def slugify_tag(s):
+    # flaskblog.models.slugify_tag as of this revision
+    return re.sub(r'[^\w]+', '-', s).strip('-').lower()
+
+
+def rebuild_post_tag(primary_key):
+    op.create_table('post_tag_new',
+                    sa.Column('post_id', sa.Integer(), nullable = not primary_key),
+                    sa.Column('tag_id', sa.Integer(), nullable = not primary_key),
+                    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+                    sa.ForeignKeyConstraint(['tag_id'], ['tag.id'], ),
+                    *([sa.PrimaryKeyConstraint('post_id', 'tag_id')] if primary_key else [])
+                    )
+    op.execute('INSERT INTO post_tag_new (post_id, tag_id) SELECT DISTINCT post_id, tag_id FROM post_tag '
+               'WHERE post_id IS NOT NULL AND tag_id IS NOT NULL')
+    op.drop_table('post_tag')
+    op.rename_table('post_tag_new', 'post_tag')
+
+
+def upgrade():
+    connection = op.get_bind()
+    keepers = {}
+    for tag_id, name, slug in connection.execute(sa.text('SELECT id, name, slug FROM tag ORDER BY id')):
+        new_slug = slugify_tag(name or slug or '')
+        keeper = keepers.setdefault(new_slug, tag_id) if new_slug else None
+        if keeper == tag_id:
+            connection.execute(sa.text('UPDATE tag SET slug = :slug WHERE id = :id'), slug = new_slug, id = tag_id)
+            continue
+        if keeper is None:  # nothing left of the name, drop the tag
+            connection.execute(sa.text('DELETE FROM post_tag WHERE tag_id = :id'), id = tag_id)
+        else:
+            connection.execute(sa.text('UPDATE post_tag SET tag_id = :keeper WHERE tag_id = :id'),
+                               keeper = keeper, id = tag_id)
+        connection.execute(sa.text('DELETE FROM tag WHERE id = :id'), id = tag_id)
+
+    rebuild_post_tag(primary_key = True)
+    op.create_index('ix_post_tag_tag_id_post_id', 'post_tag', ['tag_id', 'post_id'], unique = False)
+    with op.batch_alter_table('tag', schema = None) as batch_op:
+        batch_op.alter_column('slug', existing_type = sa.String(length = 64), nullable = False)
+        batch_op.create_unique_constraint('uq_tag_slug', ['slug'])
+
+    # merged tags share one counter now
+    op.execute("DELETE FROM counter WHERE name LIKE 'tag_posts:%'")
+    op.execute("INSERT INTO counter (name, value) "
+               "SELECT 'tag_posts:' || tag.slug, count(*) FROM post_tag JOIN tag ON tag.id = post_tag.tag_id "
+               "GROUP BY tag.slug")
+
+
+def downgrade():
+    with op.batch_alter_table('tag', schema = None) as batch_op:
+        batch_op.drop_constraint('uq_tag_slug', type_ = 'unique')
+        batch_op.alter_column('slug', existing_type = sa.String(length = 64), nullable = True)
+    op.drop_index('ix_post_tag_tag_id_post_id', table_name = 'post_tag')
+    rebuild_post_tag(primary_key = False)
@@ -3,4 +3,4 @@ from flaskblog import create_app
 app = create_app()
 
 if __name__ == '__main__':
-    app.run()
+    app.run()  # development server, production runs `python -m flaskblog.serve`
@@ -0,0 +1,41 @@
+import fnmatch
+import threading
+import time
+
+
+class FakeRedis(object):
+    """In-memory stand-in for the subset of the redis-py client used by RedisCacheBackend."""
+
+    def __init__(self):
+        self.data = {}  # key -> (expires, bytes)
+        self.lock = threading.Lock()
+
+    def _live(self, key):
+        entry = self.data.get(key)
+        if entry is not None and entry[0] and entry[0] < time.time():
+            del self.data[key]
+            entry = None
+        return entry
+
+    def get(self, name):
+        with self.lock:
+            entry = self._live(name)
+            return None if entry is None else entry[1]
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, name, value, ex = None):
+        assert isinstance(value, bytes)
+        with self.lock:
+            self.data[name] = (time.time() + ex if ex else 0, value)
+        return True
+
+    def delete(self, *names):
+        with self.lock:
+            return sum(self.data.pop(name, None) is not None for name in names)
+
+    def scan_iter(self, match = '*'):
+        with self.lock:
+            keys = [key for key in self.data if fnmatch.fnmatchcase(key, match)]
+        return iter(keys)
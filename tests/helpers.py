@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from flaskblog import create_app, db
+from flaskblog.config import TestingConfig
+
+
+def make_app(config_class = TestingConfig):
+    """Builds an app on an empty in-memory database with the default roles and search index."""
+    app = create_app(config_class)
+    with app.app_context():
+        db.create_all()
+        from flaskblog.models import Role
+        Role.insert_roles()
+        from flaskblog.search import init_index
+        init_index()
+    return app
+
+
+def seed(users = 3, posts_per_user = 4, comments_per_post = 2, tags = ('python', 'flask', 'africa')):
+    """Adds a small synthetic forum, must be called inside an app context."""
+    from flaskblog.models import User, Post, Tag, Comment
+    tag_rows = [Tag(name = name) for name in tags]
+    db.session.add_all(tag_rows)
+    start = datetime(2020, 1, 1)
+    authors = []
+    for u in range(users):
+        user = User(username = 'user%d' % u, email = 'user%d@example.com' % u, country = 'Kenya',
+                    password = 'x', confirmed = True)
+        db.session.add(user)
+        authors.append(user)
+    n = 0
+    for user in authors:
+        for p in range(posts_per_user):
+            n += 1
+            post = Post(title = 'Post %d' % n, content = '<p>Content of post %d</p>' % n, author = user,
+                        date_posted = start + timedelta(hours = n))
+            post.tag.append(tag_rows[n % len(tag_rows)])
+            db.session.add(post)
+            for c in range(comments_per_post):
+                db.session.add(Comment(body = 'comment %d' % c, post = post, author = authors[c % len(authors)],
+                                       timestamp = start + timedelta(hours = n, minutes = c)))
+    db.session.commit()
+
+
+@contextmanager
+def count_queries(app, engine = None):
+    """Collects every SQL statement sent to the app's database (or ``engine``) while the block runs."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = engine or db.get_engine(app)
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+class QueryCountMixin(object):
+    """unittest mixin for pinning a view to a fixed number of SQL statements."""
+
+    @contextmanager
+    def assertNumQueries(self, app, expected):
+        with count_queries(app) as statements:
+            yield statements
+        if len(statements) != expected:
+            self.fail('%d queries executed, %d expected:\n%s' % (len(statements), expected,
+                                                                 '\n'.join(statements)))
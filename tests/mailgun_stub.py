@@ -0,0 +1,47 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class MailgunStub(object):
+    """
+    Local stand-in for the Mailgun API. Records every request and answers with the queued status
+    codes, 200 once they run out. Keep-alive is on so tests can see whether connections are reused.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.statuses = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                form = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+                stub.requests.append(dict(path = self.path, form = form, client = self.client_address,
+                                          authorization = self.headers.get('Authorization')))
+                status = stub.statuses.pop(0) if stub.statuses else 200
+                body = json.dumps(dict(message = 'stub')).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/v3'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target = self.server.serve_forever, daemon = True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,84 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from flask import url_for
+
+from flaskblog.assets import build_assets, minify_css, assets
+from helpers import make_app
+
+MAIN_CSS = '''/* page layout */
+body {
+    background: #fafafa;
+    font-family: "Open Sans", sans-serif;
+}
+
+.content-section > p::before { content: "a ,  b"; }
+''' * 20
+
+
+class TestStaticAssets(unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()
+        self.app.static_folder = tempfile.mkdtemp()
+        for name, content in (('css/main.css', MAIN_CSS), ('js/site.js', 'var x = 1;\n' * 50),
+                              ('js/site.min.js', 'var x=1;' * 50)):
+            path = os.path.join(self.app.static_folder, name)
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            with open(path, 'w') as f:
+                f.write(content)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.app.static_folder)
+
+    def build(self):
+        manifest = build_assets(self.app.static_folder)
+        assets.load(self.app)
+        return manifest
+
+    def test_minify_css_keeps_strings(self):
+        self.assertEqual(minify_css('a  >  b {\n  content: "x ,  y" ; /* note */ }'), 'a>b{content: "x ,  y";}')
+
+    def test_built_files_are_linked_and_cached_forever(self):
+        manifest = self.build()
+        self.assertEqual(sorted(manifest), ['css/main.css', 'js/site.min.js'])  # site.js is the .min source
+        with self.app.test_request_context():
+            url = url_for('static', filename = 'css/main.css')
+        self.assertEqual(url, '/static/' + manifest['css/main.css'])
+
+        response = self.client.get(url, headers = {'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertEqual(gzip.decompress(response.data).decode('utf-8').count('body{'), 20)
+
+        response = self.client.get(url)
+        self.assertIsNone(response.headers.get('Content-Encoding'))
+        self.assertTrue(response.data.startswith(b'body{'))
+
+    def test_rebuild_keeps_the_previous_files_only(self):
+        first = self.build()['css/main.css']
+        for content in ('body { color: red; }', 'body { color: blue; }'):
+            with open(os.path.join(self.app.static_folder, 'css/main.css'), 'w') as f:
+                f.write(content)
+            second = self.build()['css/main.css']
+        dist = os.listdir(os.path.join(self.app.static_folder, 'dist/css'))
+        self.assertNotIn(os.path.basename(first), dist)
+        self.assertIn(os.path.basename(second), dist)
+        self.assertEqual(len([name for name in dist if not name.endswith('.gz')]), 2)
+
+    def test_unbuilt_files_are_served_as_before(self):
+        with self.app.test_request_context():
+            self.assertEqual(url_for('static', filename = 'css/main.css'), '/static/css/main.css')
+        response = self.client.get('/static/css/main.css')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('immutable', response.headers.get('Cache-Control', ''))
+        response.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
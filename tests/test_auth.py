@@ -0,0 +1,96 @@
+import unittest
+
+from flask_login.utils import _create_identifier
+
+from flaskblog import db, bcrypt
+from flaskblog.auth import client_address
+from flaskblog.config import TestingConfig
+from helpers import make_app, QueryCountMixin
+
+
+class ProxiedConfig(TestingConfig):
+    TRUSTED_PROXIES = 1
+
+
+class TestSessionGuard(QueryCountMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()  # no TRUSTED_PROXIES, as in a deployment that has not set it
+        with self.app.app_context():
+            from flaskblog.models import User
+            db.session.add(User(username = 'amina', email = 'amina@example.com', country = 'Kenya',
+                                password = bcrypt.generate_password_hash('pw').decode('utf-8')))
+            db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/login', data = dict(email = 'amina@example.com', password = 'pw'))
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.drop_all()
+
+    def confirm(self):
+        from flaskblog.models import User
+        with self.app.app_context():
+            user = User.query.one()
+            token = user.generate_confirmation_token().decode('utf-8')
+        return self.client.get('/confirm/' + token)
+
+    def test_unconfirmed_users_are_redirected_until_they_confirm(self):
+        response = self.client.get('/about')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/unconfirmed', response.headers['Location'])
+        self.confirm()
+        self.assertEqual(self.client.get('/about').status_code, 200)
+
+    def test_static_files_skip_the_user_query(self):
+        self.confirm()
+        with self.assertNumQueries(self.app, 0):
+            self.client.get('/static/css/main.css').close()
+
+    def test_session_from_another_client_is_signed_out(self):
+        self.confirm()
+        response = self.client.get('/account', headers = {'User-Agent': 'someone else'})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/login', response.headers['Location'])
+
+    def test_permanent_session_from_another_client_is_only_made_not_fresh(self):
+        self.confirm()
+        with self.client.session_transaction() as session:
+            session.permanent = True
+        self.assertEqual(self.client.get('/account', headers = {'User-Agent': 'someone else'}).status_code, 200)
+        with self.client.session_transaction() as session:
+            self.assertIs(session['_fresh'], False)
+            self.assertIn('_user_id', session)
+
+    def test_sessions_made_by_flask_login_stay_signed_in(self):
+        from flaskblog.models import User
+        with self.app.app_context():
+            user = User.query.one()
+            user.confirmed = True
+            db.session.commit()
+            user_id = user.get_id()
+        headers = {'User-Agent': 'Firefox', 'X-Forwarded-For': '1.2.3.4'}
+        with self.app.test_request_context(headers = headers):
+            identifier = _create_identifier()  # what 'strong' protection stored in the session
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session.update(_user_id = user_id, _fresh = True, _id = identifier)
+        self.assertEqual(client.get('/account', headers = headers).status_code, 200)
+
+
+class TestClientAddress(unittest.TestCase):
+
+    def address(self, config_class, forwarded_for):
+        app = make_app(config_class)
+        app.add_url_rule('/address', 'address', client_address)
+        return app.test_client().get('/address', headers = {'X-Forwarded-For': forwarded_for},
+                                     environ_base = {'REMOTE_ADDR': '10.0.0.2'}).data
+
+    def test_forwarded_for_is_only_trusted_from_configured_proxies(self):
+        self.assertEqual(self.address(TestingConfig, '6.6.6.6'), b'10.0.0.2')
+        # the client made up the first entry, the proxy appended the address it saw
+        self.assertEqual(self.address(ProxiedConfig, '6.6.6.6, 1.2.3.4'), b'1.2.3.4')
+
+
+if __name__ == '__main__':
+    unittest.main()
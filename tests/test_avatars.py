@@ -0,0 +1,135 @@
+import io
+import os
+import shutil
+import tempfile
+import struct
+import time
+import unittest
+import zlib
+
+from PIL import Image
+
+from flaskblog import db, bcrypt
+from flaskblog.config import TestingConfig
+from helpers import make_app
+
+
+def picture(size = (600, 400), format = 'JPEG', mode = 'RGB'):
+    data = io.BytesIO()
+    Image.new(mode, size, 'orange').save(data, format)
+    data.seek(0)
+    return data
+
+
+def png_header(width, height):
+    """A PNG that only declares its size, the way a decompression bomb starts."""
+    def chunk(kind, body):
+        return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body))
+    return io.BytesIO(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+                      + chunk(b'IDAT', zlib.compress(b'\0' * 1024)) + chunk(b'IEND', b''))
+
+
+class TestAvatars(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        class AvatarConfig(TestingConfig):
+            AVATAR_DIR = os.path.join(self.directory, 'profile_pics')
+            AVATAR_UPLOAD_DIR = os.path.join(self.directory, 'uploads')
+            AVATAR_MAX_PIXELS = 1000 * 1000
+
+        os.makedirs(AvatarConfig.AVATAR_DIR)
+        self.app = make_app(AvatarConfig)
+        with self.app.app_context():
+            from flaskblog.models import User
+            db.session.add(User(username = 'amina', email = 'amina@example.com', country = 'Kenya', confirmed = True,
+                                password = bcrypt.generate_password_hash('pw').decode('utf-8')))
+            db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/login', data = dict(email = 'amina@example.com', password = 'pw'))
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.drop_all()
+        shutil.rmtree(self.directory)
+
+    def upload(self, data, filename = 'me.jpg'):
+        return self.client.post('/account', data = dict(username = 'amina', email = 'amina@example.com',
+                                                        country = 'Kenya', picture = (data, filename)),
+                                content_type = 'multipart/form-data')
+
+    def image_file(self):
+        from flaskblog.models import User
+        with self.app.app_context():
+            return User.query.one().image_file
+
+    def test_upload_is_resized_by_the_worker(self):
+        from flaskblog.avatars import avatars, avatar_url, AVATAR_SIZES
+        self.assertEqual(self.upload(picture()).status_code, 302)
+        self.assertEqual(self.image_file(), 'default.jpg')  # not processed yet
+        with self.app.app_context():
+            self.assertEqual(avatars.process_batch(), 1)
+        image_file = self.image_file()
+        name = image_file.split('-')[0]
+        files = sorted(os.listdir(self.app.config['AVATAR_DIR']))
+        self.assertEqual(files, sorted('{}-{}.{}'.format(name, size, ext) for size in AVATAR_SIZES
+                                       for ext in ('jpg', 'webp')))
+        with Image.open(os.path.join(self.app.config['AVATAR_DIR'], name + '-64.webp')) as small:
+            self.assertEqual(small.size, (64, 64))
+        with self.app.test_request_context():
+            self.assertEqual(avatar_url(image_file, 65), '/static/profile_pics/{}-125.jpg'.format(name))
+            self.assertEqual(avatar_url(image_file, 32, 'webp'), '/static/profile_pics/{}-32.webp'.format(name))
+            self.assertIsNone(avatar_url('0214a7d68ecf74c3.jpg', 32, 'webp'))
+
+    def test_same_picture_gets_the_same_files(self):
+        from flaskblog.avatars import avatars, AVATAR_SIZES
+        self.upload(picture())
+        self.upload(picture())
+        with self.app.app_context():
+            self.assertEqual(avatars.process_batch(), 2)
+        self.assertEqual(len(os.listdir(self.app.config['AVATAR_DIR'])), 2 * len(AVATAR_SIZES))
+        self.assertEqual(len(os.listdir(self.app.config['AVATAR_UPLOAD_DIR'])), 1)
+
+    def test_too_many_pixels_is_refused_before_decoding(self):
+        response = self.upload(picture((2000, 1000), 'PNG', '1'), 'big.png')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'too big', response.data)
+        with self.app.app_context():
+            from flaskblog.models import AvatarJob
+            self.assertEqual(AvatarJob.query.count(), 0)
+
+    def test_decompression_bomb_is_refused(self):
+        response = self.upload(png_header(20000, 10000), 'bomb.png')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'too big', response.data)
+
+    def test_garbage_collection_keeps_what_is_in_use(self):
+        from flaskblog.avatars import avatars, AVATAR_SIZES
+        self.upload(picture())
+        with self.app.app_context():
+            avatars.process_batch()
+        self.upload(picture((300, 300), 'PNG', 'RGBA'), 'me.png')
+        with self.app.app_context():
+            avatars.process_batch()
+        orphan = os.path.join(self.app.config['AVATAR_DIR'], '0214a7d68ecf74c3.jpg')
+        open(orphan, 'wb').close()
+        recent = os.path.join(self.app.config['AVATAR_DIR'], '1228d29f17b49674.JPG')
+        open(recent, 'wb').close()
+        old = time.time() - 2 * 24 * 60 * 60
+        for directory in (self.app.config['AVATAR_DIR'], self.app.config['AVATAR_UPLOAD_DIR']):
+            for entry in os.scandir(directory):
+                if entry.path != recent:
+                    os.utime(entry.path, (old, old))
+        with self.app.app_context():
+            removed = avatars.collect_garbage(24 * 60 * 60)
+        name = self.image_file().split('-')[0]
+        self.assertTrue(self.image_file().endswith('.png'))
+        self.assertEqual(removed, 2 * len(AVATAR_SIZES) + 1 + 2)  # old jpg set, orphan, both uploads
+        self.assertEqual(sorted(os.listdir(self.app.config['AVATAR_DIR'])),
+                         sorted(['1228d29f17b49674.JPG'] + ['{}-{}.{}'.format(name, size, ext)
+                                                            for size in AVATAR_SIZES for ext in ('png', 'webp')]))
+
+
+if __name__ == '__main__':
+    unittest.main()
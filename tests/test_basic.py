@@ -1,22 +1,26 @@
 import unittest
 
-import flaskblog
+from flaskblog import db
+from helpers import make_app
 
 
 class TestHelloWorld(unittest.TestCase):
 
     def setUp(self):
-        self.app = flaskblog.app.test_client()
-        self.app.testing = True
+        self.app = make_app()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.drop_all()
 
     def test_status_code(self):
-        response = self.app.get('/')
+        response = self.client.get('/')
         self.assertEqual(response.status_code, 200)
 
     def test_message(self):
-        response = self.app.get('/')
-        message = flaskblog.wrap_html('Hello DockerCon 2018!')
-        self.assertEqual(response.data, message)
+        response = self.client.get('/')
+        self.assertIn(b'<title>', response.data)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,36 @@
+import copy
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import request_paths  # noqa: E402
+
+
+class TestRequestPathsBenchmark(unittest.TestCase):
+
+    def test_small_run_and_regressions(self):
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, 'bench.db')
+            results = request_paths.run(database, posts = 40, requests = 3, allocation_requests = 1)
+            again = request_paths.run(database, posts = 40, requests = 3, allocation_requests = 1)  # reused
+        self.assertEqual(set(results['results']), set(request_paths.SCENARIOS))
+        self.assertEqual(results['meta']['posts'], 40)
+        self.assertEqual(again['meta']['users'], results['meta']['users'])
+        for name, row in results['results'].items():
+            self.assertGreater(row['queries'], 0, name)
+            self.assertLessEqual(row['p50_ms'], row['p99_ms'], name)
+
+        self.assertEqual(request_paths.compare(results, results, 0.2), [])
+        slower = copy.deepcopy(results)
+        slower['results']['post']['queries'] += 1
+        slower['results']['home']['p95_ms'] *= 2
+        regressions = request_paths.compare(slower, results, 0.2)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('home'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import tempfile
+import unittest
+
+from flaskblog import db
+from flaskblog.caching import MemoryCacheBackend, FileSystemCacheBackend, RedisCacheBackend
+from fake_redis import FakeRedis
+from helpers import make_app, seed, count_queries
+
+
+class TestBackends(unittest.TestCase):
+
+    def check_backend(self, backend):
+        self.assertIsNone(backend.get('a'))
+        backend.set('a', dict(body = b'x'), 60)
+        backend.set('b', 'gen', None)
+        self.assertEqual(backend.get_many(['a', 'b', 'c']), [dict(body = b'x'), 'gen', None])
+        backend.set('expired', 1, -1)
+        self.assertIsNone(backend.get('expired'))
+        backend.delete('a')
+        self.assertIsNone(backend.get('a'))
+        backend.clear()
+        self.assertIsNone(backend.get('b'))
+
+    def test_memory(self):
+        self.check_backend(MemoryCacheBackend())
+
+    def test_memory_evicts_least_recently_used(self):
+        backend = MemoryCacheBackend(max_entries = 2)
+        backend.set('a', 1)
+        backend.set('b', 2)
+        backend.get('a')
+        backend.set('c', 3)
+        self.assertEqual(backend.get_many(['a', 'b', 'c']), [1, None, 3])
+
+    def test_filesystem(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.check_backend(FileSystemCacheBackend(directory))
+
+    def test_redis(self):
+        self.check_backend(RedisCacheBackend(FakeRedis()))
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()
+        self.app.config['RESPONSE_CACHE_BACKEND'] = 'redis'
+        self.app.extensions['response_cache'] = RedisCacheBackend(FakeRedis())
+        with self.app.app_context():
+            seed(users = 2, posts_per_user = 2)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.drop_all()
+
+    def get(self, url, **kwargs):
+        with count_queries(self.app) as statements:
+            response = self.client.get(url, **kwargs)
+        return response, len(statements)
+
+    def test_second_anonymous_hit_runs_no_queries(self):
+        first, queries = self.get('/')
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertGreater(queries, 0)
+        second, queries = self.get('/')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(queries, 0)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(self.get('/?after=x')[0].status_code, 404)
+        self.assertEqual(self.get('/home')[0].headers['X-Cache'], 'MISS')
+
+    def test_etag_gives_not_modified(self):
+        etag = self.client.get('/about').headers['ETag']
+        response = self.client.get('/about', headers = {'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+    def test_commit_invalidates_dependent_pages(self):
+        from flaskblog.models import Post, Comment
+        self.get('/')
+        self.get('/post/1')
+        self.get('/post/2')
+        with self.app.app_context():
+            db.session.add(Comment(body = 'fresh comment', post_id = 1, author_id = 1))
+            db.session.commit()
+        self.assertEqual(self.get('/post/1')[0].headers['X-Cache'], 'MISS')
+        self.assertEqual(self.get('/post/2')[0].headers['X-Cache'], 'HIT')
+        self.assertEqual(self.get('/')[0].headers['X-Cache'], 'HIT')
+        with self.app.app_context():
+            Post.query.get(2).title = 'Renamed post'
+            db.session.commit()
+        response = self.get('/')[0]
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertIn(b'Renamed post', response.data)
+
+    def test_rolled_back_changes_keep_the_cache(self):
+        from flaskblog.models import Post
+        self.get('/')
+        with self.app.app_context():
+            Post.query.get(2).title = 'Not saved'
+            db.session.flush()
+            db.session.rollback()
+        self.assertEqual(self.get('/')[0].headers['X-Cache'], 'HIT')
+
+    def test_signed_in_users_are_not_cached(self):
+        from flaskblog import bcrypt
+        from flaskblog.models import User
+        with self.app.app_context():
+            db.session.add(User(username = 'amina', email = 'amina@example.com', country = 'Kenya', confirmed = True,
+                                password = bcrypt.generate_password_hash('pw').decode('utf-8')))
+            db.session.commit()
+        self.client.post('/login', data = dict(email = 'amina@example.com', password = 'pw'))
+        self.assertNotIn('X-Cache', self.client.get('/').headers)
+
+    def test_comment_pages_are_cached_for_signed_in_users_until_moderated(self):
+        from flaskblog import bcrypt
+        from flaskblog.models import User, Role, Comment
+        with self.app.app_context():
+            db.session.add(User(username = 'amina', email = 'amina@example.com', country = 'Kenya', confirmed = True,
+                                password = bcrypt.generate_password_hash('pw').decode('utf-8'),
+                                role = Role.query.filter_by(name = 'Moderator').one()))
+            db.session.commit()
+            comment_id = Comment.query.filter_by(post_id = 1).first().id
+        self.client.post('/login', data = dict(email = 'amina@example.com', password = 'pw'))
+        first = self.client.get('/post/1')
+        with count_queries(self.app) as statements:
+            second = self.client.get('/post/1')
+        self.assertFalse([statement for statement in statements if 'FROM comment' in statement])
+        self.assertEqual(second.data, first.data)
+        self.assertNotIn(b'disabled by a moderator', second.data)
+        self.client.get('/moderate/disable/{}'.format(comment_id))
+        response = self.client.get('/post/1')
+        self.assertIn(b'disabled by a moderator', response.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
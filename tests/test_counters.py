@@ -0,0 +1,59 @@
+import unittest
+
+from flaskblog import db
+from helpers import make_app, seed
+
+
+class TestCounters(unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        seed(users = 3, posts_per_user = 2, comments_per_post = 3, tags = ('python', 'flask'))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_counts_follow_inserts_and_deletes(self):
+        from flaskblog.counters import get_counts, USERS, POSTS, tag_counter
+        from flaskblog.models import Post, Comment, Tag
+        counts = get_counts(USERS, POSTS, tag_counter('python'), tag_counter('flask'))
+        self.assertEqual(counts, {USERS: 3, POSTS: 6, tag_counter('python'): 3, tag_counter('flask'): 3})
+
+        post = Post.query.first()
+        self.assertEqual(post.comment_count, 3)
+        db.session.delete(post.comments.first())
+        db.session.commit()
+        self.assertEqual(post.comment_count, 2)
+
+        post.tag.append(Tag(name = 'Africa'))
+        db.session.commit()
+        self.assertEqual(get_counts(tag_counter('africa'))[tag_counter('africa')], 1)
+
+        for comment in post.comments:
+            db.session.delete(comment)
+        db.session.delete(post)
+        db.session.commit()
+        self.assertEqual(get_counts(POSTS)[POSTS], 5)
+        self.assertEqual(get_counts(tag_counter('africa'))[tag_counter('africa')], 0)
+        self.assertEqual(Comment.query.count(), 15)
+
+    def test_reconcile_repairs_drift(self):
+        from flaskblog.counters import get_counts, reconcile, USERS, POSTS
+        from flaskblog.models import Counter, Post
+        Counter.query.get(USERS).value = 42
+        db.session.delete(Counter.query.get(POSTS))
+        Post.query.first().comment_count = 0
+        db.session.commit()
+
+        self.assertEqual(reconcile(), 3)
+        self.assertEqual(get_counts(USERS, POSTS), {USERS: 3, POSTS: 6})
+        self.assertEqual(Post.query.first().comment_count, 3)
+        self.assertEqual(reconcile(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
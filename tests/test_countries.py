@@ -0,0 +1,39 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from flaskblog import countries
+
+
+class TestCountries(unittest.TestCase):
+
+    def tearDown(self):
+        countries.reset()
+
+    def test_choices_are_loaded_once_and_shared(self):
+        countries.reset()
+        with mock.patch('flaskblog.countries.open', wraps = open) as opened:
+            choices = countries.country_choices()
+            self.assertIs(countries.country_choices(), choices)
+        self.assertEqual(opened.call_count, 1)
+        self.assertIn(('Kenya', 'Kenya'), choices)
+
+    def test_refresh_from_a_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            target = os.path.join(tmp, 'countries.json')
+            source = os.path.join(tmp, 'source.json')
+            with open(source, 'w') as f:
+                json.dump([{'name': 'Togo'}, {'name': 'Chad'}], f)
+            with mock.patch.object(countries, 'COUNTRIES_FILE', target):
+                self.assertEqual(countries.refresh(source), 2)
+                self.assertEqual(countries.country_choices(), (('Chad', 'Chad'), ('Togo', 'Togo')))
+            with self.assertRaises(ValueError), mock.patch.object(countries, 'COUNTRIES_FILE', target):
+                with open(source, 'w') as f:
+                    json.dump({'name': 'Togo'}, f)
+                countries.refresh(source)
+
+
+if __name__ == '__main__':
+    unittest.main()
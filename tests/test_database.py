@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import ExitStack
+
+from sqlalchemy.engine.url import make_url
+
+from flaskblog import db, bcrypt
+from flaskblog.config import TestingConfig
+from flaskblog.database import STICKY_COOKIE
+from helpers import make_app, seed, count_queries
+
+
+class TestPoolOptions(unittest.TestCase):
+
+    def test_pool_settings_for_servers_only(self):
+        app = make_app()
+        app.config.update(DATABASE_POOL_SIZE = 8, DATABASE_MAX_OVERFLOW = 2, DATABASE_POOL_PRE_PING = True,
+                          DATABASE_POOL_RECYCLE = None)
+        options = {}
+        db.apply_driver_hacks(app, make_url('postgresql://blog@db.internal/blog'), options)
+        self.assertEqual(options, dict(pool_size = 8, max_overflow = 2, pool_timeout = 10, pool_pre_ping = True))
+        options = {}
+        db.apply_driver_hacks(app, make_url('sqlite:////tmp/blog.db'), options)
+        self.assertNotIn('pool_size', options)
+
+
+class TestReadReplicas(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        primary, replica = os.path.join(directory, 'primary.db'), os.path.join(directory, 'replica.db')
+
+        class Config(TestingConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + primary
+            DATABASE_REPLICA_URIS = ['sqlite:///' + replica]
+
+        self.app = make_app(Config)
+        with self.app.app_context():
+            from flaskblog.models import User
+            seed(users = 2, posts_per_user = 2, comments_per_post = 1)
+            db.session.add(User(username = 'writer', email = 'writer@example.com', country = 'Kenya',
+                                confirmed = True, password = bcrypt.generate_password_hash('pw').decode('utf-8')))
+            db.session.commit()
+        shutil.copy(primary, replica)  # replicated
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.dispose_all(self.app)
+
+    def statements(self, stack):
+        primary = stack.enter_context(count_queries(self.app))
+        replica = stack.enter_context(count_queries(self.app, db.get_engine(self.app, 'replica0')))
+        return primary, replica
+
+    def test_reads_of_listed_endpoints_use_the_replica(self):
+        client = self.app.test_client()
+        with ExitStack() as stack:
+            primary, replica = self.statements(stack)
+            self.assertEqual(client.get('/post/1').status_code, 200)
+            self.assertEqual(client.get('/user-profile/user0').status_code, 200)
+        self.assertEqual(primary, [])
+        self.assertTrue(replica)
+        with ExitStack() as stack:
+            primary, replica = self.statements(stack)
+            self.assertEqual(client.get('/about').status_code, 200)
+            client.get('/login')
+        self.assertEqual(replica, [])
+
+    def test_writer_reads_from_primary_after_commit(self):
+        writer, reader = self.app.test_client(), self.app.test_client()
+        writer.post('/login', data = dict(email = 'writer@example.com', password = 'pw'))
+        with ExitStack() as stack:
+            primary, replica = self.statements(stack)
+            response = writer.post('/post/1', data = dict(body = 'Fresh comment'))
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(STICKY_COOKIE, response.headers['Set-Cookie'])
+        self.assertTrue([s for s in primary if s.startswith('INSERT INTO comment')])
+        self.assertFalse([s for s in replica if not s.startswith('SELECT')])
+
+        self.assertIn(b'Fresh comment', writer.get('/post/1?page=-1').data)  # not replicated yet
+        self.assertNotIn(b'Fresh comment', reader.get('/post/1?page=-1').data)
+
+    def test_cache_fills_read_from_primary(self):
+        self.app.config['RESPONSE_CACHE_BACKEND'] = 'memory'
+        client = self.app.test_client()
+        with ExitStack() as stack:
+            primary, replica = self.statements(stack)
+            self.assertEqual(client.get('/post/2').headers['X-Cache'], 'MISS')
+        self.assertTrue(primary)
+        self.assertEqual(replica, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
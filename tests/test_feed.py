@@ -0,0 +1,42 @@
+import unittest
+
+from flaskblog import db
+from helpers import make_app, seed, QueryCountMixin
+
+
+class TestFeedQueries(QueryCountMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()
+        with self.app.app_context():
+            seed(users = 4, posts_per_user = 5)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.drop_all()
+
+    def test_home_query_count(self):
+        # site counters, page of posts + authors, tags of the page, sidebar tags
+        with self.assertNumQueries(self.app, 4):
+            response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'user3', response.data)
+
+    def test_user_profile_query_count(self):
+        # user, page of posts + authors, tags of the page
+        with self.assertNumQueries(self.app, 3):
+            response = self.client.get('/user-profile/user1')
+        self.assertEqual(response.status_code, 200)
+
+    def test_search_results_query_count(self):
+        self.client.get('/search_results/warmup')  # sets up the search index
+        # match count, ranked ids, matching posts + authors, tags of the results
+        with self.assertNumQueries(self.app, 4):
+            response = self.client.get('/search_results/Post')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Post 20', response.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
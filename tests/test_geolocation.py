@@ -0,0 +1,121 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from flask import Flask
+
+from flaskblog.geolocation import GeoLocator, LocationCache
+
+
+class GeoIPStub(object):
+    """Local stand-in for ip-api.com, answers with ``status`` and ``body`` and counts the lookups."""
+
+    def __init__(self):
+        self.status = 200
+        self.body = dict(status = 'success', country = 'Kenya', countryCode = 'KE')
+        self.lookups = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.lookups += 1
+                body = json.dumps(stub.body).encode()
+                self.send_response(stub.status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/json/{{}}'.format(self.server.server_address[1])
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_locator(**config):
+    app = Flask(__name__)
+    app.config.update(config)
+    return GeoLocator(app)
+
+
+class TestLocationCache(unittest.TestCase):
+
+    def test_entries_expire_after_their_ttl(self):
+        cache = LocationCache(ttl = 60)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl = 0)
+        self.assertEqual(cache.get('a'), (1, True))
+        self.assertEqual(cache.get('b'), (2, False))  # stale, still served while it is refreshed
+        self.assertEqual(cache.get('c'), (None, False))
+
+    def test_least_recently_used_entries_are_dropped(self):
+        cache = LocationCache(maxsize = 2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a')[0], cache.get('b')[0], len(cache)), (1, None, 2))
+
+
+class TestGeoLocator(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = GeoIPStub()
+        self.addCleanup(self.stub.close)
+
+    def test_lookups_are_cached_per_network(self):
+        locator = make_locator(GEOIP_API_URL = self.stub.url)
+        self.assertEqual(locator.lookup('41.90.1.1', wait = True)['country'], 'Kenya')
+        self.assertEqual(locator.lookup('41.90.1.200')['country'], 'Kenya')
+        self.assertEqual(self.stub.lookups, 1)
+
+    def test_failed_lookups_are_retried_soon(self):
+        locator = make_locator(GEOIP_API_URL = self.stub.url, GEOIP_FAILURE_TTL = 0.2)
+        self.assertEqual(locator.lookup('41.90.1.1', wait = True)['country'], 'Kenya')
+        key = locator.cache_key('41.90.1.1')
+        locator.cache.set(key, locator.cache.get(key)[0], ttl = 0)  # a day later
+        self.stub.status = 503
+        # the service is down: the last answer is kept, and the service is left alone for a while
+        self.assertEqual(locator.lookup('41.90.1.1', wait = True)['country'], 'Kenya')
+        self.assertEqual(locator.lookup('41.90.1.1', wait = True)['country'], 'Kenya')
+        self.assertEqual(self.stub.lookups, 2)
+        time.sleep(0.3)
+        self.stub.status, self.stub.body['country'] = 200, 'Uganda'
+        self.assertEqual(locator.lookup('41.90.1.1', wait = True)['country'], 'Uganda')
+
+    def test_unreachable_service_is_not_remembered_for_a_day(self):
+        locator = make_locator(GEOIP_API_URL = 'http://127.0.0.1:1/json/{}', GEOIP_FAILURE_TTL = 0.2)
+        self.assertIsNone(locator.lookup('41.90.1.1', wait = True))
+        self.assertEqual(locator.cache.get('41.90.1.0/24'), (None, True))
+        time.sleep(0.3)
+        self.assertEqual(locator.cache.get('41.90.1.0/24'), (None, False))
+
+    def test_ip_range_database_is_used_when_configured(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'ranges.csv')
+        with open(path, 'w') as f:
+            f.write('start_ip,end_ip,country_code,country,continent_code,continent\n'
+                    '41.90.0.0,41.90.255.255,KE,Kenya,AF,Africa\n'
+                    '102.0.0.0,102.0.0.255,NG,Nigeria,AF,Africa\n')
+        locator = make_locator(GEOIP_API_URL = self.stub.url, GEOIP_DATABASE = path)
+        self.assertEqual(locator.lookup('102.0.0.7')['country'], 'Nigeria')
+        self.assertEqual(locator.lookup('41.90.3.4')['continent'], 'Africa')
+        self.assertIsNone(locator.lookup('8.8.8.8'))
+        self.assertIsNone(locator.lookup('not an address'))
+        self.assertEqual(self.stub.lookups, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
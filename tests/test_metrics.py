@@ -0,0 +1,96 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from datetime import timedelta
+
+import requests
+
+from flaskblog import db
+from flaskblog.config import TestingConfig
+from flaskblog.metrics import SharedMetrics, metrics
+from helpers import make_app, seed
+
+
+class MetricsConfig(TestingConfig):
+    METRICS_TOKEN = 'scraper-secret'
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app(MetricsConfig)
+        with self.app.app_context():
+            seed()
+        metrics.registry.clear()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.drop_all()
+
+    def scrape(self):
+        response = self.client.get('/metrics', headers = {'Authorization': 'Bearer scraper-secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+        return response.get_data(as_text = True)
+
+    def test_requests_are_recorded_per_endpoint(self):
+        self.client.get('/')
+        self.client.get('/')
+        self.client.get('/post/1')
+        self.assertEqual(metrics.requests.value('main.home', 'GET', 200), 2)
+        self.assertEqual(metrics.sql_statements.count('posts.post'), 1)
+        self.assertGreater(metrics.sql_statements.sum('posts.post'), 0)
+        self.assertGreater(metrics.sql_seconds.sum('main.home'), 0)
+        self.assertEqual(metrics.template_seconds.count('home.html'), 2)
+
+        text = self.scrape()
+        self.assertIn('# TYPE flaskblog_request_duration_seconds histogram', text)
+        self.assertIn('flaskblog_requests_total{endpoint="main.home",method="GET",status="200"} 2', text)
+        self.assertIn('flaskblog_request_duration_seconds_count{endpoint="main.home",method="GET"} 2', text)
+        self.assertIn('flaskblog_request_duration_seconds_bucket{endpoint="main.home",method="GET",le="+Inf"} 2',
+                      text)
+
+    def test_scrapes_add_up_every_process(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app.config['METRICS_DIR'] = directory
+        self.client.get('/')
+        with open(os.path.join(directory, '{}.pickle'.format(os.getpid())), 'rb') as f:
+            other = pickle.load(f)  # dumped after the first request, stands in for another worker
+        with open(os.path.join(directory, '4242.pickle'), 'wb') as f:
+            pickle.dump(other, f)
+        self.client.get('/')
+        line = 'flaskblog_requests_total{endpoint="main.home",method="GET",status="200"} 3'
+        self.assertIn(line, self.scrape())
+        SharedMetrics(directory).retire(metrics.registry, 4242)  # the worker exited
+        self.assertEqual(sorted(os.listdir(directory)), ['{}.pickle'.format(os.getpid()), 'retired.pickle'])
+        self.assertIn(line, self.scrape())
+
+    def test_endpoint_is_protected(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', headers = {'Authorization': 'Bearer wrong'}).status_code, 403)
+
+    def test_slow_requests_are_logged_with_their_sql(self):
+        self.app.config['METRICS_SLOW_REQUEST'] = 1e-9
+        with self.assertLogs('flaskblog.metrics', 'WARNING') as logs:
+            self.client.get('/post/1')
+        self.assertIn('Slow request: GET /post/1 (posts.post)', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+        self.assertEqual(metrics.slow_requests.value('posts.post'), 1)
+
+    def test_outbound_http(self):
+        response = requests.Response()
+        response.url = 'https://api.eu.mailgun.net/v3/lists'
+        response.status_code = 200
+        response.elapsed = timedelta(milliseconds = 120)
+        metrics.record_http(response)
+        self.assertEqual(metrics.http_seconds.count('api.eu.mailgun.net', 200), 1)
+        self.assertIn('flaskblog_http_client_seconds_bucket{host="api.eu.mailgun.net",status="200",le="0.25"} 1',
+                      self.scrape())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import json
+import unittest
+
+from flaskblog import db, bcrypt
+from flaskblog.caching import RedisCacheBackend
+from fake_redis import FakeRedis
+from helpers import make_app, seed, count_queries
+
+
+class TestBulkModeration(unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()
+        self.app.config['RESPONSE_CACHE_BACKEND'] = 'redis'
+        self.app.extensions['response_cache'] = RedisCacheBackend(FakeRedis())
+        with self.app.app_context():
+            from flaskblog.models import User, Role
+            seed(users = 2, posts_per_user = 2, comments_per_post = 3)
+            db.session.add(User(username = 'moderator', email = 'moderator@example.com', country = 'Kenya',
+                                confirmed = True, password = bcrypt.generate_password_hash('pw').decode('utf-8'),
+                                role = Role.query.filter_by(name = 'Moderator').one()))
+            db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.drop_all()
+
+    def login(self):
+        self.client.post('/login', data = dict(email = 'moderator@example.com', password = 'pw'))
+
+    def disabled(self):
+        from flaskblog.models import Comment
+        with self.app.app_context():
+            return {c.id: c.disabled for c in Comment.query}
+
+    def test_one_update_for_many_comments(self):
+        self.login()
+        anonymous = self.app.test_client()
+        self.assertEqual(anonymous.get('/post/1').headers['X-Cache'], 'MISS')
+        self.assertEqual(anonymous.get('/post/3').headers['X-Cache'], 'MISS')
+        with count_queries(self.app) as statements:
+            response = self.client.post('/moderate/bulk', data = json.dumps(dict(ids = [1, 2, 7], action = 'disable')),
+                                        content_type = 'application/json')
+        self.assertEqual(response.get_json(), dict(updated = 3))
+        self.assertEqual(len([s for s in statements if s.startswith('UPDATE comment')]), 1)
+        disabled = self.disabled()
+        self.assertEqual(sorted(i for i, value in disabled.items() if value), [1, 2, 7])
+        self.assertEqual(anonymous.get('/post/1').headers['X-Cache'], 'MISS')  # comments 1 and 2
+        self.assertEqual(anonymous.get('/post/3').headers['X-Cache'], 'MISS')  # comment 7
+        self.assertEqual(anonymous.get('/post/2').headers['X-Cache'], 'MISS')  # never cached
+        self.assertEqual(anonymous.get('/post/2').headers['X-Cache'], 'HIT')
+
+        response = self.client.post('/moderate/bulk', data = dict(ids = ['1', '2', '3'], action = 'enable'))
+        self.assertEqual(response.status_code, 302)
+        disabled = self.disabled()
+        self.assertEqual([disabled[i] for i in (1, 2, 3, 7)], [False, False, False, True])
+
+    def test_queue_filters(self):
+        self.login()
+        self.client.post('/moderate/bulk', data = dict(ids = ['4', '5'], action = 'disable'))
+        self.client.post('/moderate/bulk', data = dict(ids = ['6'], action = 'enable'))
+        response = self.client.get('/moderate?status=disabled')
+        self.assertEqual(response.data.count(b'name="ids"'), 2)
+        response = self.client.get('/moderate?status=new&post=1')
+        self.assertEqual(response.data.count(b'name="ids"'), 3)
+        response = self.client.get('/moderate?status=approved&author=user0')
+        self.assertEqual(response.data.count(b'name="ids"'), 1)  # comment 6
+        response = self.client.get('/moderate?status=approved&author=user1')
+        self.assertEqual(response.data.count(b'name="ids"'), 0)
+        self.assertEqual(self.client.get('/moderate?status=spam').status_code, 404)
+
+    def test_requires_moderator_and_valid_ids(self):
+        self.assertEqual(self.client.post('/moderate/bulk', data = dict(ids = ['1'], action = 'disable'))
+                         .status_code, 302)  # to the login page
+        self.login()
+        response = self.client.post('/moderate/bulk', data = json.dumps(dict(ids = ['x'], action = 'disable')),
+                                    content_type = 'application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(any(self.disabled().values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import smtplib
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from flask_mail import Message
+
+from flaskblog import db, mail
+from helpers import make_app
+
+
+class TestMailOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()
+        self.app.config['MAIL_OUTBOX_BATCH_SIZE'] = 2
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        from flaskblog.outbox import outbox
+        self.outbox = outbox
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def enqueue(self, n):
+        for i in range(n):
+            self.outbox.enqueue(Message('Hello %d' % i, sender = ('AfriDevsForum', 'no-reply@afridevsforum.com'),
+                                        recipients = ['user%d@example.com' % i], body = 'hi'))
+
+    def test_batches_share_one_connection(self):
+        from flaskblog.models import OutboxMessage
+        self.enqueue(3)
+        with mail.record_messages() as outbox, mock.patch.object(mail, 'connect', wraps = mail.connect) as connect:
+            self.assertEqual(self.outbox.process_batch(), 2)
+            self.assertEqual(self.outbox.process_batch(), 1)
+            self.assertEqual(self.outbox.process_batch(), 0)
+        self.assertEqual(connect.call_count, 2)
+        self.assertEqual([m.subject for m in outbox], ['Hello 0', 'Hello 1', 'Hello 2'])
+        self.assertEqual(outbox[0].sender, 'AfriDevsForum <no-reply@afridevsforum.com>')
+        self.assertEqual({m.status for m in OutboxMessage.query}, {'sent'})
+
+    def test_failures_back_off_and_give_up(self):
+        from flaskblog.models import OutboxMessage
+        self.app.config['MAIL_OUTBOX_MAX_ATTEMPTS'] = 2
+        self.enqueue(1)
+        refused = smtplib.SMTPRecipientsRefused({'user0@example.com': (550, b'no such user')})
+        with mock.patch('flask_mail.Connection.send', side_effect = refused):
+            self.outbox.process_batch()
+            row = OutboxMessage.query.one()
+            self.assertEqual((row.status, row.attempts), ('pending', 1))
+            self.assertGreater(row.next_attempt_at, datetime.utcnow() + timedelta(seconds = 20))
+            self.assertEqual(self.outbox.process_batch(), 0)  # not due yet
+
+            row.next_attempt_at = datetime.utcnow()
+            db.session.commit()
+            self.outbox.process_batch()
+        row = OutboxMessage.query.one()
+        self.assertEqual((row.status, row.attempts), ('failed', 2))
+
+    def test_lost_connection_retries_the_rest_of_the_batch(self):
+        from flaskblog.models import OutboxMessage
+        self.enqueue(2)
+        with mock.patch('flask_mail.Connection.send', side_effect = [None, smtplib.SMTPServerDisconnected()]):
+            self.outbox.process_batch()
+        statuses = [(m.status, m.attempts) for m in OutboxMessage.query.order_by(OutboxMessage.id)]
+        self.assertEqual(statuses, [('sent', 0), ('pending', 1)])
+
+    def test_unexpected_errors_count_as_attempts(self):
+        from flaskblog.models import OutboxMessage
+        self.enqueue(2)
+        with mock.patch('flask_mail.Connection.send', side_effect = [ValueError('bad header'), None]):
+            self.outbox.process_batch()
+        statuses = [(m.status, m.attempts) for m in OutboxMessage.query.order_by(OutboxMessage.id)]
+        self.assertEqual(statuses, [('pending', 1), ('sent', 0)])
+
+        self.enqueue(1)
+        with mock.patch('flask_mail.Connection.__enter__', side_effect = smtplib.SMTPNotSupportedError('AUTH')), \
+                self.assertLogs('flaskblog.outbox', 'ERROR'):
+            self.assertEqual(self.outbox.process_batch(), 1)
+        row = OutboxMessage.query.filter_by(subject = 'Hello 0').order_by(OutboxMessage.id.desc()).first()
+        self.assertEqual((row.status, row.attempts, row.claim), ('pending', 1, None))
+
+    def test_register_does_not_send_inline(self):
+        from flaskblog.models import OutboxMessage
+        with mail.record_messages() as outbox:
+            response = self.app.test_client().post('/register', data = dict(
+                username = 'amina', email = 'amina@example.com', country = 'Kenya', password = 'pw',
+                confirm_password = 'pw'))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(outbox, [])
+        self.assertEqual(OutboxMessage.query.one().subject, 'Email Confirmation')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import re
+import unittest
+
+from flaskblog import db
+from helpers import make_app, seed, count_queries
+
+
+class TestKeysetPagination(unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()
+        self.app.config['FLASKY_MAX_OFFSET_PAGES'] = 2
+        self.app.config['FLASKY_POSTS_PER_PAGE'] = 3
+        with self.app.app_context():
+            seed(users = 2, posts_per_user = 10, comments_per_post = 9)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.drop_all()
+
+    def walk(self, url):
+        """Follows the Next links from ``url`` and returns the titles seen on every page."""
+        titles = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            html = response.data.decode('utf-8')
+            titles.extend(re.findall(r'class="article-title" href="[^"]+">([^<]+)</a>', html))
+            match = re.search(r'href="([^"]+)">Next</a>', html)
+            url = match.group(1).replace('&amp;', '&') if match else None
+        return titles
+
+    def test_home_walks_every_post_once_in_order(self):
+        titles = self.walk('/')
+        self.assertEqual(titles, ['Post %d' % n for n in range(20, 0, -1)])
+
+    def test_deep_pages_seek_with_a_cursor(self):
+        response = self.client.get('/user-profile/user0?page=2')
+        next_url = re.search(r'href="([^"]+)">Next</a>', response.data.decode('utf-8')).group(1)
+        self.assertIn('after=', next_url)
+        with count_queries(self.app) as statements:
+            response = self.client.get(next_url.replace('&amp;', '&'))
+        self.assertEqual(response.status_code, 200)
+        post_queries = [s for s in statements if 'ORDER BY post.date_posted' in s]
+        self.assertEqual(len(post_queries), 1)
+        self.assertIn('(post.date_posted, post.id) < (?, ?)', post_queries[0])
+
+    def test_deep_page_number_without_a_cursor_is_not_found(self):
+        with count_queries(self.app) as statements:
+            response = self.client.get('/?page=3')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse([s for s in statements if 'ORDER BY post.date_posted' in s])
+        self.assertEqual(self.client.get('/?page=2').status_code, 200)
+
+    def test_previous_link_from_a_deep_page(self):
+        response = self.client.get('/?page=2')
+        next_url = re.search(r'href="([^"]+)">Next</a>', response.data.decode('utf-8')).group(1)
+        response = self.client.get(next_url.replace('&amp;', '&'))
+        prev_url = re.search(r'href="([^"]+)">Previous</a>', response.data.decode('utf-8')).group(1)
+        self.assertEqual(prev_url, '/home?page=2')
+
+    def test_last_comment_page(self):
+        from flaskblog.models import Post, Comment
+        with self.app.app_context():
+            post = Post.query.first()
+            newest = post.comments.order_by(Comment.timestamp.desc()).first().body
+        response = self.client.get('/post/%d?page=-1' % post.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(newest.encode('utf-8'), response.data)
+        self.assertIn(b'>Previous</a>', response.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
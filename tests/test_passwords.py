@@ -0,0 +1,76 @@
+import unittest
+
+from flaskblog import db
+from flaskblog.config import TestingConfig
+from flaskblog.passwords import passwords, hash_password, hash_rounds, check_password
+from helpers import make_app
+
+
+class TestPasswordHasher(unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()
+        with self.app.app_context():
+            from flaskblog.models import User
+            db.session.add(User(username = 'amina', email = 'amina@example.com', country = 'Kenya', confirmed = True,
+                                password = hash_password('pw', 5)))
+            db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.drop_all()
+
+    def stored_hash(self):
+        from flaskblog.models import User
+        with self.app.app_context():
+            return User.query.one().password
+
+    def test_login_rehashes_at_the_configured_cost(self):
+        response = self.client.post('/login', data = dict(email = 'amina@example.com', password = 'pw'))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(hash_rounds(self.stored_hash()), 4)
+        self.assertEqual(check_password(self.stored_hash(), 'pw'), (True, None))
+
+    def test_wrong_password_keeps_the_old_hash(self):
+        old = self.stored_hash()
+        response = self.client.post('/login', data = dict(email = 'amina@example.com', password = 'nope'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stored_hash(), old)
+
+    def test_account_with_a_check_in_flight_gets_429(self):
+        with self.app.app_context():
+            limiter = passwords.pool.limiter
+        self.assertTrue(limiter.acquire({'account:amina@example.com': 1}))
+        try:
+            response = self.client.post('/login', data = dict(email = 'amina@example.com', password = 'pw'))
+        finally:
+            limiter.release(['account:amina@example.com'])
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '5')
+        response = self.client.post('/login', data = dict(email = 'amina@example.com', password = 'pw'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_long_passwords_are_cut_like_bcrypt_always_did(self):
+        pw_hash = hash_password('a' * 80, 4)
+        self.assertEqual(check_password(pw_hash, 'a' * 72), (True, None))
+
+
+class TestWorkerProcesses(unittest.TestCase):
+
+    def test_hashes_in_a_worker_process(self):
+        class PoolConfig(TestingConfig):
+            PASSWORD_HASH_WORKERS = 1
+
+        app = make_app(PoolConfig)
+        with app.app_context():
+            try:
+                pw_hash = passwords.hash('secret', client = '127.0.0.1')
+                self.assertEqual(hash_rounds(pw_hash), 4)
+                self.assertEqual(check_password(pw_hash, 'secret'), (True, None))
+            finally:
+                passwords.pool.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
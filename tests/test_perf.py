@@ -0,0 +1,119 @@
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine
+
+from flaskblog import db
+from flaskblog.config import TestingConfig
+from flaskblog.perf import explain, normalize, advise
+from helpers import make_app, seed
+
+
+class TestAdvisor(unittest.TestCase):
+
+    def test_normalize(self):
+        self.assertEqual(normalize("SELECT *\n  FROM counter WHERE name IN (?, ?, ?) AND value > 10 AND x = 'a''b'"),
+                         'SELECT * FROM counter WHERE name IN (...) AND value > ? AND x = ?')
+        self.assertEqual(normalize('SELECT user_1.id FROM user AS user_1'), 'SELECT user_1.id FROM user AS user_1')
+
+    def test_suggests_missing_indexes_only(self):
+        entries = [
+            dict(statement = 'SELECT comment.id FROM comment JOIN user AS user_1 ON user_1.id = comment.author_id '
+                             'WHERE comment.post_id = ? AND comment.timestamp > ? ORDER BY comment.id DESC LIMIT ?',
+                 plan = ['SCAN comment', 'SEARCH user_1 USING INTEGER PRIMARY KEY (rowid=?)'], calls = 3,
+                 seconds = 1.0),
+            dict(statement = 'SELECT post.id FROM post WHERE post.user_id = ?', plan = ['SCAN post'], calls = 1,
+                 seconds = 0.5),
+            dict(statement = 'SELECT tag.id FROM tag JOIN post_tag AS post_tag_1 ON tag.id = post_tag_1.tag_id '
+                             'WHERE tag.slug = ?',
+                 plan = ['SEARCH tag USING INDEX sqlite_autoindex_tag_1 (slug=?)', 'SCAN post_tag_1'], calls = 1,
+                 seconds = 0.5),
+            dict(statement = 'SELECT count(*) FROM post', plan = ['SCAN post'], calls = 1, seconds = 0.5),
+            dict(statement = 'SELECT post.id FROM post ORDER BY post.date_posted',
+                 plan = ['SCAN post USING INDEX ix_post_date_posted'], calls = 1, seconds = 0.5),
+        ]
+        existing = dict(comment = [['id']], post = [['id'], ['user_id', 'date_posted']], user = [['id']],
+                        tag = [['id'], ['slug']], post_tag = [['post_id', 'tag_id']])
+        suggestions = [(table, columns) for entry, table, columns in advise(entries, existing)]
+        self.assertEqual(suggestions, [('comment', ['post_id', 'timestamp', 'id']), ('post_tag', ['tag_id'])])
+
+
+class TestSlowQueryLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+        class SlowConfig(TestingConfig):
+            SLOW_QUERY_THRESHOLD = 0  # every statement
+            SLOW_QUERY_LOG = os.path.join(self.directory.name, 'slow.jsonl')
+            SLOW_QUERY_FLUSH_INTERVAL = 3600
+
+        self.app = make_app(SlowConfig)
+        with self.app.app_context():
+            seed()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.drop_all()
+        self.directory.cleanup()
+
+    def test_statements_are_logged_with_their_plan(self):
+        self.app.test_client().get('/post/1')
+        self.app.test_client().get('/post/2')
+        with self.app.app_context():
+            self.app.extensions['slow_queries'].flush()
+        with open(self.app.config['SLOW_QUERY_LOG']) as f:
+            entries = [json.loads(line) for line in f]
+        post = [e for e in entries if e['statement'].startswith('SELECT') and 'FROM post LEFT OUTER JOIN' in
+                e['statement']]
+        self.assertEqual(len(post), 1)
+        self.assertEqual(post[0]['calls'], 2)
+        self.assertTrue(any(line.startswith('SEARCH post') for line in post[0]['plan']))
+
+        result = self.app.test_cli_runner().invoke(args = ['perf', 'advise'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Slowest statements by total time:', result.output)
+        self.assertIn('No missing indexes found.', result.output)
+
+
+class RecordingConnection(object):
+    """A DBAPI connection that remembers the statements run on its cursors."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.statements = []
+
+    def cursor(self):
+        cursor = self.connection.cursor()
+        execute = cursor.execute
+        recording = SimpleNamespace(fetchall = cursor.fetchall, close = cursor.close)
+        recording.execute = lambda statement, *args: self.statements.append(statement) or execute(statement, *args)
+        return recording
+
+
+class TestExplain(unittest.TestCase):
+
+    def test_failed_explain_is_undone_to_a_savepoint(self):
+        # SQLite standing in for a server database, where a failed statement aborts the transaction
+        connection = create_engine('sqlite://').connect()
+        connection.execute('CREATE TABLE post (id INTEGER PRIMARY KEY)')
+        transaction = connection.begin()
+        connection.execute('INSERT INTO post (id) VALUES (1)')
+        dbapi = RecordingConnection(connection.connection)
+        server = SimpleNamespace(dialect = SimpleNamespace(name = 'postgresql'), connection = dbapi)
+
+        self.assertIsNone(explain(server, 'SELECT * FROM missing', ()))
+        self.assertTrue(explain(server, 'SELECT * FROM post WHERE id = ?', (1,)))
+        self.assertEqual(dbapi.statements, [
+            'SAVEPOINT flaskblog_explain', 'EXPLAIN SELECT * FROM missing', 'ROLLBACK TO SAVEPOINT flaskblog_explain',
+            'SAVEPOINT flaskblog_explain', 'EXPLAIN SELECT * FROM post WHERE id = ?',
+            'RELEASE SAVEPOINT flaskblog_explain'])
+        self.assertEqual(connection.execute('SELECT count(*) FROM post').scalar(), 1)  # the transaction lives on
+        transaction.rollback()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+from flaskblog import db, bcrypt
+from helpers import make_app, QueryCountMixin
+
+
+class TestRolePermissionCache(QueryCountMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()
+        with self.app.app_context():
+            from flaskblog.models import Role, User
+            db.session.add(User(username = 'mod', email = 'mod@example.com', country = 'Kenya', confirmed = True,
+                                password = bcrypt.generate_password_hash('pw').decode('utf-8'),
+                                role = Role.query.filter_by(name = 'Moderator').one()))
+            db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/login', data = dict(email = 'mod@example.com', password = 'pw'))
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.drop_all()
+
+    def test_signed_in_request_only_loads_the_user(self):
+        self.client.get('/about')
+        with self.assertNumQueries(self.app, 1):
+            self.assertEqual(self.client.get('/about').status_code, 200)
+
+    def test_role_changes_apply_on_commit(self):
+        from flaskblog.models import Permission, Role
+        self.assertEqual(self.client.get('/moderate').status_code, 200)
+        with self.app.app_context():
+            Role.query.filter_by(name = 'Moderator').one().permissions = Permission.COMMENT
+            db.session.commit()
+        self.assertEqual(self.client.get('/moderate').status_code, 403)
+
+
+if __name__ == '__main__':
+    unittest.main()
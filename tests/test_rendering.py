@@ -0,0 +1,57 @@
+import unittest
+
+from flaskblog import db
+from flaskblog.rendering import RENDER_VERSION, excerpt
+from helpers import make_app, seed, count_queries
+
+
+class TestRendering(unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_post_is_rendered_when_content_is_set(self):
+        from flaskblog.models import Post, User
+        user = User(username = 'amina', email = 'amina@example.com', country = 'Kenya', password = 'x')
+        post = Post(title = 'Links', author = user,
+                    content = '<p>See https://example.com &amp; more</p><script>alert(1)</script>' + ' word' * 200)
+        db.session.add(post)
+        db.session.commit()
+        self.assertIn('<a href="https://example.com"', post.content_html)
+        self.assertNotIn('<script>', post.content_html)
+        self.assertTrue(post.excerpt.startswith('See https://example.com & more'))
+        self.assertTrue(post.excerpt.endswith('...'))
+        self.assertLessEqual(len(post.excerpt), 400)
+        self.assertEqual(post.render_version, RENDER_VERSION)
+
+    def test_short_text_is_not_cut(self):
+        self.assertEqual(excerpt('a few words'), 'a few words')
+
+    def test_rerender_fills_outdated_rows(self):
+        from flaskblog.models import Post, Comment
+        from flaskblog.rendering import rerender
+        seed(users = 1, posts_per_user = 3, comments_per_post = 1)
+        db.session.execute(Post.__table__.update().values(content_html = None, excerpt = None, render_version = None))
+        db.session.execute(Comment.__table__.update().values(render_version = 'old'))
+        db.session.commit()
+        self.assertEqual(rerender(), 6)
+        self.assertEqual(rerender(), 0)
+        self.assertEqual({p.excerpt for p in Post.query}, {'Content of post 1', 'Content of post 2', 'Content of post 3'})
+
+    def test_feed_does_not_load_post_bodies(self):
+        seed(users = 1, posts_per_user = 3)
+        with count_queries(self.app) as statements:
+            response = self.app.test_client().get('/')
+        self.assertIn(b'Content of post 3', response.data)
+        self.assertFalse([s for s in statements if 'post.content AS' in s or 'post.content_html' in s])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+
+from flaskblog import create_app, db
+from flaskblog.config import TestingConfig
+from helpers import make_app, seed
+
+
+class SQLiteSearchConfig(TestingConfig):
+    SEARCH_BACKEND = 'sqlite'
+
+
+class PythonSearchConfig(TestingConfig):
+    SEARCH_BACKEND = 'python'
+
+
+class SearchTestMixin(object):
+    config_class = None
+
+    def setUp(self):
+        self.app = make_app(self.config_class)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        seed(users = 2, posts_per_user = 3, comments_per_post = 0)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def search(self, query, page = 1, per_page = 10, max_results = 50):
+        from flaskblog.search import search_posts
+        return search_posts(query, page, per_page, max_results)
+
+    def test_ranks_title_matches_first(self):
+        from flaskblog.models import Post
+        post = Post.query.filter_by(title = 'Post 2').one()
+        post.title = 'Mobile money in Kenya'
+        other = Post.query.filter_by(title = 'Post 5').one()
+        other.content = '<p>Payments over mobile networks, and some money talk.</p>'
+        db.session.commit()
+
+        results = self.search('mobile money')
+        self.assertEqual([p.title for p in results.items], ['Mobile money in Kenya', 'Post 5'])
+        self.assertEqual(results.total, 2)
+
+    def test_index_follows_edits_and_deletes(self):
+        from flaskblog.models import Post, Tag
+        self.assertEqual(self.search('fintech').total, 0)
+        post = Post.query.filter_by(title = 'Post 1').one()
+        post.tag.append(Tag(name = 'fintech'))
+        db.session.commit()
+        self.assertEqual([p.id for p in self.search('fintech').items], [post.id])
+
+        db.session.delete(post)
+        db.session.commit()
+        self.assertEqual(self.search('fintech').total, 0)
+
+    def test_rolled_back_changes_are_not_indexed(self):
+        from flaskblog.models import Post
+        Post.query.first().title = 'Blockchain'
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(self.search('blockchain').total, 0)
+
+    def test_pagination_and_result_cap(self):
+        results = self.search('content', page = 2, per_page = 4)
+        self.assertEqual((results.total, len(results.items), results.pages), (6, 2, 2))
+        self.assertEqual(self.search('content', max_results = 3).total, 3)
+
+    def test_pages_below_one_are_the_first_page(self):
+        first = [p.id for p in self.search('content', per_page = 4).items]
+        for page in (0, -3):
+            results = self.search('content', page = page, per_page = 4)
+            self.assertEqual(([p.id for p in results.items], results.page), (first, 1))
+
+    def test_search_syntax_is_not_interpreted(self):
+        self.assertEqual(self.search('post" OR title:*').total, 0)
+        self.assertEqual(self.search('"Post"').total, 6)
+
+
+class TestSearchIndexSetup(unittest.TestCase):
+
+    def test_requests_never_create_the_index(self):
+        from flaskblog.search import get_backend, init_index, search_posts
+        app = create_app(SQLiteSearchConfig)  # no `flask search init` yet
+        with app.app_context():
+            db.create_all()
+            with self.assertLogs('flaskblog.search', 'WARNING'):
+                seed(users = 1, posts_per_user = 3, comments_per_post = 0)
+                self.assertEqual(search_posts('content', 1, 10, 50).total, 0)
+            self.assertFalse(get_backend().has_schema(db.session.connection()))
+
+            self.assertEqual(init_index(), 3)
+            self.assertEqual(search_posts('content', 1, 10, 50).total, 3)
+            self.assertEqual(app.test_cli_runner().invoke(args = ['search', 'init']).exit_code, 0)
+            db.session.remove()
+            db.drop_all()
+
+
+class TestSQLiteSearch(SearchTestMixin, unittest.TestCase):
+    config_class = SQLiteSearchConfig
+
+
+class TestPythonSearch(SearchTestMixin, unittest.TestCase):
+    config_class = PythonSearchConfig
+
+
+if __name__ == '__main__':
+    unittest.main()
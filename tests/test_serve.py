@@ -0,0 +1,114 @@
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.request
+
+from flaskblog.config import TestingConfig
+from flaskblog.serve import WorkerServer, warm_up
+from helpers import make_app, seed
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestWorker(unittest.TestCase):
+
+    def test_warm_up_fills_the_cache_and_closes_connections(self):
+        directory = tempfile.mkdtemp()
+
+        class Config(TestingConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'blog.db')
+            RESPONSE_CACHE_BACKEND = 'memory'
+
+        app = make_app(Config)
+        with app.app_context():
+            seed()
+        warm_up(app, ['/', '/about'])
+        self.assertEqual(app.extensions['metrics'].requests.value('main.home', 'GET', 200), 0)
+        self.assertEqual(app.test_client().get('/').headers['X-Cache'], 'HIT')
+
+    def test_recycled_after_max_requests(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b'ok']
+
+        server = WorkerServer('127.0.0.1', 0, app)
+        worker = threading.Thread(target = server.serve, args = (2, 3, os.getppid()))
+        worker.start()
+        url = 'http://127.0.0.1:{}/'.format(server.server_port)
+        for _ in range(3):
+            self.assertEqual(urllib.request.urlopen(url, timeout = 5).read(), b'ok')
+        worker.join(5)
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(server.handled, 3)
+
+
+class TestMaster(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        database = 'sqlite:///' + os.path.join(self.directory, 'blog.db')
+
+        class Config(TestingConfig):
+            SQLALCHEMY_DATABASE_URI = database
+
+        app = make_app(Config)
+        with app.app_context():
+            seed()
+        self.config_file = os.path.join(self.directory, 'config.json')
+        with open(self.config_file, 'w') as f:
+            json.dump(dict(SECRET_KEY = 'secret', SQLALCHEMY_DATABASE_URI = database), f)
+
+    def get(self, port, path):
+        return urllib.request.urlopen('http://127.0.0.1:{}{}'.format(port, path), timeout = 10).status
+
+    def test_serves_recycles_reloads_and_stops(self):
+        log_path = os.path.join(self.directory, 'serve.log')
+        environment = dict(os.environ, FLASKBLOG_CONFIG_FILE = self.config_file, METRICS_TOKEN = 'scraper',
+                           RESPONSE_CACHE_BACKEND = 'memory',
+                           RESPONSE_CACHE_DIR = os.path.join(self.directory, 'cache'),
+                           SLOW_QUERY_LOG = os.path.join(self.directory, 'slow.jsonl'))
+        with open(log_path, 'w') as log:
+            master = subprocess.Popen([sys.executable, '-m', 'flaskblog.serve', '--bind', '127.0.0.1:0',
+                                       '--workers', '2', '--threads', '2', '--max-requests', '2',
+                                       '--max-requests-jitter', '0', '--graceful-timeout', '10'],
+                                      cwd = ROOT, env = environment, stdout = log, stderr = subprocess.STDOUT)
+        self.addCleanup(lambda: master.poll() is None and master.kill())
+        port = None
+        deadline = time.monotonic() + 30
+        while port is None and time.monotonic() < deadline and master.poll() is None:
+            time.sleep(0.1)
+            with open(log_path) as log:
+                match = re.search(r'Listening at http://127\.0\.0\.1:(\d+)', log.read())
+            port = match and int(match.group(1))
+        self.assertIsNotNone(port, open(log_path).read())
+
+        self.assertEqual([self.get(port, path) for path in ('/', '/post/1', '/about', '/', '/post/2')], [200] * 5)
+        master.send_signal(signal.SIGHUP)
+        time.sleep(1)
+        self.assertEqual([self.get(port, '/') for _ in range(4)], [200] * 4)
+        time.sleep(1)  # a worker dumps its numbers on its first request and when it is recycled
+        scrape = urllib.request.Request('http://127.0.0.1:{}/metrics'.format(port),
+                                        headers = {'Authorization': 'Bearer scraper'})
+        text = urllib.request.urlopen(scrape, timeout = 10).read().decode()
+        # every worker's requests, including those of workers recycled or replaced by the reload
+        self.assertIn('flaskblog_requests_total{endpoint="main.home",method="GET",status="200"} 6', text)
+        master.send_signal(signal.SIGTERM)
+        self.assertEqual(master.wait(30), 0)
+        with open(log_path) as log:
+            output = log.read()
+        self.assertIn('recycled after 2 requests', output)
+        self.assertIn('Reloading', output)
+        self.assertIn('using the filesystem backend', output)
+        self.assertTrue(os.listdir(os.path.join(self.directory, 'cache')))  # the warm-up filled the shared cache
+        self.assertNotIn('Traceback', output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import json
+import os
+import subprocess
+import sys
+import inspect
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from flaskblog import db, bcrypt, create_app
+from flaskblog.config import ProductionConfig, TestingConfig
+from helpers import make_app
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_no_side_effects_or_slow_imports(self):
+        program = ("import sys; from flaskblog import create_app; create_app('testing'); "
+                   "print(sorted(name for name in ('flask_admin', 'alembic', 'flask_migrate', 'flask_moment') "
+                   "if name in sys.modules))")
+        environment = dict(os.environ, FLASKBLOG_CONFIG_FILE = os.path.join(ROOT, 'missing.json'))
+        environment.pop('FLASK_RUN_FROM_CLI', None)
+        result = subprocess.run([sys.executable, '-c', program], cwd = ROOT, env = environment,
+                                capture_output = True, text = True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), '[]')
+
+    def test_production_config_file_read_by_create_app(self):
+        with tempfile.NamedTemporaryFile('w', suffix = '.json', delete = False) as f:
+            json.dump(dict(SECRET_KEY = 'from-file', SQLALCHEMY_DATABASE_URI = 'sqlite://', MAIL_USER = 'blog'), f)
+        self.addCleanup(os.remove, f.name)
+
+        class Production(ProductionConfig):
+            CONFIG_FILE = f.name
+
+        app = create_app(Production)
+        self.assertEqual(app.config['SECRET_KEY'], 'from-file')
+        self.assertEqual(app.config['MAIL_USERNAME'], 'blog')
+        self.assertIsNone(app.config['MAIL_PASSWORD'])
+
+
+class TestLazyAdmin(unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()
+        with self.app.app_context():
+            from flaskblog.models import User, Role
+            for name, role in (('admin', 'Administrator'), ('member', 'User')):
+                db.session.add(User(username = name, email = name + '@example.com', country = 'Kenya',
+                                    confirmed = True, password = bcrypt.generate_password_hash('pw').decode('utf-8'),
+                                    role = Role.query.filter_by(name = role).one()))
+            db.session.commit()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.drop_all()
+
+    def client(self, name):
+        client = self.app.test_client()
+        client.post('/login', data = dict(email = name + '@example.com', password = 'pw'))
+        return client
+
+    def test_members_cannot_load_the_admin(self):
+        self.assertEqual(self.app.test_client().get('/admin/user/').status_code, 403)
+        self.assertEqual(self.client('member').get('/admin/').status_code, 403)
+        self.assertNotIn('admin', self.app.extensions)
+
+    def test_admin_installed_on_first_visit(self):
+        admin = self.client('admin')
+        response = admin.get('/admin/user/?page=0')
+        self.assertEqual(response.status_code, 307)
+        self.assertTrue(response.headers['Location'].endswith('/admin/user/?page=0'))
+        self.assertIn('admin', self.app.extensions)
+        self.assertEqual(admin.get('/admin/user/?page=0').status_code, 200)
+        self.assertEqual(admin.get('/admin/').status_code, 200)
+        self.assertEqual(self.client('member').get('/admin/user/').status_code, 403)
+        self.assertFalse([rule for rule in self.app.url_map.iter_rules() if rule.endpoint.startswith('admin_loader.')])
+
+    def test_concurrent_first_visits_install_once(self):
+        from flaskblog import admin
+        barrier = threading.Barrier(4)
+        installed = []
+
+        def visit():
+            barrier.wait()
+            installed.append(admin.install_admin(self.app))
+
+        with mock.patch.object(admin, 'build_admin', wraps = admin.build_admin) as build:
+            threads = [threading.Thread(target = visit) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(build.call_count, 1)
+        self.assertEqual(len(installed), 4)
+        self.assertTrue(all(each is installed[0] for each in installed))
+        self.assertEqual(self.client('admin').get('/admin/').status_code, 200)
+
+    def test_install_refuses_unchecked_versions(self):
+        from flaskblog import admin
+        with mock.patch.object(admin, 'MERGE_TESTED_WITH', ((admin.werkzeug, '0.9.'),)):
+            with self.assertRaises(RuntimeError):
+                admin.install_admin(self.app)
+        self.assertNotIn('admin', self.app.extensions)
+        self.assertEqual(self.client('admin').get('/admin/').status_code, 307)
+
+
+class TestAdminMergePinned(unittest.TestCase):
+    """
+    install_admin writes to Flask's private state and copies the url map by hand. These fail on a
+    Flask or Werkzeug upgrade, check flaskblog/admin.py against the new versions before changing them.
+    """
+
+    def test_versions_are_the_checked_ones(self):
+        from flaskblog.admin import check_versions
+        check_versions()
+
+    def test_private_state_still_exists(self):
+        app = make_app()
+        self.assertIsInstance(app._blueprint_order, list)
+        self.assertIsInstance(app.blueprints, dict)
+        self.assertIsInstance(app.view_functions, dict)
+
+    def test_map_copy_keeps_every_setting(self):
+        from flaskblog.admin import _copy_map
+        app = make_app()
+        copied = _copy_map(app.url_map, list(app.url_map.iter_rules()))
+        settings = [name for name in inspect.signature(app.url_map.__class__).parameters if name != 'rules']
+        for name in settings:
+            self.assertEqual(getattr(copied, name), getattr(app.url_map, name), name)
+        self.assertEqual(sorted(map(str, copied.iter_rules())), sorted(map(str, app.url_map.iter_rules())))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import json
+import unittest
+from datetime import datetime
+
+from flaskblog import db
+from helpers import make_app
+from mailgun_stub import MailgunStub
+
+
+class TestListSubscriptions(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = MailgunStub().__enter__()
+        self.app = make_app()
+        self.app.config.update(MAILGUN_API_URL = self.stub.url, MAIL_API_KEY = 'key-test')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        from flaskblog.subscriptions import MailingListSubscriber
+        self.subscriptions = MailingListSubscriber(self.app)  # fresh HTTP session per test
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.stub.__exit__(None, None, None)
+
+    def test_one_request_per_list_over_one_connection(self):
+        from flaskblog.models import ListSubscription
+        self.subscriptions.subscribe('a@example.com', 'devs@lists.test')
+        self.subscriptions.subscribe('news@example.com', 'news@lists.test')
+        self.subscriptions.subscribe('B@example.com', 'devs@lists.test')
+        self.subscriptions.subscribe('a@example.com', 'devs@lists.test')
+        self.assertEqual(self.subscriptions.process_batch(), 4)
+
+        self.assertEqual([r['path'] for r in self.stub.requests],
+                         ['/v3/lists/devs@lists.test/members.json', '/v3/lists/news@lists.test/members.json'])
+        devs = self.stub.requests[0]['form']
+        self.assertEqual(devs['upsert'], 'yes')
+        self.assertEqual([m['address'] for m in json.loads(devs['members'])], ['a@example.com', 'b@example.com'])
+        self.assertEqual(len({r['client'] for r in self.stub.requests}), 1)
+        self.assertEqual({s.status for s in ListSubscription.query}, {'done'})
+
+    def test_server_errors_are_retried(self):
+        from flaskblog.models import ListSubscription
+        self.subscriptions.subscribe('a@example.com', 'devs@lists.test')
+        self.stub.statuses = [503]
+        self.subscriptions.process_batch()
+        row = ListSubscription.query.one()
+        self.assertEqual((row.status, row.attempts), ('pending', 1))
+        self.assertGreater(row.next_attempt_at, datetime.utcnow())
+
+        row.next_attempt_at = datetime.utcnow()
+        db.session.commit()
+        self.subscriptions.process_batch()
+        self.assertEqual(ListSubscription.query.one().status, 'done')
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_rejected_requests_are_not_retried(self):
+        from flaskblog.models import ListSubscription
+        self.subscriptions.subscribe('not-an-address', 'devs@lists.test')
+        self.stub.statuses = [400]
+        self.subscriptions.process_batch()
+        row = ListSubscription.query.one()
+        self.assertEqual((row.status, row.attempts), ('failed', 1))
+
+    def test_a_rejected_address_does_not_fail_its_batch(self):
+        from flaskblog.models import ListSubscription
+        for email in ('a@example.com', 'b@example.com', 'bad', 'c@example.com'):
+            self.subscriptions.subscribe(email, 'devs@lists.test')
+        self.stub.statuses = [400, 200, 400, 400, 200]  # whole batch, a+b, bad+c, bad, c
+        self.assertEqual(self.subscriptions.process_batch(), 4)
+        self.assertEqual({row.email: row.status for row in ListSubscription.query},
+                         {'a@example.com': 'done', 'b@example.com': 'done', 'bad': 'failed', 'c@example.com': 'done'})
+        self.assertEqual(len(self.stub.requests), 5)
+
+    def test_configuration_errors_keep_the_batch_queued(self):
+        from flaskblog.models import ListSubscription
+        self.app.config['SUBSCRIPTION_MAX_ATTEMPTS'] = 1
+        for email in ('a@example.com', 'b@example.com', 'c@example.com'):
+            self.subscriptions.subscribe(email, 'devs@lists.test')
+        self.stub.statuses = [401]
+        with self.assertLogs('flaskblog.subscriptions', 'ERROR'):
+            self.assertEqual(self.subscriptions.process_batch(), 3)
+        self.assertEqual(len(self.stub.requests), 1)  # not split
+        self.assertEqual({(row.status, row.attempts) for row in ListSubscription.query}, {('pending', 1)})
+
+    def test_malformed_addresses_are_not_queued(self):
+        from flaskblog.models import ListSubscription
+        client = self.app.test_client()
+        client.post('/subscribe', data = dict(submail = 'not an address'))
+        self.assertEqual(ListSubscription.query.count(), 0)
+        client.post('/subscribe', data = dict(submail = 'Reader@Example.com'))
+        self.assertEqual(ListSubscription.query.one().email, 'reader@example.com')
+
+    def test_register_queues_the_signup(self):
+        from flaskblog.models import ListSubscription
+        from flaskblog.subscriptions import DEVELOPERS_LIST
+        response = self.app.test_client().post('/register', data = dict(
+            username = 'amina', email = 'amina@example.com', country = 'Kenya', password = 'pw',
+            confirm_password = 'pw'))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.stub.requests, [])
+        row = ListSubscription.query.one()
+        self.assertEqual((row.email, row.list_address, row.status), ('amina@example.com', DEVELOPERS_LIST, 'pending'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+
+from flaskblog import db
+from helpers import make_app, seed, count_queries, QueryCountMixin
+
+
+class TestTags(unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        from flaskblog.models import User
+        self.user = User(username = 'amina', email = 'amina@example.com', country = 'Kenya', password = 'x')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_existing_tags_are_reused(self):
+        from flaskblog.models import Tag
+        from flaskblog.tags import get_or_create_tags
+        first = get_or_create_tags(['Python', 'flask'])
+        db.session.commit()
+        with count_queries(self.app) as statements:
+            again = get_or_create_tags(['python ', 'FLASK', 'Python!', ''])
+        self.assertEqual(len(statements), 1)
+        self.assertEqual([t.id for t in again], [t.id for t in first])
+        self.assertEqual(Tag.query.count(), 2)
+
+    def test_set_post_tags_replaces_the_tags(self):
+        from flaskblog.counters import get_count, tag_counter
+        from flaskblog.models import Post
+        from flaskblog.tags import set_post_tags
+        post = Post(title = 'Tagged', content = 'x', author = self.user)
+        set_post_tags(post, ['python', 'flask'])
+        db.session.commit()
+        set_post_tags(post, ['flask', 'africa'])
+        db.session.commit()
+        self.assertEqual(sorted(t.slug for t in post.tag), ['africa', 'flask'])
+        self.assertEqual([get_count(tag_counter(s)) for s in ('python', 'flask', 'africa')], [0, 1, 1])
+
+
+class TestTagPages(QueryCountMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()
+        self.app.config['FLASKY_POSTS_PER_PAGE'] = 2
+        with self.app.app_context():
+            seed(users = 2, posts_per_user = 6, comments_per_post = 0)  # tags rotate over 3 names
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.drop_all()
+
+    def test_tag_page_lists_only_tagged_posts(self):
+        # tag, page of posts + authors, tags of the page
+        with self.assertNumQueries(self.app, 3):
+            response = self.client.get('/tag/python')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Post 12', response.data)
+        self.assertNotIn(b'Post 11', response.data)
+        self.assertEqual(self.client.get('/tag/missing').status_code, 404)
+
+    def test_recent_posts_outrank_older_ones(self):
+        from datetime import datetime, timedelta
+        from flaskblog.models import Post, Tag, User
+        from flaskblog.tags import popular_tags, set_post_tags
+        with self.app.app_context():
+            self.assertEqual(len(popular_tags()), 3)
+            user = User.query.first()
+            post = Post(title = 'Old news', content = 'x', author = user, date_posted = datetime(2019, 1, 1))
+            set_post_tags(post, ['history'])
+            for days in range(2):
+                newer = Post(title = 'Fresh', content = 'x', author = user,
+                             date_posted = datetime(2020, 6, 1) + timedelta(days = days))
+                set_post_tags(newer, ['news'])
+            db.session.commit()
+            # two posts from months later beat four older ones
+            self.assertEqual(popular_tags(2)[0].slug, 'news')
+            self.assertEqual(popular_tags(10)[-1].slug, 'history')
+            before = Tag.query.filter_by(slug = 'news').one().popularity
+            db.session.delete(Post.query.filter_by(title = 'Fresh').first())
+            db.session.commit()
+            self.assertLess(Tag.query.filter_by(slug = 'news').one().popularity, before)
+            scores = {t.slug: t.popularity for t in Tag.query}
+            from flaskblog.tags import rescore
+            rescore()
+            for tag in Tag.query:
+                self.assertAlmostEqual(tag.popularity, scores[tag.slug], delta = scores[tag.slug] * 1e-9)
+
+
+if __name__ == '__main__':
+    unittest.main()